@@ -11,45 +11,82 @@
 #    - 우하단 개발자 이름 고정 표기
 #    - 좌상단 학교 로고 + "언양고등학교" 링크(클릭 시 학교 홈페이지)
 
+import csv
+import io
 import json
 import os
-import random
-import re
 import tempfile
 import time
-from typing import Dict, Optional, Tuple
+import uuid
 
-import requests
 import streamlit as st
-from google import genai
-from google.genai import types
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from h_pipeline import (
+    AUTO_GAS_FORMAT_DEFAULT,
+    GENERATION_PRESETS,
+    PROFILE_CATEGORIES,
+    REPORT_SECTIONS,
+    RUN_FAILURES_KEY,
+    RUN_STAGE_LABELS,
+    ExportBusy,
+    ExportTooLarge,
+    PdfExportJob,
+    PipelineError,
+    RunDeadline,
+    RunOptions,
+    SamplingProfiler,
+    SharedStateBackend,
+    SheetProgressCache,
+    active_generation_preset,
+    benchmark_generation_presets,
+    build_progress_table,
+    circuit_breaker_snapshots,
+    clean_generated_text,
+    configure,
+    fastest_complete_preset,
+    gas_format_pending,
+    get_gas_format_queue,
+    get_google_services,
+    get_shared_state,
+    google_http_stats,
+    make_run_key,
+    normalize_student_num,
+    parse_roster_csv,
+    preflight_blockers,
+    prompt_versions,
+    read_export_targets,
+    regenerate_report_section,
+    request_gas_format,
+    run_preflight,
+    run_student_pipeline,
+    set_notifier,
+    stage_checkpoint,
+)
+
+
+def current_session_key() -> str:
+    """브라우저 세션 1개를 가리키는 키(세션 상태에 1회 생성)."""
+    if "_session_key" not in st.session_state:
+        st.session_state["_session_key"] = uuid.uuid4().hex
+    return st.session_state["_session_key"]
 
-def rate_limit(key: str, limit: int, per_seconds: int) -> None:
+
+def rate_limit(key: str, limit: int, per_seconds: int, scope: str = "session") -> None:
     """
-    간단 레이트리밋(세션 단위).
+    간단 레이트리밋. 기록은 공유 상태 저장소에 두므로 여러 프로세스가 같은 한도를 본다.
     key: 제한 그룹 이름
     limit: 허용 횟수
     per_seconds: 기간(초)
+    scope: "session"(세션 단위) 또는 "global"(모든 세션 합산)
     """
-    now = time.time()
-    hist_key = f"_rl_{key}"
-    hist = st.session_state.get(hist_key, [])
-
-    # 기간 밖 기록 제거
-    hist = [t for t in hist if now - t < per_seconds]
+    bucket = f"{key}:{current_session_key()}" if scope == "session" else key
+    wait = get_shared_state().hit_rate_limit(bucket, limit, per_seconds)
 
-    if len(hist) >= limit:
-        wait = int(per_seconds - (now - hist[0])) + 1
-        st.error(f"요청이 너무 많습니다. {wait}초 후 다시 시도하세요.")
+    if wait > 0:
+        st.error(f"요청이 너무 많습니다. {int(wait) + 1}초 후 다시 시도하세요.")
         st.stop()
 
-    hist.append(now)
-    st.session_state[hist_key] = hist
-
 
 # =========================================================
 # 0) 환경 설정 (당신 PC 환경에 맞게 수정)
@@ -72,38 +109,12 @@ def load_oauth_client_secret_to_tempfile() -> str:
 
 OAUTH_CLIENT_SECRET_FILE = load_oauth_client_secret_to_tempfile()
 
+# 생성/문서/시트 파이프라인(h_pipeline.py)에 secrets를 그대로 넘김
+# (값이 같으면 재실행마다 아무 일도 없음) + 재시도 알림은 화면에 표시
+configure(st.secrets)
+set_notifier(lambda level, message: getattr(st, level)(message))
 
-# 템플릿 문서 ID (보고서 / 지도방침 분리 권장)
-TEMPLATE_REPORT_DOC_ID = "1HPzXRHgK1k6sx3f0IlXa4E2WLiOz2bDtqnxsAhbbdjo"
-TEMPLATE_GUIDE_DOC_ID = "1183Mnqp676B7bn1y2aDdqhSGHeZX_HPx1DscgP_ZNTs"
-
-# 저장 폴더 ID (비우면 내 드라이브 루트)
-DRIVE_FOLDER_ID_REPORT = "1jb60S7fibE-Acz9f8vZZt-4r7-fTLwjp"
-DRIVE_FOLDER_ID_GUIDE = "1jb60S7fibE-Acz9f8vZZt-4r7-fTLwjp"
-
-# 스프레드시트 기록
-SHEETS_ID = "1cwJ4Lf_XE5sWDNATHBTzhoeNgFM5jBV-Tj4Qx7GyrL0"
-SHEETS_TAB = "컨설팅 보고서"
-
-# Gemini Key
-GEMINI_API_KEY = st.secrets["GEMINI_API_KEY"]
-
-# GAS Web App (자동 서식 적용)
-GAS_WEBAPP_URL = st.secrets["GAS_WEBAPP_URL"]
-GAS_TOKEN = st.secrets["GAS_TOKEN"]
-
-
-AUTO_GAS_FORMAT_DEFAULT = False  # 기본은 안정적으로 OFF
-
-SCOPES = [
-    "https://www.googleapis.com/auth/drive",
-    "https://www.googleapis.com/auth/documents",
-    "https://www.googleapis.com/auth/spreadsheets",
-]
-
-MODEL_REPORT = "gemini-2.5-pro"
-MODEL_SUMMARY = "gemini-2.5-flash"
-MODEL_GUIDE = "gemini-2.5-pro"
+GLOBAL_RUN_LIMIT_PER_MIN = int(st.secrets.get("GLOBAL_RUN_LIMIT_PER_MIN", 0))  # 0=끔
 
 
 # =========================================================
@@ -246,6 +257,29 @@ auto_gas_format = st.sidebar.toggle(
     help="ON이면 문서 생성 직후 GAS 자동 서식을 '시도'합니다. 실패해도 보고서 생성은 계속됩니다.",
 )
 
+page = st.sidebar.radio(
+    "화면",
+    ["보고서 생성", "학급 진행 현황", "PDF 내보내기", "목차 다시 생성"],
+    key="page",
+)
+
+# 관리자 전용 도구(ADMIN_CODE가 설정된 경우에만 표시)
+ADMIN_CODE = st.secrets.get("ADMIN_CODE", "")
+is_admin = bool(ADMIN_CODE) and (
+    st.sidebar.text_input("관리자 코드", type="password", key="admin_code")
+    == ADMIN_CODE
+)
+# 프로파일링은 1회만: 지난 실행에서 썼으면 토글을 그리기 전에 끈다
+# (위젯이 만들어진 뒤에는 같은 실행 안에서 값을 바꿀 수 없음)
+if st.session_state.pop("profile_used", False):
+    st.session_state["profile_next_run"] = False
+profile_next_run = is_admin and st.sidebar.toggle(
+    "프로파일링(다음 실행 1회)",
+    key="profile_next_run",
+    help="실행 1회를 샘플링 프로파일러로 감싸 함수별 경과/CPU 시간과 "
+    "대기 유형(sleep/네트워크/CPU)을 기록합니다.",
+)
+
 st.markdown(
     """
     <div style="text-align:center; margin-top:14px; margin-bottom:18px;">
@@ -258,771 +292,459 @@ st.markdown(
     unsafe_allow_html=True,
 )
 
-if not GEMINI_API_KEY:
+if not st.secrets.get("GEMINI_API_KEY"):
     st.error("⚠️ GEMINI_API_KEY 환경 변수가 설정되지 않았습니다.")
     st.stop()
 
-client = genai.Client(api_key=GEMINI_API_KEY)
-
 # =========================================================
-# 2) 재시도(백오프)
+# 2-1) 프로파일링(관리자) — 결과 표시
 # =========================================================
 
 
-def _sleep_backoff(attempt: int, base: float = 2.0, cap: float = 60.0) -> None:
-    delay = min(cap, base * (2**attempt))
-    delay = delay * (0.6 + random.random() * 0.8)
-    time.sleep(delay)
-
-
-def _is_retryable_gemini_error(e: Exception) -> bool:
-    s = str(e).lower()
-    return any(
-        k in s
-        for k in [
-            "429",
-            "rate",
-            "quota",
-            "resource exhausted",
-            "503",
-            "overload",
-            "unavailable",
-            "504",
-            "deadline",
-            "timeout",
-        ]
-    )
+def render_profile(profiler: SamplingProfiler) -> None:
+    with st.expander("🧪 프로파일링 결과(이번 실행)", expanded=True):
+        st.caption(
+            f"경과 {profiler.wall_s:.1f}s · CPU {profiler.cpu_s:.1f}s · "
+            + " · ".join(
+                f"{label} {profiler.categories[c]:.1f}s"
+                for c, label in PROFILE_CATEGORIES.items()
+            )
+        )
+        rows = profiler.table()
+        st.dataframe(rows, use_container_width=True)
+        st.download_button(
+            "접힌 스택(collapsed) 내려받기 — flamegraph.pl / speedscope",
+            data=profiler.collapsed_text(),
+            file_name="h_app_profile.collapsed.txt",
+            mime="text/plain",
+        )
+        if rows:
+            buf = io.StringIO()
+            writer = csv.DictWriter(buf, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(profiler.table(limit=1000))
+            st.download_button(
+                "함수별 표(CSV) 내려받기",
+                data=buf.getvalue().encode("utf-8-sig"),
+                file_name="h_app_profile_functions.csv",
+                mime="text/csv",
+            )
 
 
-def _is_retryable_http_error(e: HttpError) -> bool:
-    status = None
-    try:
-        status = e.resp.status
-    except Exception:
-        pass
-    return status in [429, 500, 502, 503, 504]
+# =========================================================
+# 6-1) 생성 프리셋 — 세션 선택
+# =========================================================
 
 
-def execute_with_retry(fn, max_retries: int = 6, label: str = "API"):
-    for attempt in range(max_retries):
-        try:
-            return fn()
-        except HttpError as e:
-            if _is_retryable_http_error(e) and attempt < max_retries - 1:
-                st.warning(f"⚠️ {label} 재시도 ({attempt+1}/{max_retries})")
-                _sleep_backoff(attempt)
-                continue
-            raise
+def session_generation_preset() -> str:
+    """관리자가 이 세션에서 고른 프리셋(없으면 secrets 기본값)."""
+    name = st.session_state.get("generation_preset")
+    return name if name in GENERATION_PRESETS else active_generation_preset()
 
 
 # =========================================================
-# 3) Google OAuth & 서비스
+# 10) GAS 호출 — 화면 알림
 # =========================================================
 
 
-def get_google_services():
-    """
-    Streamlit Cloud / 서버 환경용
-    - Service Account 기반 Google Docs / Drive / Sheets 인증
-    """
-    import json
+def doc_link_button(label: str, doc_url: str) -> None:
+    """문서 링크 — 자동 서식/토큰 정리가 끝나기 전이면 그렇다고 표시."""
+    if gas_format_pending(doc_url):
+        label += " (서식 적용 중)"
+    st.link_button(label, doc_url)
 
-    import streamlit as st
-    from google.oauth2 import service_account
-    from googleapiclient.discovery import build
-
-    if "GOOGLE_SERVICE_ACCOUNT_JSON" not in st.secrets:
-        st.error("❌ GOOGLE_SERVICE_ACCOUNT_JSON 이 Secrets에 없습니다.")
-        st.stop()
-
-    sa_info = json.loads(st.secrets["GOOGLE_SERVICE_ACCOUNT_JSON"])
-
-    creds = service_account.Credentials.from_service_account_info(
-        sa_info,
-        scopes=[
-            "https://www.googleapis.com/auth/drive",
-            "https://www.googleapis.com/auth/documents",
-            "https://www.googleapis.com/auth/spreadsheets",
-        ],
-    )
 
-    drive = build("drive", "v3", credentials=creds)
-    docs = build("docs", "v1", credentials=creds)
-    sheets = build("sheets", "v4", credentials=creds)
+def call_gas_auto_format(doc_id: str) -> None:
+    try:
+        request_gas_format(get_gas_format_queue().session, doc_id)
+        st.info("ℹ️ (참고) 자동 서식 적용 시도 완료")
 
-    return drive, docs, sheets
+    except Exception:
+        st.warning(
+            "⚠️ 자동 서식 적용은 건너뛰었습니다.\n"
+            "문서 상단 메뉴 ‘⚙ 보고서 서식 → ✅ 본문 서식 적용’을 눌러주세요."
+        )
 
 
 # =========================================================
-# 4) Drive: 템플릿 복사 + 폴더 이동
+# 12-1) 학급 진행 현황(대시보드) — 화면
 # =========================================================
 
 
-def copy_template(
-    drive_service, template_id: str, title: str, folder_id: str = ""
-) -> str:
-    copied = execute_with_retry(
-        lambda: drive_service.files()
-        .copy(
-            fileId=template_id,
-            body={"name": title},
-            supportsAllDrives=True,
-        )
-        .execute(),
-        label="Drive Copy",
+def render_progress_dashboard() -> None:
+    st.subheader("📊 학급 진행 현황")
+    roster_file = st.file_uploader(
+        "학급 명단 CSV(머리글: 학번, 이름) — 없으면 시트에 기록된 학생만 표시",
+        type=["csv"],
+        key="roster_csv",
     )
-    file_id = copied.get("id")
-    if not file_id:
-        raise RuntimeError("템플릿 복사 실패: id 없음")
-
-    folder_id = (folder_id or "").strip()
-    if folder_id:
-        meta = execute_with_retry(
-            lambda: drive_service.files()
-            .get(fileId=file_id, fields="parents", supportsAllDrives=True)
-            .execute(),
-            label="Drive Get Parents",
-        )
-        prev_parents = ",".join(meta.get("parents", []))
-        execute_with_retry(
-            lambda: drive_service.files()
-            .update(
-                fileId=file_id,
-                addParents=folder_id,
-                removeParents=prev_parents,
-                fields="id, parents",
-                supportsAllDrives=True,
-            )
-            .execute(),
-            label="Drive Move Folder",
-        )
-
-    return file_id
+    refresh = st.button("시트 다시 확인", key="progress_refresh")
 
+    state = get_shared_state()
+    cache = SheetProgressCache(state)
+    try:
+        drive_service, _, sheets_service = get_google_services()
+        synced = cache.rows(drive_service, sheets_service, force=refresh)
+    except (HttpError, RuntimeError) as e:
+        st.error(f"Google API 오류: {e}")
+        return
 
-# =========================================================
-# 5) Docs: placeholder 관리
-# =========================================================
-
-
-def _doc_contains_text(doc_json: dict, needle: str) -> bool:
-    content = doc_json.get("body", {}).get("content", [])
-    for el in content:
-        para = el.get("paragraph")
-        if not para:
-            continue
-        for pe in para.get("elements", []):
-            tr = pe.get("textRun", {})
-            txt = tr.get("content", "")
-            if needle in txt:
-                return True
-    return False
-
+    try:
+        roster = parse_roster_csv(roster_file.getvalue()) if roster_file else []
+    except ValueError as e:
+        st.error(str(e))
+        return
 
-def ensure_placeholders_exist(
-    docs_service, doc_id: str, placeholders: Dict[str, str]
-) -> None:
-    """문서 내 플레이스홀더가 없으면 '문서 끝'에 삽입(보험)."""
-    doc = execute_with_retry(
-        lambda: docs_service.documents().get(documentId=doc_id).execute(),
-        label="Docs Get",
+    table = build_progress_table(
+        roster, synced["rows"], state.cache_get(RUN_FAILURES_KEY) or {}
+    )
+    st.caption(
+        f"마지막 동기화 {time.strftime('%H:%M:%S', time.localtime(synced['synced_at']))}"
+        f" · 이번 조회 API 호출: Drive {cache.last_sync_calls['drive']}회,"
+        f" Sheets {cache.last_sync_calls['sheets']}회"
     )
-    missing = [ph for ph in placeholders.keys() if not _doc_contains_text(doc, ph)]
-    if not missing:
+    if not table:
+        st.info("표시할 학생이 없습니다.")
         return
 
-    content = doc.get("body", {}).get("content", [])
-    end_index = content[-1].get("endIndex") if content else 1
-    if end_index is None:
-        end_index = 1
-
-    insert_text = "\n"
-    for ph in missing:
-        title = placeholders.get(ph, ph)
-        insert_text += f"\n[{title}]\n{ph}\n"
-    insert_text += "\n"
-
-    reqs = [{"insertText": {"location": {"index": end_index - 1}, "text": insert_text}}]
-
-    execute_with_retry(
-        lambda: docs_service.documents()
-        .batchUpdate(documentId=doc_id, body={"requests": reqs})
-        .execute(),
-        label="Docs Insert Placeholder",
+    classes = sorted(
+        {(r["학년"], r["반"]) for r in table}, key=lambda c: (c[0], int(c[1] or 0))
     )
-
-
-def batch_replace_all_text(
-    docs_service, doc_id: str, replace_map: Dict[str, str]
-) -> None:
-    reqs = []
-    for k, v in replace_map.items():
-        reqs.append(
+    summary = []
+    for grade, klass in classes:
+        rows = [r for r in table if (r["학년"], r["반"]) == (grade, klass)]
+        summary.append(
             {
-                "replaceAllText": {
-                    "containsText": {"text": k, "matchCase": True},
-                    "replaceText": v or "",
-                }
+                "학년": grade,
+                "반": klass,
+                "완료": sum(r["상태"] == "완료" for r in rows),
+                "미완료": sum(r["상태"] == "미완료" for r in rows),
+                "실패": sum(r["상태"] == "실패" for r in rows),
+                "전체": len(rows),
             }
         )
-    if not reqs:
-        return
+    st.dataframe(summary, use_container_width=True)
 
-    execute_with_retry(
-        lambda: docs_service.documents()
-        .batchUpdate(documentId=doc_id, body={"requests": reqs})
-        .execute(),
-        label="Docs ReplaceAllText",
-    )
-
-
-def remove_debug_tokens_after_format(docs_service, doc_id: str) -> None:
-    """GAS 서식 적용 후 보기 싫은 토큰 제거(보고서+담임템플릿 공용)."""
-    batch_replace_all_text(
-        docs_service,
-        doc_id,
-        {
-            # 공용
-            "[[HR]]": "",
-            "=== 본문 시작 ===": "",
-            # 보고서 템플릿
-            "{{REPORT_ANCHOR}}": "",
-            # 담임 템플릿
-            "{{GUIDE_ANCHOR}}": "",
-            "[[NOTES_START]]": "",
-            "[[NOTES_END]]": "",
-        },
+    labels = ["전체"] + [f"{g}학년 {k}반" for g, k in classes]
+    pick = st.selectbox("학년/반", labels)
+    status_pick = st.multiselect(
+        "상태", ["완료", "미완료", "실패"], default=["미완료", "실패"]
     )
+    shown = [
+        r
+        for r in table
+        if (pick == "전체" or pick == f"{r['학년']}학년 {r['반']}반")
+        and r["상태"] in status_pick
+    ]
+    st.dataframe(shown, use_container_width=True)
 
 
 # =========================================================
-# 6) Gemini 생성
+# 12-2) PDF 일괄 내보내기 — 화면
 # =========================================================
 
 
-def gemini_generate_text_with_retry(
-    model: str, prompt: str, pdf_bytes: Optional[bytes], max_retries: int = 6
-) -> str:
-    contents = [prompt]
-    if pdf_bytes:
-        pdf_part = types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")
-        contents.append(pdf_part)
+def render_pdf_export() -> None:
+    st.subheader("📦 PDF 일괄 내보내기")
+    col1, col2 = st.columns(2)
+    with col1:
+        grade = st.selectbox("학년", ["1", "2", "3"], key="export_grade")
+    with col2:
+        klass = st.text_input("반(비우면 학년 전체)", key="export_class").strip()
+    if klass and not klass.isdigit():
+        st.error("반은 숫자로 입력하세요.")
+        return
+    klass = str(int(klass)) if klass else ""
+    label = f"{grade}학년 {klass}반" if klass else f"{grade}학년"
 
-    cfg = types.GenerateContentConfig(
-        temperature=0.35,
-        max_output_tokens=8192 if model.endswith("pro") else 4096,
-    )
+    job = PdfExportJob(label)
+    try:
+        _, _, sheets_service = get_google_services()
+        targets = read_export_targets(sheets_service, grade, klass)
+    except (HttpError, RuntimeError) as e:
+        st.error(f"Google API 오류: {e}")
+        return
+    if not targets:
+        st.info(f"{label}: 시트에 기록된 문서가 없습니다.")
+        return
 
-    last_err = None
-    for attempt in range(max_retries):
+    pending = job.pending(targets)
+    st.caption(
+        f"{label}: 문서 {len(targets)}개 · 받은 것 {len(targets) - len(pending)}개"
+        f" · 남은 것 {len(pending)}개 (동시 {job.max_workers}개)"
+    )
+    c1, c2 = st.columns(2)
+    start = c1.button(
+        "이어서 내보내기" if len(pending) < len(targets) else "내보내기 시작",
+        disabled=not pending,
+        key="export_start",
+    )
+    if c2.button("처음부터 다시", key="export_reset"):
         try:
-            resp = client.models.generate_content(
-                model=model, contents=contents, config=cfg
-            )
-            text = (resp.text or "").strip()
-            if not text:
-                raise RuntimeError("Gemini 응답이 비었습니다.")
-            return text
-        except Exception as e:
-            last_err = e
-            if _is_retryable_gemini_error(e) and attempt < max_retries - 1:
-                st.warning(f"⚠️ Gemini 재시도 ({attempt+1}/{max_retries})")
-                _sleep_backoff(attempt)
-                continue
-            raise RuntimeError(f"Gemini 실패: {e}") from e
-
-    raise RuntimeError(f"Gemini 실패(최종): {last_err}")
-
-
-# =========================================================
-# 7) 본문 숫자목록 방지(후처리) — 헤딩 보호
-# =========================================================
-
-
-def is_heading_line(line: str) -> bool:
-    s = line.strip()
-    if not re.match(r"^\d+(-\d+){0,2}\.\s+\S+", s):
-        return False
-    if len(s) > 40:
-        return False
-    if s.endswith(("다.", "요.", ".")):
-        return False
-    return True
-
-
-def sanitize_numbered_lists(text: str) -> str:
-    lines = text.splitlines()
-    processed = []
-    for line in lines:
-        stripped = line.strip()
-
-        # ✅ 헤더는 무조건 보호
-        if is_heading_line(stripped):
-            processed.append(stripped)
-            continue
-
-        # ❌ 일반 숫자 목록만 변환
-        if re.match(r"^\d+\.\s+", stripped):
-            body = stripped.split(".", 1)[1].strip()
-            processed.append(f"- {body}")
+            job.reset()
+        except ExportBusy as e:
+            st.warning(str(e))
         else:
-            processed.append(line)
-    return "\n".join(processed)
+            st.rerun()
 
+    if start:
+        bar = st.progress(0.0)
 
-# =========================================================
-# 8) 담임조언 분량: 9000바이트 내에서 문장 완결 우선
-# =========================================================
+        def on_progress(done: int, total: int) -> None:
+            bar.progress(done / total if total else 1.0, text=f"{done}/{total}")
 
+        try:
+            errors = job.run(targets, on_progress)
+        except ExportBusy as e:
+            st.warning(str(e))
+            errors = {}
+        if errors:
+            st.warning(
+                f"{len(errors)}개 실패 — 다시 누르면 실패한 것만 이어서 받습니다."
+            )
+            st.dataframe(
+                [{"파일": k, "오류": v} for k, v in errors.items()],
+                use_container_width=True,
+            )
+        pending = job.pending(targets)
 
-def trim_korean_text_safely(text: str, max_utf8_bytes: int = 9000) -> str:
-    t = (text or "").strip()
-    if not t:
-        return t
-    if len(t.encode("utf-8")) <= max_utf8_bytes:
-        return t
-
-    b = t.encode("utf-8")[:max_utf8_bytes]
-    return b.decode("utf-8", errors="ignore").strip()
+    if len(pending) < len(targets):
+        try:
+            job.check_zip_size(targets)
+        except ExportTooLarge as e:
+            st.warning(str(e))
+            return
+        # ZIP은 버튼을 누를 때만 만들고 읽는다(재실행마다 서버 메모리에 올리지 않음)
+        st.download_button(
+            f"ZIP 내려받기 ({len(targets) - len(pending)}/{len(targets)})",
+            data=lambda: job.read_zip(targets),
+            file_name=os.path.basename(job.zip_path),
+            mime="application/zip",
+            key="export_download",
+        )
 
 
 # =========================================================
-# 9) 프롬프트
+# 13-1) 목차 1개 다시 생성 — 화면
 # =========================================================
 
 
-def build_stage1_prompt(student_name: str, notes: str) -> str:
-    notes_block = notes.strip() if notes.strip() else "(담임 메모 없음)"
-    return (
-        f"""
-당신은 경력 20년의 고등학교 진학지도교사입니다.
-입력은 한 학생의 ‘자기평가서(PDF) 내용’과 담임교사의 ‘중요 메모(추가 기재사항)’입니다.
-이 정보를 바탕으로 학생부종합전형(학종)에 맞는 최적의 진학 컨설팅 보고서를 작성하십시오.
-
-[담임 메모(보고서에는 직접 노출하지 않되, 내용에 반영)]
-{notes_block}
-
-
-[🔴 GAS 자동 서식 규칙 — 반드시 준수]
-0) 출력은 ‘순수 텍스트’만. JSON/코드블록/설명문/서론 금지.
-1) 제목(헤딩)은 오직 아래 3종의 형식만 허용.(아래 형식과 보고서 목차를 종합해 생성)
-   - 1. 제목
-   - 1-1. 제목
-   - 1-1-1. 제목
-2) 본문 내부에서는 절대 ‘1. 2. 3.’ 같은 숫자목록 금지.
-   - 각 문단은 문단 내용을 대표하는 키워드를 (말머리) 형태의 말머리로 시작
-3) 전공 추천/도서 추천/AI추천 항목은 번호 금지.
-   - 전공 추천 각 항목 앞: (🧑‍🎓🧬🔭AI추천) 굵은 빨간 글씨로 표시
-   - 도서 추천 각 항목 앞: (🔖AI추천) 굵은 빨간 글씨로 표시
-   - AI추천 각 항목 앞: (🤖AI추천)
-4) (헤딩 1. 단위) 끝날 때마다 다음 토큰을 ‘단독 한 줄’로 넣을 것:
-   [[HR]]
-   ※ 이 토큰은 문서에서 '페이지 나눔'으로 변환되며 최종 문서에는 남지 않는다.
-5) 문단과 문단 사이는 빈 줄 1개(줄바꿈 2번).
-6) 학생 이름은 "{student_name}". 호칭은 ‘학생’ 또는 학생 이름으로 통일.
-7) 존댓말. 과한 미화 금지. 구체적 실행 중심.
-8) 모든 말머리는 굵은 빨간 글씨
-""".strip()
-        + f"""
-
-
-[보고서 목차(반드시 포함)]
-1. 학생을 위한 한마디 (감성적 격려와 총평, 300자 이내)
-2. 컨설팅 종합 분석 요약
-3. 대학 전공 추천 (이유 포함)
-4. 1학년 활동 문제점 및 보완 전략
-5. 추천 도서 (고전 2권 + 전공 적합 도서 2~3권)
-6. 창체 영역별 상세 컨설팅
-  6-1. 자율활동
-  6-2. 진로활동
-  6-3. 동아리활동
-  6-4. 봉사활동
-7. 2학년 교과별 전략/수업 태도 개선 전략
-8. 인성 및 행동특성 종합 의견
-
-
-[추가 메모]
---------------------------------
-1. 학생을 위한 한마디
---------------------------------
-학생 이름을 1회 포함하여 표현
-전체 입력 내용을 종합한 총평을 학생을 격려, 따뜻하고 감성적인 말과 함께 제시. 
-최대한 감성적이고 문학적인 표현을 섞어 전해줘. 문학/시 작품 인용하여 표현하는 거 권장.
-단, 한글 400자 이상을 넘지 않도록 분량 조절(1200바이트)
-글자가 넘지 않으면서도 자연스럽게 분량에 맞춰 글을 완성
-
-
-
-
---------------------------------
-2. 컨설팅 종합 분석
---------------------------------
-2-1. 최상의 대입 준비를 위한 학생의 학교생활기록부(학생부) 스토리 전략을 제시할 것.
-     - 이 학생의 핵심 키워드, 장점, 전공적합성, 성장 스토리를 3~5문장 정도로 요약.
-2-2. ‘1학년 활동 종합 → 2학년 활동 컨설팅 → 3학년 활동 컨설팅’ 흐름으로 정리할 것.
-     - 1학년에서 이미 형성된 방향성 요약
-     - 2학년에서 어떤 활동을 추가/심화해야 하는지 제안
-     - 3학년에서 마무리·정리해야 할 포인트 제안
-2-3. 3년 동안의 활동이 최종 진학/진로 희망을 달성할 수 있도록,
-     하나의 스토리로 유기적으로 연결된 학생부 스토리를 제안할 것.
-2-4. PDF 자기평가서에 정보가 부족한 부분이나 비어 있는 영역이 있다면
-     (🤖AI추천) 말머리를 달고, 구체적인 활동/내용을 제안할 것.
-
-
-
-
-
-
---------------------------------
-3. 대학 전공 추천
---------------------------------
-3-1. 창의적 체험활동(창체)와 전체 내용을 분석하여,
-     학생에게 맞는 최상의 대학 전공을 1, 2, 3순위까지 추천하고,
-     각 전공을 추천하는 이유를 구체적으로 설명할 것.
-3-2. 학생이 자기평가서에 희망 진로를 직접 작성한 경우,
-     - 그 진로와 니가 추천한 전공과 어떻게 일치하거나 다른지 비교·분석할 것.
-
-
-
-
-
-
---------------------------------
-4. 1학년 활동 문제점 및 보완 전략
---------------------------------
-4-1. 1학년 활동 중에서 학종 관점에서 보았을 때의 문제점·아쉬운 점을 지적할 것.
-4-2. 보완이 필요한 영역(예: 전공연계성, 독서, 봉사, 심화탐구 등)을 제시하고,
-     각 영역별로 구체적인 대안을 제안할 것.
-4-4. 니가 제시하는 대안은 반드시 (🤖AI추천) 말머리를 달아줄 것.
-
-
-
-
-
-
---------------------------------
-5. 추천 도서
---------------------------------
-5-1. 1학년 때 보완해야할 추천 고전도서: 학생의 종합적 특성을 고려했을 때,
-     꼭 읽어보기를 권하고 싶은 ‘고전 교양도서’ 2권을 추천 이유와 함께 제시할 것.
-5-2. 추천 전공도서: 전공과 관련된 고1 수준의 교양 서적 2-3권 추천
-     + 활동 내용과 직접적으로 연관된 교양 책,
-     + 활동 내용과 직접적으로 연관된 참고 서적을 제시하고,
-     각각에 대해 추천 사유를 함께 쓸 것.
-5-3. 2학년 때 읽어야할 추천도서: 1학년 활동과 자연스럽게 연계되면서,
-     1학년보다 한 단계 높은 수준의 전공 서적 또는 교양 서적을 추천할 것.
-     - 2~4권 정도, 각 도서마다 활동·전공과의 연결 이유를 짧게 서술.
-
-
-
-
-
-
---------------------------------
-6-1. 창의적 체험활동#1 자율활동
---------------------------------
-총 3-4개의 활동을 정리할 것.
-자기평가서에 이미 나온 내용을 우선하여, 중요한 것부터 우선순위를 정해 컨설팅할 것.
-각 활동은 아래 구조로 서술할 것.
-     - 지적 호기심 발동: 어떤 문제의식·궁금증에서 출발했는지
-     - 탐구 활동: 무엇을, 어떻게, 얼마나, 누구와 탐구했는지
-     - 후속 활동/배운 점/성장: 그 결과 어떤 변화, 성장, 후속 활동이 있었는지
-활동 하나당 관련 추천 도서 1~2권을 제시하고, 해당 활동과 어떻게 연결되는지 추천 이유를 함께 제시할 것.
-자기평가서에 자율활동 관련 내용이 부족하거나 없다면, (🤖AI추천) 말머리를 달고 대체·보완 가능한 활동을 제안할 것.
-자율활동 내용은 진로활동, 동아리활동, 봉사활동, 교과 세특과 서로 유기적으로 연결되도록 설계할 것.
-
-
-
-
-
-
---------------------------------
-6-2. 창의적 체험활동#2 진로활동
---------------------------------
-진로활동도 자율활동과 동일한 활동 갯수, 동일한 서술방식(지적 호기심 발동-탐구 활동-후속 활동 구조), 추천도서로 컨설팅할 것.
-자율/진로/동아리/봉사/교과세특이 한 줄기 스토리로 이어지도록, 진로활동의 역할과 위치를 분명하게 제시할 것.
-
-
-
-
-
-
---------------------------------
-6-3. 창의적 체험활동#3 동아리활동
---------------------------------
-동아리 활동도 자율활동, 진로활동 동일한 방식으로 컨설팅할 것. 추천도서도 제안
-동아리 활동이 전체 창체 활동과 교과 세특, 그리고 희망 전공과 어떻게 연결되는지를 명확하게 설명할 것.
-자기평가서에 진로활동 관련 내용이 부족하거나 없다면, (🤖AI추천) 말머리를 달고 대체·보완 가능한 활동을 제안할 것.
-
-
---------------------------------
-6-4. 창의적 체험활동#4 봉사활동
---------------------------------
-자기평가서에 봉사활동 내용이 없거나 매우 부족하면, (🤖AI추천) 말머리를 달고, 전공 및 인성과 연결 가능한 봉사활동을 제안할 것.
-봉사활동 내용이 있다면, 다른 활동(자율/진로/동아리/교과) 및 진로 목표와 연결하여 의미를 재구성할 것.
-봉사활동 역시 전체 창체·교과 세특과 하나의 스토리로 이어지도록 설계할 것.
-
-
-
-
---------------------------------
-7. 2학년 교과별 전략 / 수업 태도 개선 전략
---------------------------------
-자기평가서에 2학년 선택과목 내용이 없거나 매우 부족하면,(🤖AI추천) 말머리를 달고, 전공과 연결되는 고등학교 과목 제안, 이유설명
-입력된 고등학교 2학년 선택과목중 3개를 선택해 추천하는 활동 내용 제시
-2학년 교과 활동 추천할 때 관련된 추천 도서(고전+전공+교양)를 2-3권씩 같이 제시
-집중력있고, 끈기있는, 성실한 수업 태도 강조
-
-
-
-
---------------------------------
-8. 인성 및 행동특성 종합 의견
---------------------------------
-위 모든 자료를 종합하여, 안성분야에 대해 분석, 총평
-최소 2개에서 최대 4개의 문단으로 구성할 것.
-
-
-
-
-[마지막 주의사항]
-- 학생을 비현실적으로 미화하지 말고, 자기평가서 내용과 어긋나지 않는 선에서 구체적으로 보완·제안할 것.
-- 전체 문장은 매끄럽고 전문적인 어투의 존댓말로 작성할 것.
-
-
-""".strip()
+def render_section_regen() -> None:
+    st.subheader("✏️ 목차 1개 다시 생성")
+    st.caption(
+        "전체를 다시 만들지 않고, 기존 보고서 문서에서 고른 목차만 다시 써서 "
+        "그 자리만 바꿉니다(Gemini 1회)."
     )
+    default_url = ""
+    current = st.session_state.get("current_run_key")
+    if current:
+        result = get_shared_state().checkpoint_get(current).get("result") or {}
+        default_url = result.get("report_doc_url", "")
+    doc_ref = st.text_input(
+        "보고서 문서 URL(또는 ID)", value=default_url, key="regen_doc"
+    ).strip()
+    headings = {key: heading for key, heading, _ in REPORT_SECTIONS}
+    section_key = st.selectbox(
+        "다시 생성할 목차", list(headings), format_func=headings.get, key="regen_key"
+    )
+    request = st.text_area(
+        "요청 사항(선택)",
+        placeholder="예: 추천 도서를 희망 전공과 더 직접 관련된 책으로 바꿔 주세요.",
+        key="regen_request",
+    )
+    regen_pdf = st.file_uploader(
+        "학생부 PDF(선택 — 올리면 근거를 다시 읽어 더 정확합니다)",
+        type=["pdf"],
+        key="regen_pdf",
+    )
+    refresh_guide = st.checkbox(
+        "요약/담임 지도방침도 새로 만들기 (Gemini 2회 추가 + 새 지도방침 문서 + 시트 갱신)",
+        key="regen_guide",
+    )
+    if not st.button("이 목차만 다시 생성", key="regen_run", disabled=not doc_ref):
+        return
 
+    rate_limit("generate_report", limit=2, per_seconds=60)
+    progress_box = st.empty()
 
-def ensure_report_complete(report_md: str, student_name: str) -> str:
-    required_sections = [
-        "1. 학생을 위한 한마디",
-        "2. 컨설팅 종합 분석",
-        "3. 대학 전공 추천",
-        "4. 1학년 활동 문제점 및 보완 전략",
-        "5. 추천 도서",
-        "6-1. 창의적 체험활동#1 자율활동",
-        "6-2. 창의적 체험활동#2 진로활동",
-        "6-3. 창의적 체험활동#3 동아리활동",
-        "6-4. 창의적 체험활동#4 봉사활동",
-        "7. 2학년 교과별 전략",
-        "8. 인성 및 행동특성 종합 의견",
-    ]
-
-    missing = [s for s in required_sections if s not in report_md]
-    if not missing:
-        return report_md
-
-    prompt = f"""
-아래 보고서는 중간에 끊겼습니다.
-누락된 항목만 이어서 작성하십시오.
-이미 작성된 내용은 반복하지 말고,
-다음 항목부터 계속 작성하세요.
-
-누락 항목:
-{", ".join(missing)}
-
-[기존 보고서]
-{report_md}
-"""
-
-    continuation = gemini_generate_text_with_retry(MODEL_REPORT, prompt, None)
-
-    return report_md.strip() + "\n\n" + continuation.strip()
-
-
-def build_stage2_prompt(report_md: str) -> str:
-    return f"""
-아래 컨설팅 보고서를 담임교사가 빠르게 파악할 수 있도록 요약하십시오.
-
-[요약 규칙]
-- 핵심만, 과장 없이
-- '강점 5개 / 보완점 5개 / 즉시 실행 5개'
-- 마지막에 "학생부 스토리 한 문장"
-- Markdown
-- 목록은 하이픈(-)만(숫자목록 금지)
-
-[원문]
-{report_md}
-""".strip()
-
-
-def build_stage3_homeroom_prompt(report_md: str, summary_md: str) -> str:
-    return f"""
-
-학생의 전체 컨설팅 결과를 토대로 담임교사가 학생을 지도할 때 기울여야할 지도 방침을 작성.
-컨설팅 보고서 요약 + 지도 조언 + 담임선생님을 향한 따뜻하고 공감어린 격려와 위로를 섞어 작성.
-무리한 미화 없이 학생부 흐름을 하나의 스토리로 연결.
-창체-교과-독서-인성이 서로 맞물리도록.
-가급적 9000바이트(한글 3000자 내외) 기준으로 '완결감 있게' 작성(문장 중간 절단 금지, 반드시 맺음말).
-
-
-
-
-[작성 방향]
-- 단순한 조언 나열이 아니라,
-  학생의 학생부 흐름(창체-교과-독서-인성)을 하나의 이야기로 엮어 서술할 것
-- 무리한 미화는 피하고, 실제 담임교사가 공감할 수 있는 현실적인 어조 유지
-- 학생의 강점은 어떻게 더 살릴지,
-  보완점은 어떤 방향으로 지도하면 좋을지 구체적으로 제시
-- 진학 전략뿐 아니라,
-  담임교사를 향한 따뜻하고 공감 어린 격려와 위로의 메시지를 자연스럽게 포함할 것
-
-
-
-
-[내용 구성 권장]
-1. 학생 전체 흐름에 대한 담임 관점의 종합 해석
-2. 교과·비교과·독서·인성이 맞물리는 지도 포인트
-3. 진로·진학 지도 시 특히 유의할 점
-4. 담임교사를 향한 공감과 응원의 말
-
-
-
-
-[주의]
-- 학생에게 직접 말하는 형식이 아니라,
-  ‘담임교사를 위한 내부 지도 문서’로 작성할 것
-- 훈계조, 평가조 문체는 지양할 것
-
-
-
-
-[요약]
-{summary_md}
-
-[원문]
-{report_md}
-
-[출력 규칙]
-- Markdown
-- 목록은 하이픈(-)만(숫자목록 금지)
-""".strip()
-
-
-# =========================================================
-# 10) GAS 호출
-# =========================================================
-
+    def _show_progress(stage: str, message: str) -> None:
+        progress_box.info(f"⏳ {message}")
 
-def call_gas_auto_format(doc_id: str) -> None:
     try:
-        params = {"docId": doc_id, "token": GAS_TOKEN}
-        r = requests.get(GAS_WEBAPP_URL, params=params, timeout=10)
-
-        if r.status_code != 200:
-            raise RuntimeError(f"HTTP {r.status_code}")
-
-        ct = r.headers.get("Content-Type", "")
-        if "application/json" not in ct:
-            raise RuntimeError(f"Non-JSON response: {ct}")
-
-        data = r.json()
-        if not data.get("ok", False):
-            raise RuntimeError("GAS ok=false")
-
-        st.info("ℹ️ (참고) 자동 서식 적용 시도 완료")
+        with st.spinner("다시 생성 중..."):
+            out = regenerate_report_section(
+                doc_ref,
+                section_key,
+                request,
+                regen_pdf.getvalue() if regen_pdf else None,
+                refresh_guide,
+                RunOptions(
+                    auto_gas_format=auto_gas_format,
+                    generation_preset=session_generation_preset(),
+                ),
+                on_progress=_show_progress,
+            )
+    except PipelineError as e:
+        progress_box.empty()
+        st.error(str(e))
+        return
+    progress_box.empty()
 
-    except Exception:
-        st.warning(
-            "⚠️ 자동 서식 적용은 건너뛰었습니다.\n"
-            "문서 상단 메뉴 ‘⚙ 보고서 서식 → ✅ 본문 서식 적용’을 눌러주세요."
-        )
+    st.success(
+        f"‘{out['heading']}’ 목차만 바꿨습니다. (Gemini {out['gemini_calls']}회)"
+    )
+    doc_link_button("📎 컨설팅 보고서 열기", out["report_doc_url"])
+    if out["guide_doc_url"]:
+        doc_link_button("📎 새 담임교사 지도방침 열기", out["guide_doc_url"])
+    c1, c2 = st.columns(2)
+    with c1:
+        st.markdown("**이전 본문**")
+        st.text(out["old_text"] or "(비어 있음)")
+    with c2:
+        st.markdown("**새 본문**")
+        st.text(out["new_text"])
 
 
 # =========================================================
-# 11) Sheets 기록 (A열부터 정확히)
+# 13) UI 입력
 # =========================================================
 
+if page == "학급 진행 현황":
+    render_progress_dashboard()
+    st.stop()
+if page == "PDF 내보내기":
+    render_pdf_export()
+    st.stop()
+if page == "목차 다시 생성":
+    render_section_regen()
+    st.stop()
 
-def make_hyperlink_formula(url: str, label: str) -> str:
-    u = (url or "").strip()
-    if not u:
-        return ""
-    u = u.replace('"', '""')
-    label = (label or "").replace('"', '""')
-    return f'=HYPERLINK("{u}","{label}")'
-
-
-def write_row_to_sheet_from_A6(sheets_service, values_a_to_g: list) -> None:
-    """
-    A6부터 아래로 내려가며 '가장 위의 빈 행'을 찾아
-    A~G에 values_a_to_g(7개)를 쓰고, H에는 생성 시간을 기록한다.
-
-    values_a_to_g = [grade, klass, number, student_num5, name, report_link, guide_link]
-    """
-    if not SHEETS_ID.strip():
-        return
-
-    read_range = f"{SHEETS_TAB}!A6:H1005"
-    resp = execute_with_retry(
-        lambda: sheets_service.spreadsheets()
-        .values()
-        .get(spreadsheetId=SHEETS_ID, range=read_range, majorDimension="ROWS")
-        .execute(),
-        label="Sheets Read",
+GAS_JOB_STATUS_LABELS = {
+    "queued": "⏳ 대기",
+    "running": "🔄 적용 중",
+    "done": "✅ 완료",
+    "failed": "⚠️ 실패",
+}
+
+if auto_gas_format:
+    with st.sidebar.expander("자동 서식 작업 상태", expanded=False):
+        gas_jobs = get_gas_format_queue().recent()
+        if not gas_jobs:
+            st.caption("아직 요청된 작업이 없습니다.")
+        for job in gas_jobs:
+            st.markdown(
+                f"{GAS_JOB_STATUS_LABELS.get(job['status'], job['status'])} · "
+                f"{job.get('title') or job['doc_id']}"
+            )
+            if job.get("error"):
+                st.caption(job["error"])
+        st.button("상태 새로고침", key="gas_jobs_refresh")
+
+BREAKER_STATE_LABELS = {
+    "closed": "🟢 정상",
+    "half_open": "🟡 확인 중",
+    "open": "🔴 일시 중단",
+}
+
+breaker_rows = circuit_breaker_snapshots()
+tripped = [r for r in breaker_rows if r["상태"] != "closed"]
+if tripped:
+    st.warning(
+        "외부 서비스 장애 감지: "
+        + ", ".join(f"{r['서비스']} {BREAKER_STATE_LABELS[r['상태']]}" for r in tripped)
+        + " — 회복될 때까지 해당 단계는 재시도 없이 바로 실패합니다."
     )
-    rows = resp.get("values", [])
-
-    target_offset = None
-    for i, r in enumerate(rows):
-        a = (r[0] if len(r) > 0 else "").strip()
-        if a == "":
-            target_offset = i
-            break
-
-    if target_offset is None:
-        target_offset = len(rows)
-
-    target_row = 6 + target_offset
-    created_at = time.strftime("%Y-%m-%d %H:%M:%S")
-
-    write_values = values_a_to_g[:7] + [created_at]  # A~H (8칸)
-
-    update_range = f"{SHEETS_TAB}!A{target_row}:H{target_row}"
-    body = {"values": [write_values]}
-
-    execute_with_retry(
-        lambda: sheets_service.spreadsheets()
-        .values()
-        .update(
-            spreadsheetId=SHEETS_ID,
-            range=update_range,
-            valueInputOption="USER_ENTERED",
-            body=body,
-        )
-        .execute(),
-        label="Sheets Write",
+if breaker_rows:
+    with st.sidebar.expander("외부 서비스 상태", expanded=bool(tripped)):
+        for r in breaker_rows:
+            line = f"{BREAKER_STATE_LABELS[r['상태']]} · {r['서비스']}"
+            if r["상태"] == "open":
+                line += f" (약 {r['재개까지(초)']}초 후 재시도)"
+            st.markdown(line)
+        if is_admin:
+            st.dataframe(breaker_rows, use_container_width=True)
+        st.button("상태 새로고침", key="breakers_refresh")
+
+# ---- 사전 점검(설정 확인): 결과가 캐시되므로 재실행마다 다시 조회하지 않음 ----
+
+
+def _force_preflight() -> None:
+    st.session_state["preflight_force"] = True
+
+
+health = run_preflight(force=st.session_state.pop("preflight_force", False))
+blockers = preflight_blockers(health, auto_gas_format)
+if blockers:
+    st.error(
+        "설정 점검 실패 — 지금 생성하면 바로 중단됩니다: "
+        + ", ".join(f"{r['name']}({r['detail']})" for r in blockers)
+    )
+with st.sidebar.expander("사전 점검(설정 확인)", expanded=bool(blockers)):
+    for r in health["rows"]:
+        icon = "🟢" if r["ok"] else ("🔴" if r in blockers else "🟡")
+        st.markdown(f"{icon} · {r['name']} — {r['detail']}")
+    _checked = time.strftime("%H:%M:%S", time.localtime(health["checked_at"]))
+    st.caption(
+        f"마지막 점검 {_checked}" + (" (저장된 결과)" if health["cached"] else "")
     )
+    if is_admin:
+        st.dataframe(health["rows"], use_container_width=True)
+    st.button("다시 점검", key="preflight_refresh", on_click=_force_preflight)
 
+# ---- Google API 전송(관리자): keep-alive 연결 재사용률/지연 ----
+if is_admin:
+    with st.sidebar.expander("Google API 연결(관리자)", expanded=False):
+        try:
+            _http = google_http_stats()
+        except RuntimeError as e:
+            st.caption(str(e))
+        else:
+            _ratio = _http["reuse_ratio"]
+            st.caption(
+                f"요청 {_http['http_requests']}회 · 새 연결 {_http['connections']}개 · "
+                f"재사용 {'-' if _ratio is None else f'{_ratio:.0%}'} · "
+                f"평균 {_http['avg_ms'] or 0:.0f}ms"
+            )
+            st.dataframe([_http], use_container_width=True)
 
-def parse_student_num5(num5: str):
-    if not re.fullmatch(r"\d{5}", num5 or ""):
-        return "", "", ""
-    grade = num5[0]
-    klass = str(int(num5[1:3]))
-    number = str(int(num5[3:5]))
-    return grade, klass, number
+# ---- 완료된 실행 보관: 재실행(rerun)돼도 결과가 사라지지 않게 ----
+RECENT_RUNS_LIMIT = 10
+RECENT_RUNS_TTL = 7 * 24 * 3600
 
 
-# =========================================================
-# 12) 제목/학번
-# =========================================================
+def _recent_runs_key() -> str:
+    return f"recent-runs:{current_session_key()}"
 
 
-def normalize_student_num(raw: str) -> str:
-    s = re.sub(r"\D", "", (raw or "").strip())
-    return s[:5] if len(s) >= 5 else ""
+def recent_runs(state: SharedStateBackend) -> list:
+    return state.cache_get(_recent_runs_key()) or []
 
 
-def make_doc_titles(student_num5: str, student_name: str) -> Tuple[str, str]:
-    base = f"{student_num5}_{student_name}"
-    return base, f"{base}_담임교사지도방침"
+def remember_run(state: SharedStateBackend, run_key: str, title: str) -> None:
+    """완료된 실행을 세션의 최근 목록에 올리고 현재 표시 대상으로 지정."""
+    runs = [r for r in recent_runs(state) if r["run_key"] != run_key]
+    runs.insert(0, {"run_key": run_key, "title": title, "finished_at": time.time()})
+    state.cache_set(_recent_runs_key(), runs[:RECENT_RUNS_LIMIT], ttl=RECENT_RUNS_TTL)
+    st.session_state["current_run_key"] = run_key
 
 
-# =========================================================
-# 13) UI 입력
-# =========================================================
+def _open_run(run_key: str) -> None:
+    st.session_state["current_run_key"] = run_key
+
+
+with st.sidebar.expander("최근 실행", expanded=False):
+    _runs = recent_runs(get_shared_state())
+    if not _runs:
+        st.caption("이 세션에서 완료된 실행이 없습니다.")
+    for _r in _runs:
+        _when = time.strftime("%m-%d %H:%M", time.localtime(_r["finished_at"]))
+        st.button(
+            f"{_r['title']} · {_when}",
+            key=f"open_run_{_r['run_key']}",
+            on_click=_open_run,
+            args=(_r["run_key"],),
+            use_container_width=True,
+        )
 
 col1, col2 = st.columns(2)
 with col1:
@@ -1039,14 +761,135 @@ notes = st.text_area(
 )
 
 run = st.button("🚀 학생부 컨설팅 시작")
-if run:
-    rate_limit("generate_report", limit=2, per_seconds=60)
+force_regen = st.checkbox(
+    "같은 입력이어도 새로 생성(재생성)",
+    value=False,
+    help="체크하지 않으면 같은 학생·같은 PDF·같은 메모로 이미 만든 문서를 그대로 보여줍니다.",
+)
+
+if is_admin:
+    st.sidebar.selectbox(
+        "생성 프리셋",
+        list(GENERATION_PRESETS),
+        index=list(GENERATION_PRESETS).index(session_generation_preset()),
+        key="generation_preset",
+        help="단계별 thinking 예산/출력 상한/temperature 묶음. 이 세션의 실행에만 적용.",
+    )
+    with st.expander("🧪 생성 프리셋 벤치마크(관리자)"):
+        st.dataframe(
+            [
+                dict(p.describe(), 단계=stage)
+                for preset in GENERATION_PRESETS.values()
+                for stage, p in preset.items()
+            ],
+            use_container_width=True,
+        )
+        bench_presets = st.multiselect(
+            "비교할 프리셋", list(GENERATION_PRESETS), default=list(GENERATION_PRESETS)
+        )
+        if st.button("벤치마크 실행(위에 올린 PDF 사용)", key="bench_run"):
+            if not uploaded_pdf or not student_name.strip():
+                st.error("PDF와 학생 이름을 먼저 입력하세요.")
+            else:
+                table = st.empty()
+                bench_rows = []
+
+                def _show_row(row: dict) -> None:
+                    bench_rows.append(row)
+                    table.dataframe(bench_rows, use_container_width=True)
+
+                try:
+                    with st.spinner("프리셋별 생성 중..."):
+                        benchmark_generation_presets(
+                            uploaded_pdf.getvalue(),
+                            student_name.strip(),
+                            notes,
+                            bench_presets,
+                            on_row=_show_row,
+                        )
+                except Exception as e:
+                    st.error(f"벤치마크 실패: {e}")
+                best = fastest_complete_preset(bench_rows)
+                if best:
+                    st.success(f"목차를 모두 채운 프리셋 중 가장 빠름: {best}")
+                elif bench_rows:
+                    st.warning("목차를 모두 채운 프리셋이 없습니다.")
 
 
 # =========================================================
 # 14) 실행
 # =========================================================
 
+
+def render_partial_progress(
+    checkpoint: dict, deadline: RunDeadline, versions: dict
+) -> None:
+    """실패/시간 초과 시 어디까지 끝났는지(완료 단계는 저장돼 다음 실행에서 건너뜀)."""
+    limit = deadline.expires_at - deadline.started_at
+
+    def done(key: str) -> bool:
+        # 프롬프트/프리셋이 바뀐 단계 결과는 다음 실행에서 다시 만들므로 미완료
+        if key in versions:
+            return stage_checkpoint(checkpoint, key, versions) is not None
+        return key in checkpoint
+
+    st.markdown("#### 진행 상황")
+    st.dataframe(
+        [
+            {
+                "단계": label,
+                "상태": "✅ 완료(저장됨)" if done(key) else "⏹ 미완료",
+            }
+            for key, label in RUN_STAGE_LABELS
+        ],
+        use_container_width=True,
+    )
+    st.caption(
+        f"경과 {deadline.elapsed():.0f}초 / 제한 {limit:.0f}초 — "
+        "같은 입력으로 다시 실행하면 완료된 단계는 건너뜁니다."
+    )
+
+
+def render_run_result(checkpoint: dict) -> None:
+    result = checkpoint["result"]
+    doc_link_button("📎 컨설팅 보고서 열기", result["report_doc_url"])
+    doc_link_button("📎 담임교사 지도방침 열기", result["guide_doc_url"])
+    if any(
+        map(gas_format_pending, (result["report_doc_url"], result["guide_doc_url"]))
+    ):
+        st.caption(
+            "서식 적용이 끝나기 전에는 [[HR]] 같은 표시가 잠시 보일 수 있습니다"
+            " — 사이드바 ‘자동 서식 작업 상태’에서 확인하세요."
+        )
+
+    docs_stats = result.get("docs_stats") or []
+    if docs_stats:
+        st.caption(
+            " · ".join(
+                f"문서 {i+1}: get {d['gets']}회 / batchUpdate {d['batch_updates']}회"
+                f" / 요청 {d['requests']}건"
+                for i, d in enumerate(docs_stats)
+            )
+        )
+
+    length_stats = checkpoint.get("length_control")
+    if length_stats:
+        st.caption(
+            f"3단계 분량 제어: 상한 {length_stats['max_output_tokens']}토큰 · "
+            f"출력 {length_stats['output_tokens']}토큰 · "
+            f"잘림 {length_stats['trimmed_bytes']}바이트 · "
+            f"절감 추정 {length_stats['saved_tokens_est']}토큰"
+            f"/{length_stats['saved_seconds_est']}초"
+        )
+
+    with st.expander("✅ 1단계 보고서(원문)"):
+        st.markdown(clean_generated_text(checkpoint.get("report", "")))
+    with st.expander("✅ 2단계 요약"):
+        st.markdown(clean_generated_text(checkpoint.get("summary", "")))
+    with st.expander("✅ 3단계 담임 지도방침"):
+        st.markdown(clean_generated_text(checkpoint.get("homeroom", "")))
+
+
 if run:
     student_num5 = normalize_student_num(student_num)
     if not student_num5:
@@ -1062,145 +905,88 @@ if run:
         st.stop()
 
     pdf_bytes = uploaded_pdf.read()
-    grade, klass, number = parse_student_num5(student_num5)
 
-    with st.spinner("Google 서비스 연결 중..."):
-        try:
-            drive_service, docs_service, sheets_service = get_google_services()
-        except Exception as e:
-            st.error(f"Google OAuth/서비스 연결 실패: {e}")
-            st.stop()
+    # 멱등 키: 학번+이름+PDF 해시+메모 해시 → 같은 제출은 같은 실행으로 묶음
+    state = get_shared_state()
+    run_key = make_run_key(student_num5, student_name.strip(), pdf_bytes, notes)
+    run_title = f"{student_num5} {student_name.strip()}"
 
-    with st.spinner("1단계: 컨설팅 보고서 생성 중..."):
-        try:
-            p1 = build_stage1_prompt(student_name.strip(), notes)
-            report_md = gemini_generate_text_with_retry(MODEL_REPORT, p1, pdf_bytes)
-            report_md = ensure_report_complete(report_md, student_name.strip())
-            report_md = sanitize_numbered_lists(report_md)
+    checkpoint = state.checkpoint_get(run_key)
+    if "result" in checkpoint and not force_regen:
+        st.info(
+            "ℹ️ 같은 입력으로 이미 만든 문서입니다(추가 비용 없음). "
+            "새로 만들려면 ‘같은 입력이어도 새로 생성’을 체크하세요."
+        )
+        remember_run(state, run_key, run_title)
+        render_run_result(checkpoint)
+        st.stop()
 
-        except Exception as e:
-            st.error(f"1단계 실패: {e}")
-            st.stop()
+    rate_limit("generate_report", limit=2, per_seconds=60)
+    if GLOBAL_RUN_LIMIT_PER_MIN > 0:
+        rate_limit(
+            "generate_report_all",
+            limit=GLOBAL_RUN_LIMIT_PER_MIN,
+            per_seconds=60,
+            scope="global",
+        )
 
-    with st.spinner("2단계: 보고서 요약 생성 중..."):
-        try:
-            p2 = build_stage2_prompt(report_md)
-            summary_md = gemini_generate_text_with_retry(MODEL_SUMMARY, p2, None)
-            summary_md = sanitize_numbered_lists(summary_md)
-        except Exception as e:
-            st.error(f"2단계 실패: {e}")
-            st.stop()
-
-    with st.spinner("3단계: 담임교사용 지도방침 생성 중..."):
-        try:
-            p3 = build_stage3_homeroom_prompt(report_md, summary_md)
-            homeroom_md = gemini_generate_text_with_retry(MODEL_GUIDE, p3, None)
-            homeroom_md = trim_korean_text_safely(homeroom_md, max_utf8_bytes=9000)
-            homeroom_md = sanitize_numbered_lists(homeroom_md)
-        except Exception as e:
-            st.error(f"3단계 실패: {e}")
-            st.stop()
-
-    report_title, guide_title = make_doc_titles(student_num5, student_name.strip())
-
-    placeholders_report = {
-        "{{REPORT_CONTENT}}": "컨설팅 보고서(원문)",
-        "{{REPORT_SUMMARY}}": "컨설팅 보고서 요약",
-        "{{STUDENT_NAME}}": "학생 이름",
-        "{{STUDENT_NUM}}": "학번",
-    }
-
-    placeholders_guide = {
-        "{{HOMEROOM_GUIDANCE}}": "담임교사용 진학지도 조언",
-        "{{REPORT_SUMMARY}}": "학생 컨설팅 보고서 요약본",  # ✅ 추가
-        "{{STUDENT_NAME}}": "학생 이름",
-        "{{STUDENT_NUM}}": "학번",
-        "{{NOTES_BLOCK}}": "담임 추가 기재사항",
-    }
-
-    with st.spinner("Google Docs 생성/치환 + 자동 서식 적용 중..."):
-        try:
-            # 문서 1: 보고서
-            report_doc_id = copy_template(
-                drive_service,
-                TEMPLATE_REPORT_DOC_ID,
-                report_title,
-                DRIVE_FOLDER_ID_REPORT,
-            )
-            ensure_placeholders_exist(docs_service, report_doc_id, placeholders_report)
-            batch_replace_all_text(
-                docs_service,
-                report_doc_id,
-                {
-                    "{{STUDENT_NAME}}": student_name.strip(),
-                    "{{STUDENT_NUM}}": student_num5,
-                    "{{REPORT_CONTENT}}": report_md.strip(),
-                    "{{REPORT_SUMMARY}}": summary_md.strip(),
-                },
-            )
-            if auto_gas_format:
-                call_gas_auto_format(report_doc_id)
-            remove_debug_tokens_after_format(docs_service, report_doc_id)
-            report_doc_url = f"https://docs.google.com/document/d/{report_doc_id}/edit"
-
-            # 문서 2: 지도방침
-            guide_doc_id = copy_template(
-                drive_service, TEMPLATE_GUIDE_DOC_ID, guide_title, DRIVE_FOLDER_ID_GUIDE
-            )
-            ensure_placeholders_exist(docs_service, guide_doc_id, placeholders_guide)
-            batch_replace_all_text(
-                docs_service,
-                guide_doc_id,
-                {
-                    "{{STUDENT_NAME}}": student_name.strip(),
-                    "{{STUDENT_NUM}}": student_num5,
-                    "{{NOTES_BLOCK}}": notes.strip(),
-                    "{{REPORT_SUMMARY}}": summary_md.strip(),
-                    "{{HOMEROOM_GUIDANCE}}": homeroom_md.strip(),
-                },
-            )
-            if auto_gas_format:
-                call_gas_auto_format(guide_doc_id)
-            remove_debug_tokens_after_format(docs_service, guide_doc_id)
-            guide_doc_url = f"https://docs.google.com/document/d/{guide_doc_id}/edit"
-
-            # Sheets 기록: A:H 정확 매핑 + 하이퍼링크 문구 통일
-            report_link = make_hyperlink_formula(report_doc_url, "컨설팅 보고서")
-            guide_link = make_hyperlink_formula(guide_doc_url, "조언")
-
-            write_row_to_sheet_from_A6(
-                sheets_service,
-                [
-                    grade,  # A 학년
-                    klass,  # B 반
-                    number,  # C 번호
-                    student_num5,  # D 학번
-                    student_name.strip(),  # E 이름
-                    report_link,  # F 컨설팅보고서(링크)
-                    guide_link,  # G 담임선생님 조언(링크)
-                    # H 생성시간은 함수에서 자동
-                ],
-            )
+    profiler = SamplingProfiler().start() if profile_next_run else None
+    if profiler is not None:
+        st.session_state["profile_used"] = True
+    progress_box = st.empty()
 
-        except HttpError as e:
-            st.error(f"Google API 오류: {e}")
-            st.stop()
-        except Exception as e:
-            st.error(f"문서 생성 실패: {e}")
-            st.stop()
+    def _show_progress(stage: str, message: str) -> None:
+        progress_box.info(f"⏳ {message}")
 
-    st.success(
-        "완료! (보고서/지도방침) 2개 문서 생성 + (선택)자동 서식 + 시트 기록까지 처리했습니다."
-    )
-    st.link_button("📎 컨설팅 보고서 열기", report_doc_url)
-    st.link_button("📎 담임교사 지도방침 열기", guide_doc_url)
+    try:
+        with st.spinner("생성 중... (단계별 진행은 아래에 표시)"):
+            outcome = run_student_pipeline(
+                student_num5,
+                student_name,
+                pdf_bytes,
+                notes,
+                RunOptions(
+                    force_regen=force_regen,
+                    auto_gas_format=auto_gas_format,
+                    generation_preset=session_generation_preset(),
+                ),
+                on_progress=_show_progress,
+                state=state,
+            )
+    except PipelineError as e:
+        progress_box.empty()
+        st.error(str(e))
+        render_partial_progress(
+            state.checkpoint_get(run_key),
+            e.deadline,
+            prompt_versions(session_generation_preset()),
+        )
+        st.stop()
+    finally:
+        if profiler is not None:
+            profiler.stop()
+            render_profile(profiler)
+    progress_box.empty()
+
+    if outcome["attached"]:
+        st.info("ℹ️ 진행 중이던 같은 실행의 결과입니다.")
+    else:
+        st.success(
+            "완료! (보고서/지도방침) 2개 문서 생성 + 시트 기록까지 처리했습니다."
+        )
+        if auto_gas_format:
+            st.info(
+                "ℹ️ 자동 서식은 백그라운드에서 적용 중입니다. "
+                "진행 상태는 사이드바 ‘자동 서식 작업 상태’에서 확인하세요."
+            )
+    remember_run(state, run_key, run_title)
+    render_run_result(outcome["checkpoint"])
 
-    with st.expander("✅ 1단계 보고서(원문)"):
-        st.markdown(report_md)
-    with st.expander("✅ 2단계 요약"):
-        st.markdown(summary_md)
-    with st.expander("✅ 3단계 담임 지도방침"):
-        st.markdown(homeroom_md)
-    with st.expander("✅ 3단계 담임 지도방침"):
-        st.markdown(homeroom_md)
-        st.markdown(homeroom_md)
+else:
+    # 버튼을 누르지 않은 재실행(위젯 조작 등): 보관된 결과를 API 호출 없이 다시 표시
+    _current = st.session_state.get("current_run_key")
+    if _current:
+        _checkpoint = get_shared_state().checkpoint_get(_current)
+        if "result" in _checkpoint:
+            st.caption("최근 실행 결과(보관본) — 다시 생성하지 않습니다.")
+            render_run_result(_checkpoint)
@@ -0,0 +1,351 @@
+# h_cli.py
+# 명단 폴더 일괄 처리(야간 cron 등) — Streamlit 없이 h_pipeline을 바로 호출
+#
+# 사용 예)
+#   python h_cli.py ./roster --workers 3 --report run_report.json --gas
+#   python h_cli.py ./roster --batch --report run_report.json   # 학년 전체(야간)
+#
+# 명단 폴더 규칙
+#   <학번>_<이름>.pdf        학생부 PDF (예: 10201_홍길동.pdf)
+#   <학번>_<이름>.txt        (선택) 담임 추가 기재사항
+#
+# 같은 입력으로 이미 만든 문서는 다시 만들지 않는다(reused). 화면에서 같은 학생을
+# 생성 중이면 그 실행이 끝나길 기다렸다가 결과를 쓴다(reused). 실패한 학생이 있으면
+# 종료 코드 1 — 다시 실행하면 완료된 단계는 건너뛰고 이어서 처리한다.
+# 시작 전 사전 점검(템플릿/폴더/시트/secrets)에 실패하면 아무것도 하지 않고 종료 코드 2.
+# --batch: 1~3단계를 Gemini Batch API 작업으로 먼저 만들고(단계마다 작업 1개,
+# 완료까지 대기) 문서/시트만 학생별로 처리한다. 중간에 끊기면 다시 실행해서 이어감.
+# --local-batch: Gemini 대신 로컬 더미 응답(LocalBatchEndpoint)으로 배치 흐름만 점검.
+# 체크포인트는 임시 상태에 두고(실제 실행에 섞이지 않게) 문서/시트는 만들지 않는다(ready).
+# 시트 행은 모았다가 SHEETS_FLUSH_EVERY개마다/끝날 때 한 번에 기록한다. 끝내 기록하지
+# 못한 학생은 failed(result) — 다시 실행하면 문서는 그대로 두고 행만 다시 기록한다.
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Optional, Tuple
+
+from h_pipeline import (
+    GENERATION_PRESETS,
+    SHEETS_FLUSH_EVERY,
+    BatchRun,
+    LocalBatchEndpoint,
+    PipelineError,
+    RunOptions,
+    SheetsRowWriter,
+    SqliteStateBackend,
+    configure,
+    get_gas_format_queue,
+    get_google_services,
+    get_shared_state,
+    google_http_stats,
+    mark_sheet_rows_written,
+    normalize_student_num,
+    preflight_blockers,
+    run_preflight,
+    run_student_pipeline,
+)
+
+ROSTER_STEM_RE = re.compile(r"^(\d{5})[_\s-]+(.+)$")
+RUN_STATUSES = ("done", "reused", "ready", "failed")
+
+logger = logging.getLogger("h_cli")
+
+
+def load_settings(path: str) -> dict:
+    """secrets.toml(Streamlit과 같은 파일) 또는 JSON 설정 파일."""
+    if path.lower().endswith(".json"):
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    try:
+        import tomllib  # Python 3.11+
+
+        with open(path, "rb") as f:
+            return tomllib.load(f)
+    except ImportError:
+        import toml
+
+        with open(path, "r", encoding="utf-8") as f:
+            return toml.load(f)
+
+
+def scan_roster(roster_dir: str) -> Tuple[list, list]:
+    """반환: (학생 목록, 건너뛴 파일 이름) — 학생은 학번 순."""
+    students, skipped = [], []
+    for name in sorted(os.listdir(roster_dir)):
+        stem, ext = os.path.splitext(name)
+        if ext.lower() != ".pdf":
+            continue
+        m = ROSTER_STEM_RE.match(stem)
+        student_num5 = normalize_student_num(m.group(1)) if m else None
+        if not student_num5:
+            skipped.append(name)
+            continue
+        notes_path = os.path.join(roster_dir, stem + ".txt")
+        students.append(
+            {
+                "student_num": student_num5,
+                "student_name": m.group(2).strip(),
+                "pdf_path": os.path.join(roster_dir, name),
+                "notes_path": notes_path if os.path.exists(notes_path) else None,
+            }
+        )
+    students.sort(key=lambda s: s["student_num"])
+    return students, skipped
+
+
+def read_student_inputs(student: dict) -> Tuple[bytes, str]:
+    """반환: (PDF, 담임 메모). 읽기 실패는 OSError."""
+    with open(student["pdf_path"], "rb") as f:
+        pdf_bytes = f.read()
+    notes = ""
+    if student["notes_path"]:
+        with open(student["notes_path"], "r", encoding="utf-8") as f:
+            notes = f.read()
+    return pdf_bytes, notes
+
+
+def _student_row(student: dict) -> dict:
+    return {
+        "student_num": student["student_num"],
+        "student_name": student["student_name"],
+        "pdf": os.path.basename(student["pdf_path"]),
+    }
+
+
+def run_batch_generation(
+    students: list, options: RunOptions, endpoint=None, state=None
+) -> Dict[str, dict]:
+    """1~3단계를 Batch API로 먼저 생성. 반환: {학번: 실패한 학생의 보고서 줄}"""
+    loaded, failed = [], {}
+    for s in students:
+        try:
+            pdf_bytes, notes = read_student_inputs(s)
+        except OSError as e:
+            failed[s["student_num"]] = dict(
+                _student_row(s),
+                status="failed",
+                stage="input",
+                error=f"파일을 읽을 수 없습니다: {e}",
+            )
+            continue
+        loaded.append(dict(s, pdf_bytes=pdf_bytes, notes=notes))
+
+    def _progress(stage: str, message: str) -> None:
+        logger.info("batch %s: %s", stage, message)
+
+    outcome = BatchRun(
+        loaded, endpoint, options=options, state=state, on_progress=_progress
+    ).run()
+    for s in loaded:
+        out = outcome[s["student_num"]]
+        if out["status"] == "failed":
+            failed[s["student_num"]] = dict(
+                _student_row(s),
+                status="failed",
+                run_key=out["run_key"],
+                stage=out["stage"],
+                error=out["error"],
+            )
+    return failed
+
+
+def process_student(student: dict, options: RunOptions) -> dict:
+    """학생 1명 처리 → 보고서 JSON의 한 줄."""
+    started = time.time()
+    row = _student_row(student)
+    try:
+        pdf_bytes, notes = read_student_inputs(student)
+
+        def _progress(stage: str, message: str) -> None:
+            logger.info("%s %s: %s", row["student_num"], stage, message)
+
+        out = run_student_pipeline(
+            student["student_num"],
+            student["student_name"],
+            pdf_bytes,
+            notes,
+            options,
+            on_progress=_progress,
+        )
+        result = out["checkpoint"].get("result", {})
+        if out["reused"] and result.get("sheet_pending") and options.sheets_writer:
+            # 지난 실행에서 모아 두고 기록하지 못한 행
+            options.sheets_writer.add(result["sheet_row"])
+        row.update(
+            status="reused" if out["reused"] else "done",
+            run_key=out["run_key"],
+            report_doc_url=result.get("report_doc_url"),
+            guide_doc_url=result.get("guide_doc_url"),
+        )
+    except PipelineError as e:
+        row.update(status="failed", stage=e.stage, error=str(e))
+    except OSError as e:
+        row.update(
+            status="failed", stage="input", error=f"파일을 읽을 수 없습니다: {e}"
+        )
+    row["elapsed_s"] = round(time.time() - started, 1)
+    logger.info("%s %s (%.1fs)", row["student_num"], row["status"], row["elapsed_s"])
+    return row
+
+
+def flush_sheet_rows(writer: SheetsRowWriter, rows: list) -> str:
+    """모아 둔 시트 행 기록. 실패하면 행은 writer에 남기고(다음에 다시) 오류를 반환."""
+    try:
+        written = writer.flush(get_google_services()[2])
+    except Exception as e:
+        logger.warning("시트 기록 실패(다음에 다시 시도): %s", e)
+        return str(e)
+    mark_sheet_rows_written(
+        get_shared_state(),
+        [
+            r["run_key"]
+            for r in rows
+            if r["student_num"] in written and r.get("run_key")
+        ],
+    )
+    return ""
+
+
+def run_local_batch(students: list, options: RunOptions, path: Optional[str]) -> int:
+    """--local-batch: 더미 응답으로 1~3단계 배치 흐름만 점검. 실패가 있으면 1."""
+    started = time.time()
+    with tempfile.TemporaryDirectory() as tmp:
+        state = SqliteStateBackend(os.path.join(tmp, "state.sqlite3"))
+        failed = run_batch_generation(students, options, LocalBatchEndpoint(), state)
+    rows = [failed.get(s["student_num"]) or _student_row(s) for s in students]
+    for row in rows:
+        row.setdefault("status", "ready")
+    counts = {s: sum(r["status"] == s for r in rows) for s in RUN_STATUSES}
+    report = {
+        "elapsed_s": round(time.time() - started, 1),
+        "summary": dict(counts, total=len(rows)),
+        "batch": "local",
+        "students": rows,
+    }
+    write_report(path, report)
+    logger.info("로컬 배치 점검: %s", json.dumps(report["summary"], ensure_ascii=False))
+    return 1 if counts["failed"] else 0
+
+
+def write_report(path: Optional[str], report: dict) -> None:
+    if path:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="학생부 컨설팅 문서 일괄 생성")
+    parser.add_argument("roster_dir", help="<학번>_<이름>.pdf 파일이 있는 폴더")
+    parser.add_argument(
+        "--secrets",
+        default=os.path.join(".streamlit", "secrets.toml"),
+        help="설정 파일(secrets.toml 또는 .json)",
+    )
+    parser.add_argument("--workers", type=int, default=2, help="동시 처리 학생 수")
+    parser.add_argument("--report", help="실행 결과 JSON 저장 경로")
+    parser.add_argument(
+        "--preset", choices=list(GENERATION_PRESETS), help="생성 프리셋"
+    )
+    parser.add_argument(
+        "--force", action="store_true", help="같은 입력이어도 새로 생성"
+    )
+    parser.add_argument(
+        "--gas", action="store_true", help="GAS 자동 서식 적용(끝날 때까지 대기)"
+    )
+    parser.add_argument("--deadline", type=float, help="학생 1명당 제한 시간(초)")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="1~3단계를 Gemini Batch API로(할인 요금, 완료까지 최대 24시간 대기)",
+    )
+    parser.add_argument(
+        "--local-batch",
+        action="store_true",
+        help="Gemini 없이 배치 흐름만 점검(더미 응답, 문서/시트는 만들지 않음)",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    configure(load_settings(args.secrets))
+
+    students, skipped = scan_roster(args.roster_dir)
+    for name in skipped:
+        logger.warning("파일 이름 규칙(<학번>_<이름>.pdf)에 맞지 않아 건너뜀: %s", name)
+    options = RunOptions(
+        force_regen=args.force,
+        auto_gas_format=args.gas,
+        generation_preset=args.preset,
+        deadline_seconds=args.deadline,
+    )
+    if args.local_batch:
+        return run_local_batch(students, options, args.report)
+
+    health = run_preflight(force=True)
+    blockers = preflight_blockers(health, args.gas)
+    for r in blockers:
+        logger.error("사전 점검 실패 — %s: %s", r["name"], r["detail"])
+    if blockers:
+        write_report(args.report, {"preflight": health, "students": []})
+        return 2
+
+    started = time.time()
+    rows = []
+    options.sheets_writer = SheetsRowWriter(get_shared_state())
+    if args.batch:
+        batch_failed = run_batch_generation(students, options)
+        rows.extend(batch_failed.values())
+        students = [s for s in students if s["student_num"] not in batch_failed]
+        # 생성은 끝났으니 문서/시트만 — 방금 만든 체크포인트를 지우지 않게
+        options.force_regen = False
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = [pool.submit(process_student, s, options) for s in students]
+        for future in as_completed(futures):
+            rows.append(future.result())
+            if options.sheets_writer.pending() >= SHEETS_FLUSH_EVERY:
+                flush_sheet_rows(options.sheets_writer, rows)
+    sheet_error = flush_sheet_rows(options.sheets_writer, rows)
+    if sheet_error:
+        unwritten = options.sheets_writer.pending_students()
+        for row in rows:
+            if row["student_num"] in unwritten:
+                row.update(
+                    status="failed",
+                    stage="result",
+                    error=f"시트 기록 실패: {sheet_error}",
+                )
+    rows.sort(key=lambda r: r["student_num"])
+
+    gas_idle = True
+    if args.gas:
+        logger.info("자동 서식 작업이 끝나기를 기다리는 중...")
+        gas_idle = get_gas_format_queue().wait_idle()
+
+    counts = {s: sum(r["status"] == s for r in rows) for s in RUN_STATUSES}
+    report = {
+        "roster_dir": os.path.abspath(args.roster_dir),
+        "started_at": started,
+        "elapsed_s": round(time.time() - started, 1),
+        "summary": dict(counts, total=len(rows), skipped_files=skipped),
+        "batch": args.batch,
+        "gas_format_idle": gas_idle,
+        "preflight": health,
+        "google_http": google_http_stats(),
+        "students": rows,
+    }
+    write_report(args.report, report)
+    logger.info("완료: %s", json.dumps(report["summary"], ensure_ascii=False))
+    logger.info("Google API 연결: %s", json.dumps(report["google_http"]))
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,5340 @@
+# h_pipeline.py
+# 학생부 컨설팅 생성 파이프라인(화면 없이 동작하는 핵심 로직)
+#   Gemini 3단계 생성 → Google Docs 템플릿 복사/치환 → Sheets 기록
+# H_App.py(Streamlit 화면)와 h_cli.py(야간 일괄 실행)가 함께 쓴다.
+# Streamlit을 import하지 않는다. 설정은 configure()로, 진행 알림은 콜백으로 받는다.
+
+import contextvars
+import csv
+import functools
+import hashlib
+import io
+import json
+import logging
+import math
+import os
+import random
+import re
+import socket
+import sqlite3
+import string
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Callable, Dict, Mapping, Optional, Tuple
+
+import requests
+from google import genai
+from google.auth.transport.requests import Request as AuthRequest
+from google.genai import types
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# =========================================================
+# 0) 설정 / 알림 / 프로세스 단일 객체
+# =========================================================
+# 비밀값과 운영 설정은 configure(매핑)으로 넣는다.
+#   Streamlit: configure(st.secrets) / CLI: secrets.toml(또는 JSON)을 읽어서
+# 아래 모듈 상수 중 _SETTING_TYPES에 있는 이름만 덮어쓴다(없으면 기본값 유지).
+
+SETTINGS: Dict[str, object] = {}
+
+
+def _as_bool(value) -> bool:
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
+
+
+_SETTING_TYPES = {
+    "GEMINI_API_KEY": str,
+    "GAS_WEBAPP_URL": str,
+    "GAS_TOKEN": str,
+    "SHARED_STATE_URL": str,
+    "RUN_DEADLINE_SECONDS": float,
+    "BREAKER_FAILURE_THRESHOLD": int,
+    "BREAKER_COOLDOWN": float,
+    "TEMPLATE_POOL_SIZE": int,
+    "DRIVE_CLASS_FOLDERS": _as_bool,
+    "GENERATION_PRESET": str,
+    "STRUCTURED_REPORT": _as_bool,
+    "EXPORT_MAX_WORKERS": int,
+}
+# secrets 이름과 모듈 상수 이름이 다른 경우
+_SETTING_NAMES = {"GENERATION_PRESET": "GENERATION_PRESET_DEFAULT"}
+
+
+def configure(settings: Mapping) -> None:
+    """
+    설정을 반영한다. 값이 바뀌었으면 프로세스 단일 객체(클라이언트/저장소 등)는
+    다음 사용 때 새로 만든다(같은 값으로 다시 부르면 아무 일도 없음).
+    """
+    settings = dict(settings)
+    if settings == SETTINGS:
+        return
+    SETTINGS.clear()
+    SETTINGS.update(settings)
+    module = globals()
+    for key, cast in _SETTING_TYPES.items():
+        if key in SETTINGS:
+            module[_SETTING_NAMES.get(key, key)] = cast(SETTINGS[key])
+    for factory in _SINGLETONS:
+        factory.reset()
+
+
+_SINGLETONS = []
+
+
+def process_singleton(factory):
+    """인자 없는 팩토리를 프로세스에 1개만 만들도록(스레드 안전)."""
+    lock = threading.Lock()
+    holder = {}
+
+    @functools.wraps(factory)
+    def wrapper():
+        with lock:
+            if "value" not in holder:
+                holder["value"] = factory()
+            return holder["value"]
+
+    wrapper.reset = holder.clear
+    _SINGLETONS.append(wrapper)
+    return wrapper
+
+
+logger = logging.getLogger("h_pipeline")
+
+
+def _log_notifier(level: str, message: str) -> None:
+    logger.log(logging.WARNING if level == "warning" else logging.INFO, message)
+
+
+_notifier: Callable[[str, str], None] = _log_notifier
+
+
+def set_notifier(fn: Optional[Callable[[str, str], None]]) -> None:
+    """재시도 등 진행 중 알림을 받을 함수(level, message). None이면 로그로."""
+    global _notifier
+    _notifier = fn or _log_notifier
+
+
+def notify(level: str, message: str) -> None:
+    _notifier(level, message)
+
+
+# 템플릿 문서 ID (보고서 / 지도방침 분리 권장)
+TEMPLATE_REPORT_DOC_ID = "1HPzXRHgK1k6sx3f0IlXa4E2WLiOz2bDtqnxsAhbbdjo"
+TEMPLATE_GUIDE_DOC_ID = "1183Mnqp676B7bn1y2aDdqhSGHeZX_HPx1DscgP_ZNTs"
+
+# 저장 폴더 ID (비우면 내 드라이브 루트)
+DRIVE_FOLDER_ID_REPORT = "1jb60S7fibE-Acz9f8vZZt-4r7-fTLwjp"
+DRIVE_FOLDER_ID_GUIDE = "1jb60S7fibE-Acz9f8vZZt-4r7-fTLwjp"
+
+# 스프레드시트 기록
+SHEETS_ID = "1cwJ4Lf_XE5sWDNATHBTzhoeNgFM5jBV-Tj4Qx7GyrL0"
+SHEETS_TAB = "컨설팅 보고서"
+
+# Gemini Key
+GEMINI_API_KEY = ""
+
+# GAS Web App (자동 서식 적용)
+GAS_WEBAPP_URL = ""
+GAS_TOKEN = ""
+
+
+AUTO_GAS_FORMAT_DEFAULT = False  # 기본은 안정적으로 OFF
+
+SCOPES = [
+    "https://www.googleapis.com/auth/drive",
+    "https://www.googleapis.com/auth/documents",
+    "https://www.googleapis.com/auth/spreadsheets",
+]
+
+MODEL_REPORT = "gemini-2.5-pro"
+MODEL_SUMMARY = "gemini-2.5-flash"
+MODEL_GUIDE = "gemini-2.5-pro"
+
+
+# =========================================================
+# 0-2) 공유 상태 저장소 (여러 프로세스/서버가 함께 쓰는 상태)
+# =========================================================
+# 레이트리밋 기록, 캐시, 실행 체크포인트, 잠금(행 배정 등)을 한곳에 둔다.
+# SHARED_STATE_URL
+#   ""                  → 임시 폴더의 SQLite 파일(같은 서버의 여러 프로세스 공유)
+#   "sqlite:///경로"     → 지정한 SQLite 파일(공유 디스크면 여러 서버도 가능)
+#   "redis://호스트:포트" → Redis(여러 서버, `pip install redis` 필요)
+
+SHARED_STATE_URL = ""
+CHECKPOINT_TTL = 7 * 24 * 3600  # 실행 체크포인트 보관 기간(초)
+KV_PURGE_INTERVAL = 10 * 60  # SQLite 만료 키 정리 주기(초)
+
+
+class SharedStateBackend:
+    """
+    공유 상태 저장소 인터페이스. 다른 저장소(네트워크 KV 등)는 이 메서드만 구현하면 된다.
+    값은 JSON으로 직렬화 가능한 것만 저장한다.
+    """
+
+    def hit_rate_limit(self, key: str, limit: int, per_seconds: float) -> float:
+        """허용이면 기록하고 0, 초과면 기록 없이 남은 대기 시간(초)을 반환."""
+        raise NotImplementedError
+
+    def cache_get(self, key: str):
+        raise NotImplementedError
+
+    def cache_set(self, key: str, value, ttl: Optional[float] = None) -> None:
+        raise NotImplementedError
+
+    def cache_add(self, key: str, value, ttl: Optional[float] = None) -> bool:
+        """키가 없을 때만 저장(원자적). 저장했으면 True."""
+        raise NotImplementedError
+
+    def cache_delete(self, key: str) -> None:
+        raise NotImplementedError
+
+    def cache_delete_if(self, key: str, value) -> bool:
+        """값이 value일 때만 삭제(원자적). 삭제했으면 True."""
+        raise NotImplementedError
+
+    def cache_touch_if(self, key: str, value, ttl: float) -> bool:
+        """값이 value일 때만 만료를 지금+ttl로 연장(원자적). 연장했으면 True."""
+        raise NotImplementedError
+
+    def checkpoint_put(self, run_key: str, stage: str, value) -> None:
+        raise NotImplementedError
+
+    def checkpoint_get(self, run_key: str) -> dict:
+        """{stage: value}"""
+        raise NotImplementedError
+
+    def checkpoint_clear(self, run_key: str) -> None:
+        raise NotImplementedError
+
+    @contextmanager
+    def lock(
+        self, name: str, ttl: float = 30.0, timeout: float = 30.0, renew: bool = False
+    ):
+        """
+        프로세스 간 잠금. ttl이 지나면 자동 해제(잠금 보유 프로세스가 죽은 경우 대비).
+        기본 구현은 cache_add 기반 스핀 잠금. 해제는 내 토큰일 때만(원자적).
+        renew=True면 보유하는 동안 ttl/3마다 만료를 연장 — 재시도 대기로 작업이
+        ttl보다 길어질 수 있는 경우(외부 API 호출을 잠금 안에서 할 때).
+        """
+        key = f"lock:{name}"
+        token = uuid.uuid4().hex
+        deadline = time.time() + timeout
+        while not self.cache_add(key, token, ttl=ttl):
+            if time.time() >= deadline:
+                raise TimeoutError(f"잠금 대기 시간 초과: {name}")
+            time.sleep(0.05 + random.random() * 0.1)
+
+        stop = threading.Event()
+
+        def _renew() -> None:
+            while not stop.wait(ttl / 3):
+                if not self.cache_touch_if(key, token, ttl):
+                    logger.warning("잠금을 잃었습니다(만료): %s", name)
+                    return
+
+        if renew:
+            threading.Thread(
+                target=_renew, name=f"lock-renew:{name}", daemon=True
+            ).start()
+        try:
+            yield
+        finally:
+            stop.set()
+            self.cache_delete_if(key, token)
+
+
+class SqliteStateBackend(SharedStateBackend):
+    """SQLite(WAL) 기반 기본 저장소. 스레드마다 연결을 따로 연다."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        self._purged_at = 0.0
+        self._conn().executescript("""
+            CREATE TABLE IF NOT EXISTS kv (
+                key TEXT PRIMARY KEY, value TEXT, expires_at REAL
+            );
+            CREATE INDEX IF NOT EXISTS kv_expires ON kv (expires_at);
+            CREATE TABLE IF NOT EXISTS rate_hits (key TEXT, ts REAL);
+            CREATE INDEX IF NOT EXISTS rate_hits_key ON rate_hits (key, ts);
+            CREATE TABLE IF NOT EXISTS checkpoints (
+                run_key TEXT, stage TEXT, value TEXT, updated_at REAL,
+                PRIMARY KEY (run_key, stage)
+            );
+            """)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _tx(self):
+        # BEGIN IMMEDIATE: 쓰기 잠금을 먼저 잡아 '읽고-판단-쓰기'를 원자적으로
+        db = self._conn()
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            yield db
+            db.execute("COMMIT")
+        except Exception:
+            db.execute("ROLLBACK")
+            raise
+
+    def hit_rate_limit(self, key: str, limit: int, per_seconds: float) -> float:
+        now = time.time()
+        with self._tx() as db:
+            db.execute(
+                "DELETE FROM rate_hits WHERE key = ? AND ts <= ?",
+                (key, now - per_seconds),
+            )
+            rows = db.execute(
+                "SELECT ts FROM rate_hits WHERE key = ? ORDER BY ts", (key,)
+            ).fetchall()
+            if len(rows) >= limit:
+                return max(0.001, per_seconds - (now - rows[0][0]))
+            db.execute("INSERT INTO rate_hits (key, ts) VALUES (?, ?)", (key, now))
+            return 0.0
+
+    def cache_get(self, key: str):
+        row = (
+            self._conn()
+            .execute("SELECT value, expires_at FROM kv WHERE key = ?", (key,))
+            .fetchone()
+        )
+        if row is None or (row[1] is not None and row[1] <= time.time()):
+            return None
+        return json.loads(row[0])
+
+    def _purge_expired(self, db: sqlite3.Connection, now: float) -> None:
+        # 만료된 키는 읽을 때 무시만 하므로 가끔 한 번씩 실제로 지운다
+        if now - self._purged_at < KV_PURGE_INTERVAL:
+            return
+        self._purged_at = now
+        db.execute(
+            "DELETE FROM kv WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,)
+        )
+
+    def cache_set(self, key: str, value, ttl: Optional[float] = None) -> None:
+        now = time.time()
+        expires_at = now + ttl if ttl else None
+        with self._tx() as db:
+            self._purge_expired(db, now)
+            db.execute(
+                "INSERT OR REPLACE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at),
+            )
+
+    def cache_add(self, key: str, value, ttl: Optional[float] = None) -> bool:
+        now = time.time()
+        with self._tx() as db:
+            db.execute(
+                "DELETE FROM kv WHERE key = ? AND expires_at IS NOT NULL"
+                " AND expires_at <= ?",
+                (key, now),
+            )
+            expires_at = now + ttl if ttl else None
+            cur = db.execute(
+                "INSERT OR IGNORE INTO kv (key, value, expires_at) VALUES (?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), expires_at),
+            )
+            return cur.rowcount == 1
+
+    def cache_delete(self, key: str) -> None:
+        with self._tx() as db:
+            db.execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def cache_delete_if(self, key: str, value) -> bool:
+        with self._tx() as db:
+            cur = db.execute(
+                "DELETE FROM kv WHERE key = ? AND value = ?",
+                (key, json.dumps(value, ensure_ascii=False)),
+            )
+            return cur.rowcount == 1
+
+    def cache_touch_if(self, key: str, value, ttl: float) -> bool:
+        now = time.time()
+        with self._tx() as db:
+            cur = db.execute(
+                "UPDATE kv SET expires_at = ? WHERE key = ? AND value = ?"
+                " AND (expires_at IS NULL OR expires_at > ?)",
+                (now + ttl, key, json.dumps(value, ensure_ascii=False), now),
+            )
+            return cur.rowcount == 1
+
+    def checkpoint_put(self, run_key: str, stage: str, value) -> None:
+        now = time.time()
+        with self._tx() as db:
+            db.execute(
+                "DELETE FROM checkpoints WHERE updated_at <= ?", (now - CHECKPOINT_TTL,)
+            )
+            db.execute(
+                "INSERT OR REPLACE INTO checkpoints (run_key, stage, value, updated_at)"
+                " VALUES (?, ?, ?, ?)",
+                (run_key, stage, json.dumps(value, ensure_ascii=False), now),
+            )
+
+    def checkpoint_get(self, run_key: str) -> dict:
+        rows = (
+            self._conn()
+            .execute(
+                "SELECT stage, value FROM checkpoints"
+                " WHERE run_key = ? AND updated_at > ?",
+                (run_key, time.time() - CHECKPOINT_TTL),
+            )
+            .fetchall()
+        )
+        return {stage: json.loads(value) for stage, value in rows}
+
+    def checkpoint_clear(self, run_key: str) -> None:
+        with self._tx() as db:
+            db.execute("DELETE FROM checkpoints WHERE run_key = ?", (run_key,))
+
+
+_REDIS_RATE_LIMIT_LUA = """
+local key = KEYS[1]
+local now = tonumber(ARGV[1])
+local per = tonumber(ARGV[2])
+local limit = tonumber(ARGV[3])
+redis.call('ZREMRANGEBYSCORE', key, '-inf', now - per)
+if redis.call('ZCARD', key) >= limit then
+  local first = redis.call('ZRANGE', key, 0, 0, 'WITHSCORES')
+  return tostring(per - (now - tonumber(first[2])))
+end
+redis.call('ZADD', key, now, ARGV[4])
+redis.call('EXPIRE', key, math.ceil(per))
+return '0'
+"""
+
+
+_REDIS_DELETE_IF_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_REDIS_TOUCH_IF_LUA = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+
+class RedisStateBackend(SharedStateBackend):
+    """Redis 저장소(여러 서버용). redis 패키지는 이 저장소를 쓸 때만 필요."""
+
+    def __init__(self, url: str, prefix: str = "h_app:"):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError(
+                "SHARED_STATE_URL이 redis://인데 redis 패키지가 없습니다. "
+                "`pip install redis` 후 다시 실행하세요."
+            ) from e
+        self._r = redis.Redis.from_url(url)
+        self._prefix = prefix
+        self._rate_limit = self._r.register_script(_REDIS_RATE_LIMIT_LUA)
+        self._delete_if = self._r.register_script(_REDIS_DELETE_IF_LUA)
+        self._touch_if = self._r.register_script(_REDIS_TOUCH_IF_LUA)
+
+    def _k(self, key: str) -> str:
+        return self._prefix + key
+
+    def hit_rate_limit(self, key: str, limit: int, per_seconds: float) -> float:
+        wait = self._rate_limit(
+            keys=[self._k(f"rl:{key}")],
+            args=[time.time(), per_seconds, limit, uuid.uuid4().hex],
+        )
+        return float(wait)
+
+    def cache_get(self, key: str):
+        raw = self._r.get(self._k(key))
+        return None if raw is None else json.loads(raw)
+
+    def cache_set(self, key: str, value, ttl: Optional[float] = None) -> None:
+        px = int(ttl * 1000) if ttl else None
+        self._r.set(self._k(key), json.dumps(value, ensure_ascii=False), px=px)
+
+    def cache_add(self, key: str, value, ttl: Optional[float] = None) -> bool:
+        px = int(ttl * 1000) if ttl else None
+        raw = json.dumps(value, ensure_ascii=False)
+        return bool(self._r.set(self._k(key), raw, px=px, nx=True))
+
+    def cache_delete(self, key: str) -> None:
+        self._r.delete(self._k(key))
+
+    def cache_delete_if(self, key: str, value) -> bool:
+        raw = json.dumps(value, ensure_ascii=False)
+        return bool(self._delete_if(keys=[self._k(key)], args=[raw]))
+
+    def cache_touch_if(self, key: str, value, ttl: float) -> bool:
+        raw = json.dumps(value, ensure_ascii=False)
+        return bool(self._touch_if(keys=[self._k(key)], args=[raw, int(ttl * 1000)]))
+
+    def checkpoint_put(self, run_key: str, stage: str, value) -> None:
+        k = self._k(f"ckpt:{run_key}")
+        pipe = self._r.pipeline()
+        pipe.hset(k, stage, json.dumps(value, ensure_ascii=False))
+        pipe.expire(k, CHECKPOINT_TTL)
+        pipe.execute()
+
+    def checkpoint_get(self, run_key: str) -> dict:
+        raw = self._r.hgetall(self._k(f"ckpt:{run_key}"))
+        return {k.decode("utf-8"): json.loads(v) for k, v in raw.items()}
+
+    def checkpoint_clear(self, run_key: str) -> None:
+        self._r.delete(self._k(f"ckpt:{run_key}"))
+
+
+def make_shared_state(url: str = "") -> SharedStateBackend:
+    url = (url or "").strip()
+    if url.startswith(("redis://", "rediss://")):
+        return RedisStateBackend(url)
+    if url.startswith("sqlite:///"):
+        return SqliteStateBackend(url[len("sqlite:///") :])
+    if url:
+        raise RuntimeError(f"알 수 없는 SHARED_STATE_URL: {url}")
+    default_path = os.path.join(tempfile.gettempdir(), "h_app_state.sqlite3")
+    return SqliteStateBackend(default_path)
+
+
+@process_singleton
+def get_shared_state() -> SharedStateBackend:
+    return make_shared_state(SHARED_STATE_URL)
+
+
+# =========================================================
+# 2) 재시도(백오프)
+# =========================================================
+
+
+# ---- 실행 전체 마감 시간(deadline) ----
+# 실행 1회에 RUN_DEADLINE_SECONDS를 주고 contextvar로 모든 단계/재시도에 전달한다.
+# 재시도 대기와 호출별 타임아웃은 남은 시간 안으로 줄이고,
+# 다음 재시도까지 기다릴 시간이 없으면 바로 DeadlineExceeded.
+# (백그라운드 작업 스레드에는 전달되지 않음 → 실행이 끝난 뒤의 일은 제한 없음)
+
+RUN_DEADLINE_SECONDS = 600.0
+
+
+class DeadlineExceeded(RuntimeError):
+    """실행 마감 시간 초과."""
+
+
+class RunDeadline:
+    def __init__(self, seconds: float):
+        self.started_at = time.time()
+        self.expires_at = self.started_at + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.time())
+
+    def elapsed(self) -> float:
+        return time.time() - self.started_at
+
+    def check(self, what: str = "") -> None:
+        if self.remaining() <= 0:
+            raise DeadlineExceeded(
+                f"실행 제한 시간({self.expires_at - self.started_at:.0f}초) 초과"
+                + (f": {what}" if what else "")
+            )
+
+
+_run_deadline = contextvars.ContextVar("run_deadline", default=None)
+
+
+def current_deadline() -> Optional[RunDeadline]:
+    return _run_deadline.get()
+
+
+@contextmanager
+def run_deadline(seconds: Optional[float] = None):
+    deadline = RunDeadline(seconds or RUN_DEADLINE_SECONDS)
+    token = _run_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        _run_deadline.reset(token)
+
+
+def check_deadline(what: str = "") -> None:
+    deadline = current_deadline()
+    if deadline:
+        deadline.check(what)
+
+
+def clamp_timeout(seconds: float, minimum: float = 1.0) -> float:
+    """호출 타임아웃을 남은 시간 이내로(마감이 없으면 그대로)."""
+    deadline = current_deadline()
+    if not deadline:
+        return seconds
+    return max(minimum, min(seconds, deadline.remaining()))
+
+
+def _sleep_backoff(attempt: int, base: float = 2.0, cap: float = 60.0) -> None:
+    delay = min(cap, base * (2**attempt))
+    delay = delay * (0.6 + random.random() * 0.8)
+    deadline = current_deadline()
+    if deadline and deadline.remaining() <= delay:
+        # 기다린 뒤에는 재시도할 시간이 없음 → 지금 실패
+        raise DeadlineExceeded(
+            f"실행 제한 시간이 얼마 남지 않아 재시도하지 않습니다"
+            f"(남은 {deadline.remaining():.0f}초)"
+        )
+    time.sleep(delay)
+
+
+def _is_retryable_gemini_error(e: Exception) -> bool:
+    s = str(e).lower()
+    return any(
+        k in s
+        for k in [
+            "429",
+            "rate",
+            "quota",
+            "resource exhausted",
+            "503",
+            "overload",
+            "unavailable",
+            "504",
+            "deadline",
+            "timeout",
+        ]
+    )
+
+
+def _is_retryable_http_error(e: HttpError) -> bool:
+    status = None
+    try:
+        status = e.resp.status
+    except Exception:
+        pass
+    return status in [429, 500, 502, 503, 504]
+
+
+# 응답을 받지 못한 전송 오류(연결 끊김/타임아웃)는 5xx처럼 재시도하고 차단기 실패로 센다.
+# PooledGoogleHttp(requests) 전송의 읽기 타임아웃/연결 오류도 여기에 포함
+_TRANSPORT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    socket.timeout,
+    requests.RequestException,
+)
+
+
+# 서비스가 내려가 있을 때 교사마다 몇 분씩 재시도하며 부하를 더하지 않도록
+# 의존 서비스별 차단기(circuit breaker)를 둔다.
+#   closed    : 정상. 연속 실패가 BREAKER_FAILURE_THRESHOLD회면 open
+#   open      : BREAKER_COOLDOWN초 동안 호출 없이 바로 실패
+#   half_open : 쿨다운 후 시험 호출 1개만 허용 → 성공이면 closed, 실패면 다시 open
+# 프로세스 안의 모든 세션/백그라운드 스레드가 같은 차단기를 공유한다.
+
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_COOLDOWN = 30.0
+BREAKER_LABELS = {
+    "drive": "Google Drive",
+    "docs": "Google Docs",
+    "sheets": "Google Sheets",
+    "gas": "GAS 자동 서식",
+}
+
+
+class CircuitOpenError(RuntimeError):
+    """차단기가 열려 있어 호출하지 않고 바로 실패."""
+
+
+class CircuitBreaker:
+    def __init__(
+        self,
+        name: str,
+        failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+        cooldown: float = BREAKER_COOLDOWN,
+    ):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self.stats = {"calls": 0, "failures": 0, "rejected": 0, "opened": 0}
+        self.last_error = ""
+
+    @property
+    def label(self) -> str:
+        if self.name.startswith("gemini:"):
+            return f"Gemini ({self.name.split(':', 1)[1]})"
+        return BREAKER_LABELS.get(self.name, self.name)
+
+    def retry_after(self) -> float:
+        return max(0.0, self.opened_at + self.cooldown - time.time())
+
+    def before_call(self) -> None:
+        """호출 전에 부른다. 막혀 있으면 CircuitOpenError."""
+        with self._lock:
+            if self.state == "open" and self.retry_after() <= 0:
+                self.state = "half_open"
+            if self.state == "half_open":
+                if self._trial_in_flight:
+                    self.stats["rejected"] += 1
+                    raise CircuitOpenError(
+                        f"{self.label} 상태 확인 중입니다. 잠시 후 다시 시도하세요."
+                    )
+                self._trial_in_flight = True
+            elif self.state == "open":
+                self.stats["rejected"] += 1
+                raise CircuitOpenError(
+                    f"{self.label} 연결이 계속 실패해 잠시 호출을 멈췄습니다"
+                    f"(약 {math.ceil(self.retry_after())}초 후 다시 시도). "
+                    f"최근 오류: {self.last_error}"
+                )
+            self.stats["calls"] += 1
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.consecutive_failures = 0
+            self._trial_in_flight = False
+
+    def record_failure(self, error: Exception) -> None:
+        with self._lock:
+            self.stats["failures"] += 1
+            self.consecutive_failures += 1
+            self.last_error = str(error)[:200]
+            was_trial = self.state == "half_open"
+            self._trial_in_flight = False
+            if was_trial or self.consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.stats["opened"] += 1
+                self.state = "open"
+                self.opened_at = time.time()
+
+    def release(self) -> None:
+        """의존 서비스 탓이 아닌 실패(404 등): 시험 호출 자리만 돌려준다."""
+        with self._lock:
+            self._trial_in_flight = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "서비스": self.label,
+                "상태": self.state,
+                "연속 실패": self.consecutive_failures,
+                "재개까지(초)": (
+                    math.ceil(self.retry_after()) if self.state == "open" else 0
+                ),
+                "호출": self.stats["calls"],
+                "실패": self.stats["failures"],
+                "즉시 거절": self.stats["rejected"],
+                "열림 횟수": self.stats["opened"],
+                "최근 오류": self.last_error,
+            }
+
+
+@process_singleton
+def _circuit_breakers() -> dict:
+    return {"lock": threading.Lock(), "breakers": {}}
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    registry = _circuit_breakers()
+    with registry["lock"]:
+        breaker = registry["breakers"].get(name)
+        if breaker is None:
+            breaker = registry["breakers"][name] = CircuitBreaker(
+                name, BREAKER_FAILURE_THRESHOLD, BREAKER_COOLDOWN
+            )
+        return breaker
+
+
+def circuit_breaker_snapshots() -> list:
+    registry = _circuit_breakers()
+    with registry["lock"]:
+        breakers = sorted(registry["breakers"].values(), key=lambda b: b.name)
+    return [b.snapshot() for b in breakers]
+
+
+def _breaker_for_label(label: str) -> Optional[CircuitBreaker]:
+    """'Drive Copy' → drive 차단기. 알 수 없는 라벨이면 None."""
+    name = (label.split() or [""])[0].lower()
+    return get_circuit_breaker(name) if name in BREAKER_LABELS else None
+
+
+def execute_with_retry(fn, max_retries: int = 6, label: str = "API"):
+    breaker = _breaker_for_label(label)
+    for attempt in range(max_retries):
+        check_deadline(label)
+        if breaker:
+            breaker.before_call()
+        try:
+            result = fn()
+        except (HttpError, *_TRANSPORT_ERRORS) as e:
+            retryable = not isinstance(e, HttpError) or _is_retryable_http_error(e)
+            if breaker:
+                # 4xx(권한/없음 등)는 호출 쪽 문제 → 차단기에 넣지 않음
+                if retryable:
+                    breaker.record_failure(e)
+                else:
+                    breaker.release()
+            # 이번 실패로 차단기가 열렸으면 기다리지 않고 바로 실패
+            tripped = breaker is not None and breaker.state == "open"
+            if retryable and not tripped and attempt < max_retries - 1:
+                notify("warning", f"⚠️ {label} 재시도 ({attempt+1}/{max_retries})")
+                _sleep_backoff(attempt)
+                continue
+            raise
+        except Exception:
+            if breaker:
+                breaker.release()
+            raise
+        if breaker:
+            breaker.record_success()
+        return result
+
+
+# =========================================================
+# 2-1) 프로파일링(관리자) — 샘플링 프로파일러
+# =========================================================
+# 실행 스레드의 스택을 주기적으로 샘플링해, 함수별 경과시간(wall)과 CPU 시간을
+# 나누고, 맨 끝(leaf) 프레임으로 sleep / 네트워크 대기 / CPU를 구분한다.
+
+PROFILE_INTERVAL = 0.005  # 샘플 간격(초)
+_NETWORK_MODULES = (
+    "socket.py",
+    "ssl.py",
+    "selectors.py",
+    "http/client.py",
+    "httplib2",
+    "urllib3",
+    "requests",
+    "httpx",
+    "httpcore",
+)
+PROFILE_CATEGORIES = {
+    "sleep": "재시도/대기 sleep",
+    "network": "네트워크 대기",
+    "json": "JSON 파싱(CPU)",
+    "cpu": "CPU",
+    "wait": "기타 대기(GIL·잠금 등)",
+}
+
+
+def _classify_leaf(frame_key: Tuple[str, str], cpu_ratio: float) -> str:
+    filename, func = frame_key
+    path = filename.replace("\\", "/")
+    if func in ("_sleep_backoff", "sleep"):
+        return "sleep"
+    if any(m in path for m in _NETWORK_MODULES):
+        return "network"
+    if "/json/" in path:
+        return "json"
+    return "cpu" if cpu_ratio >= 0.5 else "wait"
+
+
+class SamplingProfiler:
+    """
+    start()를 호출한 스레드를 백그라운드 스레드에서 샘플링한다.
+    - stacks: 접힌 스택(collapsed) → 경과 마이크로초(flamegraph.pl / speedscope 입력)
+    - functions: 함수별 누적 경과/CPU/자기시간 + 대기 유형별 시간
+    CPU 시간은 스레드별 CPU 시계(pthread_getcpuclockid)를 쓰며, 없는 OS에서는 0.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks: Dict[str, int] = {}
+        self.functions: Dict[Tuple[str, str], dict] = {}
+        self.categories: Dict[str, float] = {k: 0.0 for k in PROFILE_CATEGORIES}
+        self.wall_s = 0.0
+        self.cpu_s = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self) -> "SamplingProfiler":
+        self._target = threading.get_ident()
+        try:
+            self._clock = time.pthread_getcpuclockid(self._target)
+        except (AttributeError, OSError):
+            self._clock = None
+        self._thread = threading.Thread(
+            target=self._loop, name="run-profiler", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=2)
+
+    def _cpu_now(self) -> float:
+        if self._clock is None:
+            return 0.0
+        try:
+            return time.clock_gettime(self._clock)
+        except OSError:
+            return 0.0
+
+    def _loop(self) -> None:
+        last_wall, last_cpu = time.perf_counter(), self._cpu_now()
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            now_wall, now_cpu = time.perf_counter(), self._cpu_now()
+            dt_wall, dt_cpu = now_wall - last_wall, max(0.0, now_cpu - last_cpu)
+            last_wall, last_cpu = now_wall, now_cpu
+            if frame is None:
+                continue
+
+            keys = []
+            while frame is not None:
+                keys.append((frame.f_code.co_filename, frame.f_code.co_name))
+                frame = frame.f_back
+            keys.reverse()  # 바깥 → 안쪽(leaf)
+
+            cat = _classify_leaf(keys[-1], dt_cpu / dt_wall if dt_wall else 0.0)
+            self._record(keys, cat, dt_wall, dt_cpu)
+
+    def _record(self, keys: list, cat: str, dt_wall: float, dt_cpu: float) -> None:
+        self.wall_s += dt_wall
+        self.cpu_s += dt_cpu
+        self.categories[cat] += dt_wall
+
+        names = [f"{os.path.basename(f)}:{fn}" for f, fn in keys]
+        collapsed = ";".join(names)
+        self.stacks[collapsed] = self.stacks.get(collapsed, 0) + int(dt_wall * 1e6)
+
+        for key in set(keys):  # 재귀 호출은 한 번만 누적
+            row = self.functions.get(key)
+            if row is None:
+                row = {"wall_s": 0.0, "cpu_s": 0.0, "self_s": 0.0}
+                row.update(dict.fromkeys(PROFILE_CATEGORIES, 0.0))
+                self.functions[key] = row
+            row["wall_s"] += dt_wall
+            row["cpu_s"] += dt_cpu
+            row[cat] += dt_wall
+        self.functions[keys[-1]]["self_s"] += dt_wall
+
+    def collapsed_text(self) -> str:
+        return "".join(f"{k} {v}\n" for k, v in sorted(self.stacks.items()) if v)
+
+    def table(self, limit: int = 40) -> list:
+        rows = []
+        for (filename, func), r in self.functions.items():
+            row = {
+                "함수": f"{os.path.basename(filename)}:{func}",
+                "경과(s)": round(r["wall_s"], 3),
+                "CPU(s)": round(r["cpu_s"], 3),
+                "자기시간(s)": round(r["self_s"], 3),
+            }
+            row.update(
+                {label: round(r[c], 3) for c, label in PROFILE_CATEGORIES.items()}
+            )
+            rows.append(row)
+        rows.sort(key=lambda r: r["경과(s)"], reverse=True)
+        return rows[:limit]
+
+
+# =========================================================
+# 3) Google OAuth & 서비스
+# =========================================================
+# googleapiclient 기본 전송(httplib2)은 스레드 간 공유가 안 되고 호출마다 연결을
+# 새로 여는 일이 잦다. keep-alive 연결 풀(requests/urllib3) 위의 전송 1개를
+# 프로세스가 공유하고, 서비스 객체도 1벌만 만들어 모든 스레드가 같이 쓴다.
+
+GOOGLE_HTTP_TIMEOUT = (5, 120)  # Google API (연결, 응답) 초 — 마감이 있으면 그 안으로
+GOOGLE_HTTP_POOL_SIZE = 16  # 호스트당 keep-alive 연결 수(동시 작업 스레드 수 이상)
+GOOGLE_HTTP_POOL_HOSTS = 8  # 연결 풀을 유지할 호스트 수(drive/docs/sheets/oauth2 …)
+
+
+class _GoogleHttpResponse(dict):
+    """httplib2.Response와 같은 모양(소문자 헤더 dict + status/reason)."""
+
+    def __init__(self, r: requests.Response):
+        super().__init__((k.lower(), v) for k, v in r.headers.items())
+        self["status"] = str(r.status_code)
+        self.status = r.status_code
+        self.reason = r.reason
+
+
+class PooledGoogleHttp:
+    """
+    googleapiclient용 전송(build(..., http=)) — 여러 스레드가 함께 써도 안전.
+    - 연결 풀(HTTPAdapter)은 1개를 공유, requests 세션(쿠키 등 상태)은 스레드마다
+    - 토큰 갱신은 잠금 안에서 1번만 — 동시에 401을 받아도 중복 갱신하지 않음
+    - 연결 재사용률/평균 지연은 stats()
+    """
+
+    def __init__(
+        self,
+        credentials,
+        pool_size: int = GOOGLE_HTTP_POOL_SIZE,
+        timeout: Tuple[float, float] = GOOGLE_HTTP_TIMEOUT,
+    ):
+        self.credentials = credentials
+        self.timeout = timeout
+        self.adapter = HTTPAdapter(
+            pool_connections=GOOGLE_HTTP_POOL_HOSTS, pool_maxsize=pool_size
+        )
+        self._local = threading.local()
+        self._refresh_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._auth_session = self._new_session()  # 토큰 갱신 전용(잠금 안에서만)
+        self._counts = dict.fromkeys(
+            ("requests", "errors", "token_refreshes", "auth_retries", "threads"), 0
+        )
+        self._seconds = 0.0
+
+    def _new_session(self) -> requests.Session:
+        session = requests.Session()
+        session.mount("https://", self.adapter)
+        return session
+
+    def _session(self) -> requests.Session:
+        session = getattr(self._local, "session", None)
+        if session is None:
+            session = self._local.session = self._new_session()
+            self._count("threads")
+        return session
+
+    def _count(self, key: str, seconds: float = 0.0) -> None:
+        with self._stats_lock:
+            self._counts[key] += 1
+            self._seconds += seconds
+
+    def _refresh(self, stale_token: Optional[str] = None) -> None:
+        with self._refresh_lock:
+            # 기다리는 동안 다른 스레드가 이미 갱신했으면 그 토큰을 사용
+            if self.credentials.valid and self.credentials.token != stale_token:
+                return
+            self.credentials.refresh(AuthRequest(self._auth_session))
+            self._count("token_refreshes")
+
+    def request(
+        self,
+        uri,
+        method="GET",
+        body=None,
+        headers=None,
+        redirections=5,
+        connection_type=None,
+    ):
+        """httplib2.Http.request와 같은 호출 형태. 반환: (응답, 본문 bytes)"""
+        if not self.credentials.valid:
+            self._refresh()
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        session = self._session()
+        connect, read = self.timeout
+        started = time.perf_counter()
+        try:
+            for attempt in range(2):
+                token = self.credentials.token
+                request_headers = dict(headers or {})
+                self.credentials.apply(request_headers, token=token)
+                r = session.request(
+                    method,
+                    uri,
+                    data=body,
+                    headers=request_headers,
+                    timeout=(clamp_timeout(connect), clamp_timeout(read)),
+                    # 재개형 업로드의 308은 리다이렉트가 아님 → GET/HEAD만 따라감
+                    allow_redirects=redirections > 0 and method in ("GET", "HEAD"),
+                )
+                if r.status_code != 401 or attempt:
+                    break
+                # 만료 직전 토큰이 거절됨 → 1번만 갱신 후 재시도
+                self._refresh(stale_token=token)
+                self._count("auth_retries")
+        except requests.RequestException:
+            self._count("errors", time.perf_counter() - started)
+            raise
+        self._count("requests", time.perf_counter() - started)
+        return _GoogleHttpResponse(r), r.content
+
+    def stats(self) -> dict:
+        """누적 통계. http_requests/connections는 urllib3 풀 기준(토큰 갱신 포함)."""
+        http_requests = connections = 0
+        pools = self.adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                http_requests += pool.num_requests
+                connections += pool.num_connections
+        with self._stats_lock:
+            counts = dict(self._counts)
+            seconds = self._seconds
+        done = counts["requests"] + counts["errors"]
+        return dict(
+            counts,
+            http_requests=http_requests,
+            connections=connections,
+            reused=max(0, http_requests - connections),
+            reuse_ratio=(
+                round(1 - connections / http_requests, 3) if http_requests else None
+            ),
+            avg_ms=round(seconds / done * 1000, 1) if done else None,
+        )
+
+
+@process_singleton
+def google_http() -> PooledGoogleHttp:
+    """
+    Service Account 기반 공유 전송
+    - 설정(configure)의 GOOGLE_SERVICE_ACCOUNT_JSON(문자열 또는 매핑) 사용
+    """
+    raw = SETTINGS.get("GOOGLE_SERVICE_ACCOUNT_JSON")
+    if not raw:
+        raise RuntimeError("GOOGLE_SERVICE_ACCOUNT_JSON 설정이 없습니다.")
+    sa_info = json.loads(raw) if isinstance(raw, str) else dict(raw)
+
+    creds = service_account.Credentials.from_service_account_info(
+        sa_info, scopes=SCOPES
+    )
+    return PooledGoogleHttp(creds)
+
+
+@process_singleton
+def get_google_services():
+    """Google Docs / Drive / Sheets (drive, docs, sheets) — 프로세스 공유, 스레드 안전."""
+    http = google_http()
+    drive = build("drive", "v3", http=http)
+    docs = build("docs", "v1", http=http)
+    sheets = build("sheets", "v4", http=http)
+
+    return drive, docs, sheets
+
+
+def google_http_stats() -> dict:
+    return google_http().stats()
+
+
+# =========================================================
+# 3-1) 사전 점검(preflight) — Gemini 호출 전에 외부 자원 설정 확인
+# =========================================================
+# 템플릿/폴더/시트/secrets가 잘못돼 있으면 Gemini 3회(수 분)를 쓴 뒤에야 실패한다.
+# 각 자원을 가볍게 1회씩 조회해 결과를 공유 상태에 TTL 동안 캐시 → 이후 실행은 ms.
+# 설정 값이 바뀌면 캐시 키(지문)가 달라져 자동으로 다시 점검한다.
+
+PREFLIGHT_TTL = 10 * 60  # 통과 결과 유지(초)
+PREFLIGHT_FAIL_TTL = 30  # 실패 결과 유지(초) — 고친 뒤 금방 다시 점검되게 짧게
+PREFLIGHT_HTTP_TIMEOUT = (3, 10)  # GAS 연결 확인 (연결, 응답) 초
+
+
+def _preflight_fingerprint() -> str:
+    """점검 대상 설정 전체의 지문(비밀값은 해시로만 들어감)."""
+    raw = SETTINGS.get("GOOGLE_SERVICE_ACCOUNT_JSON") or ""
+    parts = [
+        TEMPLATE_REPORT_DOC_ID,
+        TEMPLATE_GUIDE_DOC_ID,
+        DRIVE_FOLDER_ID_REPORT,
+        DRIVE_FOLDER_ID_GUIDE,
+        SHEETS_ID,
+        SHEETS_TAB,
+        MODEL_REPORT,
+        MODEL_SUMMARY,
+        MODEL_GUIDE,
+        GEMINI_API_KEY,
+        GAS_WEBAPP_URL,
+        GAS_TOKEN,
+        raw if isinstance(raw, str) else json.dumps(dict(raw), sort_keys=True),
+    ]
+    return hashlib.sha256("\x1f".join(parts).encode("utf-8")).hexdigest()[:16]
+
+
+def _check_secrets(google) -> str:
+    missing = [
+        name
+        for name, value in (
+            ("GEMINI_API_KEY", GEMINI_API_KEY),
+            (
+                "GOOGLE_SERVICE_ACCOUNT_JSON",
+                SETTINGS.get("GOOGLE_SERVICE_ACCOUNT_JSON"),
+            ),
+        )
+        if not value
+    ]
+    if missing:
+        raise RuntimeError("설정 없음: " + ", ".join(missing))
+    return "필수 secrets 있음"
+
+
+def _check_gemini(google) -> str:
+    # 모델 정보 조회만(생성 비용 없음) → 키/모델 이름 확인
+    client = get_gemini_client()
+    for model in sorted({MODEL_REPORT, MODEL_SUMMARY, MODEL_GUIDE}):
+        client.models.get(model=model)
+    return "API 키/모델 확인"
+
+
+def _check_template(doc_id: str):
+    def check(google) -> str:
+        meta = (
+            google()[0]
+            .files()
+            .get(
+                fileId=doc_id,
+                fields="name,mimeType,trashed,capabilities/canCopy",
+                supportsAllDrives=True,
+            )
+            .execute()
+        )
+        if meta.get("trashed"):
+            raise RuntimeError(f"휴지통에 있음: {meta.get('name')}")
+        if not meta.get("capabilities", {}).get("canCopy", False):
+            raise RuntimeError(f"복사 권한 없음: {meta.get('name')}")
+        return meta.get("name", "")
+
+    return check
+
+
+def _check_folder(folder_id: str):
+    def check(google) -> str:
+        if not folder_id:
+            return "(비어 있음 — 서비스 계정 드라이브 루트)"
+        meta = (
+            google()[0]
+            .files()
+            .get(
+                fileId=folder_id,
+                fields="name,mimeType,trashed,capabilities/canAddChildren",
+                supportsAllDrives=True,
+            )
+            .execute()
+        )
+        if meta.get("mimeType") != FOLDER_MIME or meta.get("trashed"):
+            raise RuntimeError(f"폴더가 아님(또는 휴지통): {meta.get('name')}")
+        if not meta.get("capabilities", {}).get("canAddChildren", False):
+            raise RuntimeError(f"쓰기 권한 없음(공유 확인): {meta.get('name')}")
+        return meta.get("name", "")
+
+    return check
+
+
+def _check_sheet(google) -> str:
+    meta = (
+        google()[2]
+        .spreadsheets()
+        .get(spreadsheetId=SHEETS_ID, fields="properties.title,sheets.properties.title")
+        .execute()
+    )
+    tabs = [s["properties"]["title"] for s in meta.get("sheets", [])]
+    if SHEETS_TAB not in tabs:
+        raise RuntimeError(f"탭 '{SHEETS_TAB}' 없음 (있는 탭: {', '.join(tabs)})")
+    return f"{meta.get('properties', {}).get('title', '')} / {SHEETS_TAB}"
+
+
+def _check_gas(google) -> str:
+    # 문서 ID 없이 호출 → 서식은 적용되지 않고 배포 URL/접근 권한/토큰만 확인
+    if not GAS_WEBAPP_URL or not GAS_TOKEN:
+        raise RuntimeError("GAS_WEBAPP_URL 또는 GAS_TOKEN 설정 없음")
+    r = requests.get(
+        GAS_WEBAPP_URL,
+        params={"token": GAS_TOKEN, "ping": "1"},
+        timeout=PREFLIGHT_HTTP_TIMEOUT,
+    )
+    if r.status_code != 200:
+        raise RuntimeError(f"HTTP {r.status_code}")
+    if "application/json" not in r.headers.get("Content-Type", ""):
+        raise RuntimeError("JSON 응답이 아님(배포 URL/접근 권한 확인)")
+    error = str(r.json().get("error", ""))
+    if "token" in error.lower() or "토큰" in error:
+        raise RuntimeError(f"GAS_TOKEN 거부: {error}")
+    return "웹앱 응답 확인"
+
+
+def preflight_checks() -> list:
+    """(키, 이름, 대상, 필수 여부, 점검 함수) — 필수가 아니면 실패해도 경고만."""
+    report_doc, guide_doc = TEMPLATE_REPORT_DOC_ID, TEMPLATE_GUIDE_DOC_ID
+    report_dir, guide_dir = DRIVE_FOLDER_ID_REPORT, DRIVE_FOLDER_ID_GUIDE
+    return [
+        ("secrets", "secrets", "필수 설정", True, _check_secrets),
+        ("gemini", "Gemini", MODEL_REPORT, True, _check_gemini),
+        ("report_doc", "보고서 템플릿", report_doc, True, _check_template(report_doc)),
+        ("guide_doc", "지도방침 템플릿", guide_doc, True, _check_template(guide_doc)),
+        ("report_dir", "보고서 폴더", report_dir, True, _check_folder(report_dir)),
+        ("guide_dir", "지도방침 폴더", guide_dir, True, _check_folder(guide_dir)),
+        ("sheet", "시트", SHEETS_ID, True, _check_sheet),
+        ("gas", "GAS 자동 서식", GAS_WEBAPP_URL, False, _check_gas),
+    ]
+
+
+def run_preflight(
+    state: Optional[SharedStateBackend] = None,
+    services=None,
+    force: bool = False,
+) -> dict:
+    """
+    외부 자원 사전 점검. 반환: {"ok", "checked_at", "cached", "rows": [...]}
+    ok는 필수 항목이 모두 통과했는지. 재시도 없이 1회만 조회한다(빨리 실패).
+    """
+    state = state or get_shared_state()
+    cache_key = f"preflight:{_preflight_fingerprint()}"
+    if not force:
+        cached = state.cache_get(cache_key)
+        if cached is not None:
+            return dict(cached, cached=True)
+
+    def google():
+        # 구글 서비스는 처음 필요할 때 1번만 연결(secrets/Gemini/GAS만 실패해도 점검 계속)
+        nonlocal services
+        if services is None:
+            services = get_google_services()
+        return services
+
+    rows = []
+    for key, name, target, required, check in preflight_checks():
+        started = time.perf_counter()
+        try:
+            detail, ok = check(google), True
+        except HttpError as e:
+            status = getattr(e.resp, "status", "?")
+            hint = {
+                403: "권한 없음(서비스 계정 공유 확인)",
+                404: "찾을 수 없음(ID 확인)",
+            }
+            detail, ok = f"HTTP {status} {hint.get(status, '')}".strip(), False
+        except Exception as e:
+            detail, ok = str(e) or type(e).__name__, False
+        rows.append(
+            {
+                "key": key,
+                "name": name,
+                "target": target,
+                "required": required,
+                "ok": ok,
+                "detail": detail,
+                "ms": round((time.perf_counter() - started) * 1000),
+            }
+        )
+
+    report = {
+        "ok": all(r["ok"] for r in rows if r["required"]),
+        "checked_at": time.time(),
+        "rows": rows,
+    }
+    state.cache_set(
+        cache_key, report, ttl=PREFLIGHT_TTL if report["ok"] else PREFLIGHT_FAIL_TTL
+    )
+    return dict(report, cached=False)
+
+
+def preflight_blockers(report: dict, auto_gas_format: bool = False) -> list:
+    """이번 실행을 막는 실패 항목(GAS는 자동 서식을 켠 경우에만)."""
+    return [
+        r
+        for r in report["rows"]
+        if not r["ok"] and (r["required"] or (auto_gas_format and r["key"] == "gas"))
+    ]
+
+
+# =========================================================
+# 4) Drive: 템플릿 복사 + 폴더 이동
+# =========================================================
+
+
+def copy_template(
+    drive_service, template_id: str, title: str, folder_id: str = ""
+) -> str:
+    # 복사할 때 parents를 바로 지정 → 부모 조회/이동 호출 없이 1회로 끝
+    body = {"name": title}
+    folder_id = (folder_id or "").strip()
+    if folder_id:
+        body["parents"] = [folder_id]
+
+    copied = execute_with_retry(
+        lambda: drive_service.files()
+        .copy(
+            fileId=template_id,
+            body=body,
+            supportsAllDrives=True,
+        )
+        .execute(),
+        label="Drive Copy",
+    )
+    file_id = copied.get("id")
+    if not file_id:
+        raise RuntimeError("템플릿 복사 실패: id 없음")
+
+    return file_id
+
+
+def trash_file(drive_service, file_id: str, label: str = "Drive Trash") -> None:
+    """파일을 휴지통으로(영구 삭제 아님 — 잘못 지워도 Drive에서 되살릴 수 있다)."""
+    execute_with_retry(
+        lambda: drive_service.files()
+        .update(fileId=file_id, body={"trashed": True}, supportsAllDrives=True)
+        .execute(),
+        label=label,
+    )
+
+
+# =========================================================
+# 4-1) Drive: 템플릿 사본 풀(미리 복사해 두기)
+# =========================================================
+
+TEMPLATE_POOL_SIZE = 0  # 0이면 사용 안 함
+POOL_PROP_TEMPLATE = "hAppPoolTemplate"  # 풀 사본 표시(appProperties)
+POOL_PROP_VERSION = "hAppPoolVersion"  # 복사 당시 템플릿 version
+POOL_VERSION_TTL = (
+    5 * 60
+)  # 템플릿 version 확인 유효 시간(초) — 지나면 claim 전에 재확인
+POOL_CLAIM_TTL = 24 * 3600
+
+
+class TemplateCopyPool:
+    """
+    템플릿별로 N개의 사본을 대상 폴더에 미리 만들어 두고,
+    실행 시에는 하나를 가져와(claim) 이름만 바꿔 쓴다.
+
+    - 풀 사본은 appProperties로 표시 → 프로세스가 재시작돼도 Drive에서 다시 찾음
+    - 템플릿 version은 채우기(백그라운드)에서 확인해 기억 → claim은 보통 Drive 조회
+      없음. 확인한 지 POOL_VERSION_TTL이 지났으면 꺼내기 전에 1번 다시 확인.
+      version이 바뀌면 이전 사본은 휴지통으로
+    - 채우기(refill)는 백그라운드 스레드 1개에서 순차 처리
+    - 여러 프로세스가 같은 사본을 가져가지 않도록 공유 상태로 claim 표시
+    """
+
+    def __init__(self, state: SharedStateBackend, size: int = TEMPLATE_POOL_SIZE):
+        self.state = state
+        self.size = size
+        self._lock = threading.Lock()
+        # (template_id, folder_id) -> [(사본 id, 복사 당시 version)]
+        self._ready: Dict[Tuple[str, str], list] = {}
+        self._discovered = set()
+        self._refilling = set()
+        self._versions: Dict[str, Tuple[str, float]] = (
+            {}
+        )  # 템플릿 → (version, 확인 시각)
+        self._executor = ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="template-pool"
+        )
+
+    @staticmethod
+    def _template_version(drive_service, template_id: str) -> str:
+        meta = execute_with_retry(
+            lambda: drive_service.files()
+            .get(fileId=template_id, fields="version", supportsAllDrives=True)
+            .execute(),
+            label="Drive Template Version",
+        )
+        return str(meta.get("version", ""))
+
+    @staticmethod
+    def _trash(drive_service, file_id: str) -> None:
+        trash_file(drive_service, file_id, label="Drive Trash Stale Copy")
+
+    def _discover(self, drive_service, template_id: str, folder_id: str) -> None:
+        """이전 프로세스가 만들어 둔 풀 사본을 Drive에서 다시 찾는다(최초 1회)."""
+        key = (template_id, folder_id)
+        if key in self._discovered:
+            return
+        q = (
+            f"appProperties has {{ key='{POOL_PROP_TEMPLATE}'"
+            f" and value='{template_id}' }} and trashed = false"
+        )
+        if folder_id:
+            q += f" and '{folder_id}' in parents"
+        resp = execute_with_retry(
+            lambda: drive_service.files()
+            .list(
+                q=q,
+                fields="files(id, appProperties)",
+                pageSize=100,
+                supportsAllDrives=True,
+                includeItemsFromAllDrives=True,
+            )
+            .execute(),
+            label="Drive List Pool",
+        )
+        found = [
+            (f["id"], (f.get("appProperties") or {}).get(POOL_PROP_VERSION, ""))
+            for f in resp.get("files", [])
+        ]
+        with self._lock:
+            known = {fid for fid, _ in self._ready.get(key, [])}
+            self._ready.setdefault(key, []).extend(
+                item for item in found if item[0] not in known
+            )
+            self._discovered.add(key)
+
+    def refill(self, drive_service, template_id: str, folder_id: str) -> None:
+        key = (template_id, folder_id)
+        self._discover(drive_service, template_id, folder_id)
+        version = self._template_version(drive_service, template_id)
+
+        with self._lock:
+            self._versions[template_id] = (version, time.time())
+            items = self._ready.get(key, [])
+            stale = [fid for fid, v in items if v != version]
+            self._ready[key] = [(fid, v) for fid, v in items if v == version]
+            missing = self.size - len(self._ready[key])
+        for fid in stale:
+            self._trash(drive_service, fid)
+
+        for _ in range(max(0, missing)):
+            body = {
+                "name": f"[준비 중] {template_id}",
+                "appProperties": {
+                    POOL_PROP_TEMPLATE: template_id,
+                    POOL_PROP_VERSION: version,
+                },
+            }
+            if folder_id:
+                body["parents"] = [folder_id]
+            copied = execute_with_retry(
+                lambda: drive_service.files()
+                .copy(fileId=template_id, body=body, supportsAllDrives=True)
+                .execute(),
+                label="Drive Pool Copy",
+            )
+            with self._lock:
+                self._ready.setdefault(key, []).append((copied["id"], version))
+
+    def _refill_in_worker(self, template_id: str, folder_id: str) -> None:
+        try:
+            self.refill(get_google_services()[0], template_id, folder_id)
+        except Exception:
+            pass  # 풀은 보조 수단: 실패하면 다음 요청 때 다시 채움
+        finally:
+            with self._lock:
+                self._refilling.discard((template_id, folder_id))
+
+    def ensure_warm(self, template_id: str, folder_id: str = "") -> None:
+        """풀이 모자라면 백그라운드 채우기를 예약(이미 진행 중이면 무시)."""
+        if self.size <= 0:
+            return
+        key = (template_id, (folder_id or "").strip())
+        with self._lock:
+            if key in self._refilling:
+                return
+            _, checked_at = self._versions.get(template_id, ("", 0.0))
+            fresh = time.time() - checked_at < POOL_VERSION_TTL
+            full = len(self._ready.get(key, [])) >= self.size
+            if key in self._discovered and full and fresh:
+                return
+            self._refilling.add(key)
+        self._executor.submit(self._refill_in_worker, *key)
+
+    def claim(
+        self,
+        drive_service,
+        template_id: str,
+        title: str,
+        folder_id: str = "",
+        target_folder_id: str = "",
+    ) -> Optional[str]:
+        """
+        최신 version의 사본 1개를 꺼내 이름을 바꿔 반환. 없으면 None.
+        target_folder_id가 풀 폴더와 다르면 이름 변경과 같은 호출로 옮긴다.
+        version은 마지막 채우기 때 확인한 값(아직 모르면 풀을 쓰지 않음). 확인이
+        POOL_VERSION_TTL보다 오래됐으면 다시 확인하고, 실패하면 None(바로 복사).
+        이름 변경/이동이 실패하면 사본을 풀에 되돌리고 claim 표시를 지운다.
+        """
+        if self.size <= 0:
+            return None
+        key = (template_id, (folder_id or "").strip())
+        with self._lock:
+            version, checked_at = self._versions.get(template_id, (None, 0.0))
+        if version is not None and time.time() - checked_at >= POOL_VERSION_TTL:
+            # 마지막 확인 뒤 템플릿이 편집됐을 수 있음 → 옛 사본을 내주지 않게
+            try:
+                version = self._template_version(drive_service, template_id)
+            except Exception:
+                self.ensure_warm(template_id, folder_id)
+                return None
+            with self._lock:
+                self._versions[template_id] = (version, time.time())
+        target_folder_id = (target_folder_id or "").strip()
+        move = {}
+        if target_folder_id and target_folder_id != key[1]:
+            move["addParents"] = target_folder_id
+            if key[1]:
+                move["removeParents"] = key[1]
+
+        file_id = None
+        stale = []
+        with self._lock:
+            items = self._ready.get(key, []) if version is not None else []
+            while items:
+                fid, v = items.pop(0)
+                if v != version:
+                    stale.append(fid)
+                # 다른 프로세스가 같은 사본을 먼저 가져갔으면 건너뜀
+                elif self.state.cache_add(f"pool-claim:{fid}", 1, ttl=POOL_CLAIM_TTL):
+                    file_id = fid
+                    break
+        for fid in stale:
+            self._trash(drive_service, fid)
+
+        try:
+            if file_id:
+                self._take(drive_service, file_id, title, move)
+        except Exception:
+            with self._lock:
+                self._ready.setdefault(key, []).insert(0, (file_id, version))
+            self.state.cache_delete(f"pool-claim:{file_id}")
+            raise
+        finally:
+            self.ensure_warm(template_id, folder_id)
+        return file_id
+
+    @staticmethod
+    def _take(drive_service, file_id: str, title: str, move: dict) -> None:
+        """풀 표시를 지우고 이름 변경(+이동)."""
+        execute_with_retry(
+            lambda: drive_service.files()
+            .update(
+                fileId=file_id,
+                body={
+                    "name": title,
+                    "appProperties": {
+                        POOL_PROP_TEMPLATE: None,
+                        POOL_PROP_VERSION: None,
+                    },
+                },
+                supportsAllDrives=True,
+                **move,
+            )
+            .execute(),
+            label="Drive Claim Pool Copy",
+        )
+
+
+@process_singleton
+def get_template_pool() -> TemplateCopyPool:
+    return TemplateCopyPool(get_shared_state(), TEMPLATE_POOL_SIZE)
+
+
+def copy_template_pooled(
+    drive_service,
+    template_id: str,
+    title: str,
+    folder_id: str = "",
+    target_folder_id: str = "",
+) -> str:
+    """
+    풀에 준비된 사본이 있으면 그걸 쓰고, 없으면 바로 복사.
+    풀은 folder_id(루트)에 두고, 결과 문서는 target_folder_id(없으면 루트)로.
+    """
+    target_folder_id = target_folder_id or folder_id
+    try:
+        file_id = get_template_pool().claim(
+            drive_service, template_id, title, folder_id, target_folder_id
+        )
+    except Exception:
+        file_id = None  # 풀은 보조 수단: 실패하면 바로 복사
+    return file_id or copy_template(drive_service, template_id, title, target_folder_id)
+
+
+# =========================================================
+# 4-2) Drive: 학년/반 폴더 (루트/1학년/1학년 2반)
+# =========================================================
+# 폴더 id는 공유 상태에 만료 없이 저장 → 첫 실행 이후에는 Drive 호출 없음.
+# 누가 폴더를 지웠으면 복사가 404로 실패 → 캐시를 지우고 다시 찾는다.
+
+DRIVE_CLASS_FOLDERS = True
+FOLDER_MIME = "application/vnd.google-apps.folder"
+
+
+def class_folder_names(grade: str, klass: str) -> list:
+    """학년/반 → 루트 아래 폴더 이름 경로. 알 수 없으면 빈 목록(루트에 저장)."""
+    if not grade:
+        return []
+    names = [f"{grade}학년"]
+    if klass:
+        names.append(f"{grade}학년 {klass}반")
+    return names
+
+
+def _find_or_create_folder(drive_service, parent_id: str, name: str) -> str:
+    escaped = name.replace("\\", "\\\\").replace("'", "\\'")
+    q = (
+        f"name = '{escaped}' and mimeType = '{FOLDER_MIME}'"
+        f" and '{parent_id}' in parents and trashed = false"
+    )
+    resp = execute_with_retry(
+        lambda: drive_service.files()
+        .list(
+            q=q,
+            fields="files(id)",
+            pageSize=1,
+            supportsAllDrives=True,
+            includeItemsFromAllDrives=True,
+        )
+        .execute(),
+        label="Drive Find Folder",
+    )
+    files = resp.get("files", [])
+    if files:
+        return files[0]["id"]
+    created = execute_with_retry(
+        lambda: drive_service.files()
+        .create(
+            body={"name": name, "mimeType": FOLDER_MIME, "parents": [parent_id]},
+            fields="id",
+            supportsAllDrives=True,
+        )
+        .execute(),
+        label="Drive Create Folder",
+    )
+    return created["id"]
+
+
+def _folder_cache_key(root_id: str, names: list) -> str:
+    return "drive-folder:" + "/".join([root_id] + names)
+
+
+def resolve_class_folder(
+    drive_service,
+    state: SharedStateBackend,
+    root_id: str,
+    grade: str,
+    klass: str,
+) -> str:
+    """
+    루트 아래 학년/반 폴더 id를 반환(없으면 만든다).
+    - 경로의 각 단계를 캐시 → 같은 학년의 다른 반은 반 폴더만 찾으면 됨
+    - 생성은 잠금 안에서 → 두 교사가 동시에 같은 폴더를 두 개 만들지 않음
+    """
+    root_id = (root_id or "").strip()
+    names = class_folder_names(grade, klass)
+    if not DRIVE_CLASS_FOLDERS or not root_id or not names:
+        return root_id
+
+    cached = state.cache_get(_folder_cache_key(root_id, names))
+    if cached:
+        return cached
+
+    parent_id = root_id
+    for depth in range(1, len(names) + 1):
+        key = _folder_cache_key(root_id, names[:depth])
+        folder_id = state.cache_get(key)
+        if not folder_id:
+            with state.lock(key, renew=True):
+                folder_id = state.cache_get(key)
+                if not folder_id:
+                    folder_id = _find_or_create_folder(
+                        drive_service, parent_id, names[depth - 1]
+                    )
+                    state.cache_set(key, folder_id)
+        parent_id = folder_id
+    return parent_id
+
+
+def forget_class_folder(
+    state: SharedStateBackend, root_id: str, grade: str, klass: str
+) -> None:
+    names = class_folder_names(grade, klass)
+    for depth in range(1, len(names) + 1):
+        state.cache_delete(_folder_cache_key((root_id or "").strip(), names[:depth]))
+
+
+def copy_template_to_class_folder(
+    drive_service,
+    state: SharedStateBackend,
+    template_id: str,
+    title: str,
+    root_id: str,
+    student_num5: str,
+) -> str:
+    """템플릿 사본을 학생의 학년/반 폴더에 만든다(풀 사본이면 옮긴다)."""
+    grade, klass, _ = parse_student_num5(student_num5)
+    target = resolve_class_folder(drive_service, state, root_id, grade, klass)
+    try:
+        return copy_template_pooled(drive_service, template_id, title, root_id, target)
+    except HttpError as e:
+        if target == root_id or getattr(e.resp, "status", None) != 404:
+            raise
+    # 캐시된 폴더가 지워진 경우: 한 번만 다시 찾아서 재시도
+    forget_class_folder(state, root_id, grade, klass)
+    target = resolve_class_folder(drive_service, state, root_id, grade, klass)
+    return copy_template_pooled(drive_service, template_id, title, root_id, target)
+
+
+# =========================================================
+# 5) Docs: placeholder 관리
+# =========================================================
+
+
+def _doc_contains_text(doc_json: dict, needle: str) -> bool:
+    content = doc_json.get("body", {}).get("content", [])
+    for el in content:
+        para = el.get("paragraph")
+        if not para:
+            continue
+        for pe in para.get("elements", []):
+            tr = pe.get("textRun", {})
+            txt = tr.get("content", "")
+            if needle in txt:
+                return True
+    return False
+
+
+DEBUG_TOKENS = {
+    # 공용
+    "[[HR]]": "",
+    "=== 본문 시작 ===": "",
+    # 보고서 템플릿
+    "{{REPORT_ANCHOR}}": "",
+    # 담임 템플릿
+    "{{GUIDE_ANCHOR}}": "",
+    "[[NOTES_START]]": "",
+    "[[NOTES_END]]": "",
+}
+
+
+def _build_placeholder_insert_requests(
+    doc_json: dict, placeholders: Dict[str, str]
+) -> list:
+    """없는 플레이스홀더를 '문서 끝'에 삽입하는 요청 목록(없으면 빈 목록)."""
+    missing = [ph for ph in placeholders.keys() if not _doc_contains_text(doc_json, ph)]
+    if not missing:
+        return []
+
+    content = doc_json.get("body", {}).get("content", [])
+    end_index = content[-1].get("endIndex") if content else 1
+    if end_index is None:
+        end_index = 1
+
+    insert_text = "\n"
+    for ph in missing:
+        title = placeholders.get(ph, ph)
+        insert_text += f"\n[{title}]\n{ph}\n"
+    insert_text += "\n"
+
+    return [{"insertText": {"location": {"index": end_index - 1}, "text": insert_text}}]
+
+
+def _build_replace_all_requests(replace_map: Dict[str, str]) -> list:
+    reqs = []
+    for k, v in replace_map.items():
+        reqs.append(
+            {
+                "replaceAllText": {
+                    "containsText": {"text": k, "matchCase": True},
+                    "replaceText": v or "",
+                }
+            }
+        )
+    return reqs
+
+
+def ensure_placeholders_exist(
+    docs_service, doc_id: str, placeholders: Dict[str, str]
+) -> None:
+    """문서 내 플레이스홀더가 없으면 '문서 끝'에 삽입(보험)."""
+    doc = execute_with_retry(
+        lambda: docs_service.documents().get(documentId=doc_id).execute(),
+        label="Docs Get",
+    )
+    reqs = _build_placeholder_insert_requests(doc, placeholders)
+    if not reqs:
+        return
+
+    execute_with_retry(
+        lambda: docs_service.documents()
+        .batchUpdate(documentId=doc_id, body={"requests": reqs})
+        .execute(),
+        label="Docs Insert Placeholder",
+    )
+
+
+def batch_replace_all_text(
+    docs_service, doc_id: str, replace_map: Dict[str, str]
+) -> None:
+    reqs = _build_replace_all_requests(replace_map)
+    if not reqs:
+        return
+
+    execute_with_retry(
+        lambda: docs_service.documents()
+        .batchUpdate(documentId=doc_id, body={"requests": reqs})
+        .execute(),
+        label="Docs ReplaceAllText",
+    )
+
+
+def remove_debug_tokens_after_format(docs_service, doc_id: str) -> None:
+    """GAS 서식 적용 후 보기 싫은 토큰 제거(보고서+담임템플릿 공용)."""
+    batch_replace_all_text(docs_service, doc_id, DEBUG_TOKENS)
+
+
+# =========================================================
+# 5-1) Docs: 문서별 변경 계획(batchUpdate 병합)
+# =========================================================
+
+# 같은 batchUpdate 안에서는 요청이 순서대로 적용되므로 단계 순서대로 정렬해 보낸다.
+PHASE_INSERT = 0  # 플레이스홀더 삽입(보험)
+PHASE_REPLACE = 1  # 본문 치환
+PHASE_CLEANUP = 2  # 디버그 토큰 제거(GAS 서식 적용 '이후'여야 함)
+
+
+class DocsMutationPlan:
+    """
+    문서 1개에 대한 변경(플레이스홀더 삽입/치환/토큰 제거)을 모아 두었다가
+    가능한 한 적은 batchUpdate로 보낸다.
+
+    - GAS 미사용: documents().get 1회 + batchUpdate 1회
+    - GAS 사용: 토큰 제거만 GAS 이후로 분리(batchUpdate 2회)
+    stats에 문서별 API 호출/요청 수를 기록한다.
+    """
+
+    def __init__(self, doc_id: str):
+        self.doc_id = doc_id
+        self._placeholders: Dict[str, str] = {}
+        self._pending = []  # (phase, seq, request)
+        self._seq = 0
+        self.stats = {"gets": 0, "batch_updates": 0, "requests": 0}
+
+    def _add(self, phase: int, reqs: list) -> None:
+        for r in reqs:
+            self._pending.append((phase, self._seq, r))
+            self._seq += 1
+
+    def ensure_placeholders(self, placeholders: Dict[str, str]) -> "DocsMutationPlan":
+        self._placeholders.update(placeholders)
+        return self
+
+    def replace_all(self, replace_map: Dict[str, str]) -> "DocsMutationPlan":
+        self._add(PHASE_REPLACE, _build_replace_all_requests(replace_map))
+        return self
+
+    def remove_debug_tokens(self) -> "DocsMutationPlan":
+        self._add(PHASE_CLEANUP, _build_replace_all_requests(DEBUG_TOKENS))
+        return self
+
+    def _resolve_placeholders(self, docs_service) -> None:
+        if not self._placeholders:
+            return
+        doc = execute_with_retry(
+            lambda: docs_service.documents().get(documentId=self.doc_id).execute(),
+            label="Docs Get",
+        )
+        self.stats["gets"] += 1
+        self._add(
+            PHASE_INSERT, _build_placeholder_insert_requests(doc, self._placeholders)
+        )
+        self._placeholders = {}
+
+    def flush(self, docs_service, max_phase: Optional[int] = None) -> int:
+        """max_phase 이하 단계의 요청을 batchUpdate 1회로 전송. 보낸 요청 수 반환."""
+        self._resolve_placeholders(docs_service)
+
+        ready, later = [], []
+        for p in self._pending:
+            (ready if max_phase is None or p[0] <= max_phase else later).append(p)
+        self._pending = later
+        if not ready:
+            return 0
+
+        reqs = [r for _, _, r in sorted(ready, key=lambda p: (p[0], p[1]))]
+        execute_with_retry(
+            lambda: docs_service.documents()
+            .batchUpdate(documentId=self.doc_id, body={"requests": reqs})
+            .execute(),
+            label="Docs BatchUpdate",
+        )
+        self.stats["batch_updates"] += 1
+        self.stats["requests"] += len(reqs)
+        return len(reqs)
+
+    def commit(self, docs_service) -> dict:
+        """남은 요청을 모두 보내고 통계 반환."""
+        self.flush(docs_service)
+        return dict(self.stats, doc_id=self.doc_id)
+
+
+# =========================================================
+# 6) Gemini 생성
+# =========================================================
+
+
+@process_singleton
+def get_gemini_client() -> "genai.Client":
+    if not GEMINI_API_KEY:
+        raise RuntimeError("GEMINI_API_KEY 설정이 없습니다.")
+    return genai.Client(api_key=GEMINI_API_KEY)
+
+
+def _usage_meta(resp) -> dict:
+    usage = getattr(resp, "usage_metadata", None)
+    cands = getattr(resp, "candidates", None) or []
+    finish = getattr(cands[0], "finish_reason", None) if cands else None
+    return {
+        "output_tokens": getattr(usage, "candidates_token_count", None) or 0,
+        "thinking_tokens": getattr(usage, "thoughts_token_count", None) or 0,
+        "finish_reason": str(getattr(finish, "name", finish) or ""),
+    }
+
+
+class GeminiEmptyResponse(RuntimeError):
+    """본문 없이 끝난 응답. MAX_TOKENS면 thinking이 상한을 다 쓴 것."""
+
+    def __init__(self, finish_reason: str):
+        super().__init__(f"Gemini 실패: 응답이 비었습니다({finish_reason or '?'})")
+        self.finish_reason = finish_reason
+
+
+def gemini_generate_with_meta(
+    model: str,
+    prompt: str,
+    pdf_bytes: Optional[bytes],
+    max_retries: int = 6,
+    max_output_tokens: Optional[int] = None,
+    profile: Optional["GenerationProfile"] = None,
+    response_schema: Optional[dict] = None,
+) -> Tuple[str, dict]:
+    """
+    생성 텍스트와 함께 사용량/소요시간(meta)을 돌려준다.
+    profile이 없으면 기본 설정, max_output_tokens를 주면 profile의 상한보다 우선.
+    response_schema를 주면 JSON으로 받는다(텍스트는 JSON 문자열).
+    """
+    contents = [prompt]
+    if pdf_bytes:
+        pdf_part = types.Part.from_bytes(data=pdf_bytes, mime_type="application/pdf")
+        contents.append(pdf_part)
+
+    profile = profile or GenerationProfile()
+    if max_output_tokens is None:
+        max_output_tokens = profile.output_cap(model)
+    cfg = profile.config(model, max_output_tokens, response_schema)
+
+    breaker = get_circuit_breaker(f"gemini:{model}")
+    last_err = None
+    for attempt in range(max_retries):
+        check_deadline(f"Gemini {model}")
+        breaker.before_call()
+        try:
+            t0 = time.time()
+            deadline = current_deadline()
+            if deadline:
+                # 남은 시간보다 오래 기다리지 않도록 이번 호출의 타임아웃 지정
+                cfg = profile.config(
+                    model,
+                    max_output_tokens,
+                    response_schema,
+                    timeout_s=clamp_timeout(deadline.remaining()),
+                )
+            try:
+                resp = get_gemini_client().models.generate_content(
+                    model=model, contents=contents, config=cfg
+                )
+            except Exception as e:
+                if _is_retryable_gemini_error(e):
+                    breaker.record_failure(e)
+                else:
+                    breaker.release()
+                raise
+            breaker.record_success()
+            text = (resp.text or "").strip()
+            meta = _usage_meta(resp)
+            if not text:
+                raise GeminiEmptyResponse(meta["finish_reason"])
+            meta.update(
+                latency_s=time.time() - t0,
+                max_output_tokens=max_output_tokens,
+                profile=profile.name,
+                thinking_budget=profile.thinking_budget_for(model),
+            )
+            return text, meta
+        except GeminiEmptyResponse:
+            raise  # 같은 설정으로 다시 불러도 같음 → 상한을 정한 쪽에서 처리
+        except Exception as e:
+            last_err = e
+            if (
+                _is_retryable_gemini_error(e)
+                and breaker.state != "open"
+                and attempt < max_retries - 1
+            ):
+                notify("warning", f"⚠️ Gemini 재시도 ({attempt+1}/{max_retries})")
+                _sleep_backoff(attempt)
+                continue
+            raise RuntimeError(f"Gemini 실패: {e}") from e
+
+    raise RuntimeError(f"Gemini 실패(최종): {last_err}")
+
+
+def gemini_generate_text_with_retry(
+    model: str,
+    prompt: str,
+    pdf_bytes: Optional[bytes],
+    max_retries: int = 6,
+    profile: Optional["GenerationProfile"] = None,
+) -> str:
+    return gemini_generate_with_meta(
+        model, prompt, pdf_bytes, max_retries, profile=profile
+    )[0]
+
+
+# =========================================================
+# 6-1) Gemini 생성 프로필 (단계별 thinking/상한/temperature)
+# =========================================================
+# 2.5 모델은 thinking 토큰이 보이지 않는 지연/비용의 대부분을 차지한다.
+# 프리셋마다 단계별 설정을 두고, 관리자가 벤치마크로 비교해 고른다.
+#   thinking_budget: None=모델 기본(동적), 0=끔(flash만 가능), N=최대 N토큰
+# max_output_tokens는 thinking 토큰을 포함한 상한이다.
+
+PRO_MIN_THINKING_BUDGET = 128  # pro 모델은 thinking을 끌 수 없음
+
+
+class GenerationProfile:
+    """단계 1개의 생성 설정."""
+
+    def __init__(
+        self,
+        name: str = "기본",
+        temperature: float = 0.35,
+        max_output_tokens: Optional[int] = None,
+        thinking_budget: Optional[int] = None,
+    ):
+        self.name = name
+        self.temperature = temperature
+        self.max_output_tokens = max_output_tokens
+        self.thinking_budget = thinking_budget
+
+    def output_cap(self, model: str) -> int:
+        if self.max_output_tokens:
+            return self.max_output_tokens
+        return 8192 if model.endswith("pro") else 4096
+
+    def thinking_budget_for(self, model: str) -> Optional[int]:
+        if self.thinking_budget is None:
+            return None
+        if model.endswith("pro"):
+            return max(PRO_MIN_THINKING_BUDGET, self.thinking_budget)
+        return self.thinking_budget
+
+    def config(
+        self,
+        model: str,
+        max_output_tokens: Optional[int] = None,
+        response_schema: Optional[dict] = None,
+        timeout_s: Optional[float] = None,
+    ) -> "types.GenerateContentConfig":
+        kwargs = {
+            "temperature": self.temperature,
+            "max_output_tokens": max_output_tokens or self.output_cap(model),
+        }
+        if response_schema:
+            kwargs["response_mime_type"] = "application/json"
+            kwargs["response_schema"] = response_schema
+        budget = self.thinking_budget_for(model)
+        if budget is not None:
+            kwargs["thinking_config"] = types.ThinkingConfig(thinking_budget=budget)
+        if timeout_s:
+            kwargs["http_options"] = types.HttpOptions(timeout=int(timeout_s * 1000))
+        return types.GenerateContentConfig(**kwargs)
+
+    def signature(self, model: str) -> str:
+        """캐시 키용: 출력에 영향을 주는 설정을 모두 담는다."""
+        return (
+            f"{self.name}|{model}|{self.temperature}|{self.output_cap(model)}"
+            f"|{self.thinking_budget_for(model)}"
+        )
+
+    def with_thinking_budget(self, budget: int) -> "GenerationProfile":
+        """같은 설정에 thinking 상한만 고정한 사본."""
+        return GenerationProfile(
+            self.name, self.temperature, self.max_output_tokens, budget
+        )
+
+    def describe(self) -> dict:
+        return {
+            "프로필": self.name,
+            "temperature": self.temperature,
+            "max_output_tokens": self.max_output_tokens or "모델 기본",
+            "thinking_budget": (
+                "모델 기본" if self.thinking_budget is None else self.thinking_budget
+            ),
+        }
+
+
+def _preset(name: str, **stages) -> Dict[str, GenerationProfile]:
+    return {
+        stage: GenerationProfile(f"{name}/{stage}", **kwargs)
+        for stage, kwargs in stages.items()
+    }
+
+
+GENERATION_PRESETS = {
+    # 기존 동작 그대로(thinking은 모델이 알아서)
+    "기본": _preset("기본", stage1={}, continuation={}, stage2={}, stage3={}),
+    "균형": _preset(
+        "균형",
+        stage1={"thinking_budget": 4096, "max_output_tokens": 16384},
+        continuation={"thinking_budget": 2048, "max_output_tokens": 12288},
+        stage2={"thinking_budget": 512, "max_output_tokens": 4096},
+        stage3={"thinking_budget": 2048},
+    ),
+    "빠름": _preset(
+        "빠름",
+        stage1={"thinking_budget": 1024, "max_output_tokens": 12288},
+        continuation={"thinking_budget": 512, "max_output_tokens": 10240},
+        stage2={"thinking_budget": 0, "max_output_tokens": 4096},
+        stage3={"thinking_budget": 512},
+    ),
+}
+GENERATION_PRESET_DEFAULT = "기본"
+
+
+_generation_preset = contextvars.ContextVar("generation_preset", default=None)
+
+
+@contextmanager
+def use_generation_preset(name: Optional[str]):
+    """이 안에서의 생성은 name 프리셋 사용(None이면 설정 기본값)."""
+    token = _generation_preset.set(name)
+    try:
+        yield
+    finally:
+        _generation_preset.reset(token)
+
+
+def active_generation_preset() -> str:
+    name = _generation_preset.get() or GENERATION_PRESET_DEFAULT
+    return name if name in GENERATION_PRESETS else "기본"
+
+
+def stage_profile(stage: str, preset: Optional[str] = None) -> GenerationProfile:
+    return GENERATION_PRESETS[preset or active_generation_preset()][stage]
+
+
+def benchmark_generation_presets(
+    pdf_bytes: bytes, student_name: str, notes: str, presets: list, on_row=None
+) -> list:
+    """
+    같은 입력으로 프리셋별 1단계(PDF 포함)와 2단계를 순서대로 생성해 비교한다.
+    완결도는 이어쓰기 없이 1단계 한 번에 나온 필수 목차 수.
+    동시에 돌리면 서로의 지연에 영향을 주므로 순차 실행.
+    """
+    rows = []
+
+    def add(preset: str, stage: str, model: str, text: str, meta: dict, extra=None):
+        row = {
+            "프리셋": preset,
+            "단계": stage,
+            "모델": model,
+            "지연(초)": round(meta["latency_s"], 1),
+            "출력 토큰": meta["output_tokens"],
+            "thinking 토큰": meta["thinking_tokens"],
+            "thinking 예산": meta["thinking_budget"],
+            "종료 사유": meta["finish_reason"],
+            "바이트": len(text.encode("utf-8")),
+        }
+        row.update(extra or {})
+        rows.append(row)
+        if on_row:
+            on_row(row)
+
+    total = len(REPORT_REQUIRED_SECTIONS)
+    for preset in presets:
+        p1 = build_stage1_prompt(student_name, notes)
+        report, meta = gemini_generate_with_meta(
+            MODEL_REPORT, p1, pdf_bytes, profile=stage_profile("stage1", preset)
+        )
+        done = total - len(missing_report_sections(report))
+        add(
+            preset,
+            "1단계",
+            MODEL_REPORT,
+            report,
+            meta,
+            {"완결 목차": f"{done}/{total}"},
+        )
+
+        p2 = build_stage2_prompt(sanitize_numbered_lists(report))
+        summary, meta = gemini_generate_with_meta(
+            MODEL_SUMMARY, p2, None, profile=stage_profile("stage2", preset)
+        )
+        add(preset, "2단계", MODEL_SUMMARY, summary, meta)
+    return rows
+
+
+def fastest_complete_preset(rows: list) -> Optional[str]:
+    """1단계가 목차를 모두 채운 프리셋 중 1+2단계 합계 지연이 가장 짧은 것."""
+    total = len(REPORT_REQUIRED_SECTIONS)
+    complete = {
+        r["프리셋"]
+        for r in rows
+        if r["단계"] == "1단계" and r.get("완결 목차") == f"{total}/{total}"
+    }
+    latency = {}
+    for r in rows:
+        if r["프리셋"] in complete:
+            latency[r["프리셋"]] = latency.get(r["프리셋"], 0.0) + r["지연(초)"]
+    return min(latency, key=latency.get) if latency else None
+
+
+# =========================================================
+# 7) 본문 숫자목록 방지(후처리) — 헤딩 보호
+# =========================================================
+
+_HEADING_RE = re.compile(r"^\d+(-\d+){0,2}\.\s+\S+")
+_NUMBERED_RE = re.compile(r"^\d+\.\s+")
+# 문장 끝: 마침표/물음표/느낌표(+닫는 따옴표·괄호) 뒤에 공백이 오거나 글이 끝나는 자리
+_SENTENCE_END_RE = re.compile(r"[.!?…][\"'”’)\]]*(?=\s|$)")
+
+
+def _last_sentence_end(line: str, end_is_boundary: bool = True) -> int:
+    """
+    line 안 마지막 문장 끝 위치(없으면 -1).
+    end_is_boundary=False면 줄 맨 끝은 문장 끝으로 보지 않는다(바이트 한도에서 잘려
+    원문에서는 "3.14"처럼 바로 다음 글자가 이어지는 경우).
+    """
+    end = -1
+    for m in _SENTENCE_END_RE.finditer(line):
+        if end_is_boundary or m.end() < len(line):
+            end = m.end()
+    return end
+
+
+def _drop_trailing_blank_lines(text: str) -> str:
+    lines = text.split("\n")
+    while lines and not lines[-1].strip():
+        lines.pop()
+    return "\n".join(lines)
+
+
+def cut_at_sentence_boundary(text: str, end_is_boundary: bool = True) -> str:
+    """
+    잘린 텍스트의 마지막 줄을 문장 끝에서 마무리한다(이미 문장으로 끝나면 그대로).
+    마지막 줄에 완결 문장이 없으면 그 줄을 버리고, 줄이 하나뿐이면 그대로 둔다.
+    """
+    start = text.rfind("\n") + 1
+    end = _last_sentence_end(text[start:], end_is_boundary)
+    if end >= 0:
+        return text[: start + end]
+    if start > 0:
+        return _drop_trailing_blank_lines(text[:start])
+    return text
+
+
+def is_heading_line(line: str) -> bool:
+    s = line.strip()
+    if not s[:1].isdigit() or not _HEADING_RE.match(s):
+        return False
+    if len(s) > 40:
+        return False
+    if s.endswith(("다.", "요.", ".")):
+        return False
+    return True
+
+
+@functools.lru_cache(maxsize=None)
+def _token_pattern(strip_tokens: tuple) -> Optional[re.Pattern]:
+    """토큰 목록 → 미리 컴파일한 정규식(같은 목록이면 재사용)."""
+    tokens = sorted((t for t in strip_tokens if t), key=len, reverse=True)
+    return re.compile("|".join(map(re.escape, tokens))) if tokens else None
+
+
+class TextPostProcessor:
+    """
+    생성 결과 후처리를 한 번의 순회로 적용한다(정규식은 미리 컴파일).
+      1) 분량 자르기(max_utf8_bytes, UTF-8 바이트 기준. sentence_aware면 문장 끝에서)
+      2) 헤딩 보호: "1. 제목" / "1-1. 제목" 줄은 그대로(공백만 정리)
+      3) 본문 숫자목록 "1. 내용" → "- 내용"
+      4) 토큰 제거(strip_tokens)
+    process()는 문자열 전체, feed()/finish()는 스트리밍 조각용이며 결과는 같다.
+    timing=True면 규칙별 소요 시간(초)을 timings에 누적한다.
+    스트림/통계 상태를 가지므로 스레드 간에 공유하지 말고 호출마다 새로 만든다
+    (정규식은 모듈 수준에서 공유되므로 만드는 비용은 작다).
+    """
+
+    def __init__(
+        self,
+        max_utf8_bytes: Optional[int] = None,
+        strip_tokens=(),
+        timing: bool = False,
+        sentence_aware: bool = False,
+    ):
+        self.max_utf8_bytes = max_utf8_bytes
+        self.sentence_aware = sentence_aware
+        self.trimmed_bytes = 0  # 마지막 처리에서 잘려 나간 바이트 수
+        self._token_re = _token_pattern(tuple(strip_tokens))
+        self.timing = timing
+        self.timings = {"trim": 0.0, "heading": 0.0, "numbered": 0.0, "tokens": 0.0}
+        self._reset_stream()
+
+    # ---- 줄 단위 규칙 ----
+    def _line(self, line: str, strip_tokens: bool = True) -> str:
+        if self.timing:
+            return self._line_timed(line)
+        stripped = line.strip()
+        if stripped[:1].isdigit():
+            # ✅ 헤더는 무조건 보호
+            if is_heading_line(stripped):
+                line = stripped
+            # ❌ 일반 숫자 목록만 변환
+            elif _NUMBERED_RE.match(stripped):
+                line = f"- {stripped.split('.', 1)[1].strip()}"
+        if strip_tokens and self._token_re is not None:
+            line = self._token_re.sub("", line)
+        return line
+
+    def _line_timed(self, line: str) -> str:
+        t0 = time.perf_counter()
+        stripped = line.strip()
+        heading = stripped[:1].isdigit() and is_heading_line(stripped)
+        t1 = time.perf_counter()
+        self.timings["heading"] += t1 - t0
+        if heading:
+            line = stripped
+        elif stripped[:1].isdigit() and _NUMBERED_RE.match(stripped):
+            line = f"- {stripped.split('.', 1)[1].strip()}"
+        t2 = time.perf_counter()
+        self.timings["numbered"] += t2 - t1
+        if self._token_re is not None:
+            line = self._token_re.sub("", line)
+            self.timings["tokens"] += time.perf_counter() - t2
+        return line
+
+    def _trim(self, text: str) -> str:
+        t0 = time.perf_counter()
+        t = (text or "").strip()
+        b = t.encode("utf-8")  # 인코딩은 1회만
+        self.trimmed_bytes = 0
+        if len(b) > self.max_utf8_bytes:
+            cut = b[: self.max_utf8_bytes].decode("utf-8", errors="ignore")
+            # 잘린 자리 바로 뒤가 공백이어야 맨 끝 "다."를 문장 끝으로 인정
+            at_space = not t[len(cut) : len(cut) + 1].strip()
+            t = cut.strip()
+            if self.sentence_aware:
+                t = cut_at_sentence_boundary(t, at_space)
+            self.trimmed_bytes = len(b) - len(t.encode("utf-8"))
+        if self.timing:
+            self.timings["trim"] += time.perf_counter() - t0
+        return t
+
+    # ---- 문자열 전체 ----
+    def process(self, text: str) -> str:
+        if self.max_utf8_bytes is not None:
+            text = self._trim(text)
+            if not text:
+                return text
+        if self.timing or self._token_re is None:
+            return "\n".join(self._line(line) for line in text.splitlines())
+        # 토큰에는 줄바꿈이 없으므로 줄 규칙 뒤 전체에 1번만 적용해도 결과가 같다
+        out = "\n".join(self._line(line, False) for line in text.splitlines())
+        return self._token_re.sub("", out)
+
+    # ---- 스트리밍 ----
+    def _reset_stream(self) -> None:
+        self._started = False  # 앞쪽 공백을 지났는지(자르기 사용 시)
+        self._held_ws = ""  # 뒤쪽 공백일 수도 있어 보류 중인 공백
+        self._used_bytes = 0
+        self._cut = False
+        self._cut_at_space = True  # 잘린 자리 바로 뒤가 공백이었는지
+        self._line_buf = ""
+        self._emitted = False
+        self._held_blank = []  # 끝 빈 줄일 수도 있어 보류 중인 공백 줄
+        self._cut_done = False  # 문장 단위 자르기를 마쳤는지
+
+    def _trim_stream(self, chunk: str) -> str:
+        """자르기 규칙의 스트리밍 버전: 앞뒤 공백 제거 + 바이트 한도."""
+        if self.max_utf8_bytes is None:
+            return chunk
+        if self._cut:
+            return ""
+        if not self._started:
+            chunk = chunk.lstrip()
+            if not chunk:
+                return ""
+            self._started = True
+
+        body = chunk.rstrip()
+        tail_ws = chunk[len(body) :]
+        if not body:
+            self._held_ws += tail_ws
+            return ""
+
+        piece = self._held_ws + body
+        piece_b = piece.encode("utf-8")
+        remaining = self.max_utf8_bytes - self._used_bytes
+        if len(piece_b) > remaining:
+            self._cut = True
+            cut = piece_b[:remaining].decode("utf-8", errors="ignore")
+            self._cut_at_space = not piece[len(cut) : len(cut) + 1].strip()
+            cut = cut.rstrip()
+            self._used_bytes += len(cut.encode("utf-8"))
+            self._held_ws = ""
+            return cut
+
+        self._used_bytes += len(piece_b)
+        self._held_ws = tail_ws
+        return piece
+
+    def _emit_lines(self, lines) -> str:
+        out = []
+        for line in lines:
+            if self.sentence_aware and not line.strip():
+                # 문장 단위로 자르면 끝의 빈 줄은 버려지므로 다음 내용이 올 때까지 보류
+                self._held_blank.append(line)
+                continue
+            for held in self._held_blank + [line]:
+                out.append(("\n" if self._emitted else "") + self._line(held))
+                self._emitted = True
+            self._held_blank = []
+        return "".join(out)
+
+    def feed(self, chunk: str) -> str:
+        """조각을 넣으면 완성된 줄까지의 처리 결과를 돌려준다."""
+        self._line_buf += self._trim_stream(chunk)
+        *done, self._line_buf = self._line_buf.split("\n")
+        lines = []
+        for seg in done:
+            lines.extend(seg.splitlines() or [""])
+        out = self._emit_lines(lines)
+        if self._cut and self.sentence_aware and not self._cut_done:
+            # 한도에 닿은 마지막 줄만 문장 끝에서 마무리(이미 내보낸 줄은 그대로)
+            self._cut_done = True
+            end = _last_sentence_end(self._line_buf, self._cut_at_space)
+            if end >= 0:
+                self._line_buf = self._line_buf[:end]
+            elif self._emitted or self._held_blank:
+                self._line_buf = ""
+                self._held_blank = []
+        return out
+
+    def finish(self) -> str:
+        """남은 조각을 처리하고 스트림 상태를 초기화."""
+        rest = self._line_buf.splitlines() if self._line_buf else []
+        out = self._emit_lines(rest)
+        if self._held_blank and not self._cut:
+            self._held_blank, held = [], self._held_blank
+            out += "".join(
+                ("\n" if i or self._emitted else "") + self._line(h)
+                for i, h in enumerate(held)
+            )
+        self._reset_stream()
+        return out
+
+
+def sanitize_numbered_lists(text: str) -> str:
+    return TextPostProcessor().process(text)
+
+
+def clean_generated_text(text: str) -> str:
+    """숫자목록 정리 + 디버그 토큰 제거(화면 표시/문서 부분 교체용)."""
+    return TextPostProcessor(strip_tokens=DEBUG_TOKENS).process(text)
+
+
+# =========================================================
+# 8) 담임조언 분량: 9000바이트 내에서 문장 완결 우선
+# =========================================================
+
+
+def trim_korean_text_safely(
+    text: str, max_utf8_bytes: int = 9000, sentence_aware: bool = True
+) -> str:
+    return TextPostProcessor(
+        max_utf8_bytes=max_utf8_bytes, sentence_aware=sentence_aware
+    )._trim(text)
+
+
+# =========================================================
+# 8-1) 분량 제어: 바이트 목표 → max_output_tokens
+# =========================================================
+# 목표 바이트를 '한국어 바이트/토큰' 실측값으로 토큰 상한으로 바꿔, 버려질 분량을
+# 애초에 생성하지 않게 한다. 실측값은 공유 상태 저장소에 지수이동평균으로 누적.
+
+STAGE3_TARGET_BYTES = 9000
+DEFAULT_KOREAN_BYTES_PER_TOKEN = 3.0  # 실측 전 기본값(보수적으로 낮게)
+LENGTH_HEADROOM = 1.15  # 목표보다 15% 여유 → 문장 끝에서 자를 여지
+DEFAULT_THINKING_ALLOWANCE = 4096  # 2.5 계열은 사고 토큰도 max_output_tokens에 포함
+LENGTH_EMA_ALPHA = 0.2
+
+
+class LengthController:
+    """바이트 목표 기반 토큰 상한 계산 + 실행별 절감량 기록."""
+
+    def __init__(self, state: SharedStateBackend, name: str = "stage3"):
+        self.state = state
+        self.key = f"length-control:{name}"
+
+    def stats(self) -> dict:
+        return self.state.cache_get(self.key) or {
+            "samples": 0,
+            "bytes_per_token": DEFAULT_KOREAN_BYTES_PER_TOKEN,
+            "thinking_tokens": 0.0,
+            "natural_output_tokens": 0.0,  # 상한에 안 걸리고 끝난 출력 길이
+            "tokens_per_sec": 0.0,
+        }
+
+    def budget(
+        self, target_bytes: int, model: str, profile: GenerationProfile
+    ) -> Tuple[int, GenerationProfile]:
+        """
+        (max_output_tokens, thinking 상한을 고정한 프로필).
+        thinking도 max_output_tokens에 포함되므로, 모델이 동적으로 정하게 두면
+        thinking이 늘어난 만큼 본문이 잘린다 → thinking 상한을 고정하고
+        본문 몫은 그와 따로 잡는다.
+        """
+        s = self.stats()
+        answer = math.ceil(target_bytes * LENGTH_HEADROOM / s["bytes_per_token"])
+        if profile.thinking_budget is None:
+            estimate = (
+                math.ceil(s["thinking_tokens"] * 1.5)
+                if s["samples"]
+                else DEFAULT_THINKING_ALLOWANCE
+            )
+            profile = profile.with_thinking_budget(estimate)
+        thinking = profile.thinking_budget_for(model) or 0
+        cap = int(min(65536, max(1024, answer) + thinking))
+        return cap, profile
+
+    def record(self, raw_text: str, meta: dict, trimmed_bytes: int) -> dict:
+        """실측값 갱신 후 이번 실행의 분량 제어 결과를 반환."""
+
+        def ema(old: float, new: float) -> float:
+            return new if not old else old + LENGTH_EMA_ALPHA * (new - old)
+
+        out_tokens = meta.get("output_tokens") or 0
+        capped = meta.get("finish_reason") == "MAX_TOKENS"
+        latency = meta.get("latency_s") or 0.0
+
+        with self.state.lock(self.key):
+            s = self.stats()
+            if out_tokens:
+                bpt = len(raw_text.encode("utf-8")) / out_tokens
+                s["bytes_per_token"] = ema(s["bytes_per_token"], bpt)
+                if latency:
+                    s["tokens_per_sec"] = ema(s["tokens_per_sec"], out_tokens / latency)
+                if not capped:
+                    s["natural_output_tokens"] = ema(
+                        s["natural_output_tokens"], out_tokens
+                    )
+            s["thinking_tokens"] = ema(
+                s["thinking_tokens"], meta.get("thinking_tokens") or 0
+            )
+            s["samples"] += 1
+            self.state.cache_set(self.key, s)
+
+        # 상한에 걸려 멈췄다면, 평소(자연 종료) 길이와의 차이만큼 생성을 아낀 것으로 추정
+        saved = max(0.0, s["natural_output_tokens"] - out_tokens) if capped else 0.0
+        return {
+            "max_output_tokens": meta.get("max_output_tokens"),
+            "output_tokens": out_tokens,
+            "thinking_tokens": meta.get("thinking_tokens") or 0,
+            "trimmed_bytes": trimmed_bytes,
+            "wasted_tokens_est": round(trimmed_bytes / s["bytes_per_token"]),
+            "saved_tokens_est": round(saved),
+            "saved_seconds_est": (
+                round(saved / s["tokens_per_sec"], 1) if s["tokens_per_sec"] else 0.0
+            ),
+            "latency_s": round(latency, 1),
+        }
+
+
+def generate_with_length_control(
+    model: str,
+    prompt: str,
+    target_bytes: int,
+    state: SharedStateBackend,
+    profile: Optional[GenerationProfile] = None,
+) -> Tuple[str, dict]:
+    """상한을 목표 바이트에서 계산해 생성하고, 문장 끝에서 마무리한다."""
+    profile = profile or stage_profile("stage3")
+    controller = length_controller(state, profile)
+    cap, pinned = controller.budget(target_bytes, model, profile)
+    try:
+        raw, meta = gemini_generate_with_meta(
+            model, prompt, None, max_output_tokens=cap, profile=pinned
+        )
+    except GeminiEmptyResponse as e:
+        if e.finish_reason != "MAX_TOKENS":
+            raise
+        raw, meta = _generate_without_length_cap(model, prompt, profile)
+    return finish_length_controlled(raw, meta, target_bytes, controller)
+
+
+def _generate_without_length_cap(
+    model: str, prompt: str, profile: GenerationProfile
+) -> Tuple[str, dict]:
+    """상한 안에서 본문이 하나도 안 나왔을 때 — 프리셋 그대로의 상한으로 1번만 다시."""
+    notify("warning", "⚠️ 3단계가 분량 상한에서 본문 없이 끝나 기본 상한으로 재시도")
+    return gemini_generate_with_meta(model, prompt, None, profile=profile)
+
+
+def length_controller(
+    state: SharedStateBackend, profile: GenerationProfile
+) -> LengthController:
+    # thinking 토큰 추정치는 프로필마다 다르므로 따로 학습.
+    # 기본 프리셋은 프리셋 도입 전 키를 그대로 써서 쌓인 통계를 잇는다
+    if profile.name == "기본/stage3":
+        return LengthController(state)
+    return LengthController(state, profile.name.replace("/", ":"))
+
+
+def finish_length_controlled(
+    raw: str, meta: dict, target_bytes: int, controller: LengthController
+) -> Tuple[str, dict]:
+    """생성 결과를 목표 바이트 안에서 문장 끝으로 마무리 + 실측값 기록."""
+    pp = TextPostProcessor(max_utf8_bytes=target_bytes, sentence_aware=True)
+    text = pp.process(raw)
+    if meta.get("finish_reason") == "MAX_TOKENS":
+        # 상한에서 끊긴 경우(목표 이하라도) 마지막 문장이 미완결이면 완결된 곳까지로
+        cut = cut_at_sentence_boundary(text)
+        pp.trimmed_bytes += len(text.encode("utf-8")) - len(cut.encode("utf-8"))
+        text = cut
+    return text, controller.record(raw, meta, pp.trimmed_bytes)
+
+
+# =========================================================
+# 9) 프롬프트
+# =========================================================
+
+
+PROMPTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "prompts")
+PROMPT_FILES = {
+    "stage1": "stage1_report.txt",
+    "continuation": "continuation.txt",
+    "stage1_structured": "stage1_structured.txt",
+    "section": "section_regen.txt",
+    "section_rewrite": "section_rewrite.txt",
+    "stage2": "stage2_summary.txt",
+    "stage3": "stage3_homeroom.txt",
+}
+
+
+class PromptTemplate:
+    """
+    prompts/ 폴더의 템플릿 1개. `$이름` 자리에 값을 채운다(string.Template).
+    version = 파일 내용 해시 → 프롬프트를 고치면 해당 단계 캐시만 무효화.
+    """
+
+    def __init__(self, name: str, text: str):
+        self.name = name
+        self.text = text.strip()
+        self.version = hashlib.sha256(self.text.encode("utf-8")).hexdigest()[:12]
+        self._template = string.Template(self.text)
+
+    def render(self, **values) -> str:
+        return self._template.substitute(values)
+
+
+def _prompt_files_stamp(directory: str = PROMPTS_DIR) -> tuple:
+    """파일 수정시각 묶음 — 바뀌었을 때만 다시 읽는다(재배포 없이 반영)."""
+    return tuple(
+        (name, os.stat(os.path.join(directory, fname)).st_mtime_ns)
+        for name, fname in sorted(PROMPT_FILES.items())
+    )
+
+
+@functools.lru_cache(maxsize=8)
+def _load_prompt_templates(stamp: tuple, directory: str = PROMPTS_DIR) -> dict:
+    templates = {}
+    for name, fname in PROMPT_FILES.items():
+        with open(os.path.join(directory, fname), encoding="utf-8") as f:
+            templates[name] = PromptTemplate(name, f.read())
+    return templates
+
+
+def get_prompt_templates() -> Dict[str, PromptTemplate]:
+    return _load_prompt_templates(_prompt_files_stamp())
+
+
+def prompt_versions(preset: Optional[str] = None) -> Dict[str, str]:
+    """
+    단계별 캐시 키용 버전. 앞 단계 출력이 뒤 단계 입력이므로 앞 버전을 이어 붙인다.
+    (1단계 프롬프트를 고치면 요약/지도방침도 다시, 3단계만 고치면 3단계만 다시)
+    생성 프리셋/모델도 포함 — 프리셋을 바꾸면 다른 프리셋의 결과를 재사용하지 않음
+    """
+    t = get_prompt_templates()
+    profile = GENERATION_PRESETS[preset or active_generation_preset()]
+
+    def chain(*parts: str) -> str:
+        return hashlib.sha256(":".join(parts).encode("utf-8")).hexdigest()[:12]
+
+    if STRUCTURED_REPORT:
+        report = chain(
+            t["stage1"].version,
+            t["stage1_structured"].version,
+            t["section"].version,
+            "json",
+            profile["stage1"].signature(MODEL_REPORT),
+            profile["continuation"].signature(MODEL_REPORT),
+        )
+    else:
+        report = chain(
+            t["stage1"].version,
+            t["continuation"].version,
+            profile["stage1"].signature(MODEL_REPORT),
+            profile["continuation"].signature(MODEL_REPORT),
+        )
+    summary = chain(
+        report, t["stage2"].version, profile["stage2"].signature(MODEL_SUMMARY)
+    )
+    homeroom = chain(
+        summary, t["stage3"].version, profile["stage3"].signature(MODEL_GUIDE)
+    )
+    return {"report": report, "summary": summary, "homeroom": homeroom}
+
+
+def build_stage1_prompt(student_name: str, notes: str) -> str:
+    notes_block = notes.strip() if notes.strip() else "(담임 메모 없음)"
+    return get_prompt_templates()["stage1"].render(
+        student_name=student_name, notes_block=notes_block
+    )
+
+
+REPORT_REQUIRED_SECTIONS = [
+    "1. 학생을 위한 한마디",
+    "2. 컨설팅 종합 분석",
+    "3. 대학 전공 추천",
+    "4. 1학년 활동 문제점 및 보완 전략",
+    "5. 추천 도서",
+    "6-1. 창의적 체험활동#1 자율활동",
+    "6-2. 창의적 체험활동#2 진로활동",
+    "6-3. 창의적 체험활동#3 동아리활동",
+    "6-4. 창의적 체험활동#4 봉사활동",
+    "7. 2학년 교과별 전략",
+    "8. 인성 및 행동특성 종합 의견",
+]
+
+
+def missing_report_sections(report_md: str) -> list:
+    return [s for s in REPORT_REQUIRED_SECTIONS if s not in report_md]
+
+
+def ensure_report_complete(
+    report_md: str, student_name: str, profile: Optional[GenerationProfile] = None
+) -> str:
+    missing = missing_report_sections(report_md)
+    if not missing:
+        return report_md
+
+    prompt = get_prompt_templates()["continuation"].render(
+        missing=", ".join(missing), report_md=report_md
+    )
+
+    continuation = gemini_generate_text_with_retry(
+        MODEL_REPORT, prompt, None, profile=profile or stage_profile("continuation")
+    )
+
+    return report_md.strip() + "\n\n" + continuation.strip()
+
+
+# =========================================================
+# 9-1) 1단계 구조화 출력(선택) — 목차별 JSON 필드
+# =========================================================
+# STRUCTURED_REPORT=true면 1단계를 response_schema(JSON)로 받는다.
+#   - 완결성 검사는 빈 필드 확인으로 끝(문자열 검색 없음)
+#   - 빠진 목차는 그 목차만 따로 생성(보고서 전체 이어쓰기 없음)
+#   - 문서/화면용 텍스트는 파싱된 객체에서 만든다(헤딩/[[HR]] 위치가 항상 정확)
+
+STRUCTURED_REPORT = False
+
+# (필드 키, 문서에 쓰는 목차 제목, 상위 헤딩 — 같은 상위의 첫 목차 앞에만 출력)
+REPORT_SECTIONS = [
+    ("message", "1. 학생을 위한 한마디", ""),
+    ("analysis", "2. 컨설팅 종합 분석", ""),
+    ("majors", "3. 대학 전공 추천", ""),
+    ("first_year", "4. 1학년 활동 문제점 및 보완 전략", ""),
+    ("books", "5. 추천 도서", ""),
+    ("autonomy", "6-1. 창의적 체험활동#1 자율활동", "6. 창체 영역별 상세 컨설팅"),
+    ("career", "6-2. 창의적 체험활동#2 진로활동", "6. 창체 영역별 상세 컨설팅"),
+    ("club", "6-3. 창의적 체험활동#3 동아리활동", "6. 창체 영역별 상세 컨설팅"),
+    ("volunteer", "6-4. 창의적 체험활동#4 봉사활동", "6. 창체 영역별 상세 컨설팅"),
+    ("subjects", "7. 2학년 교과별 전략 / 수업 태도 개선 전략", ""),
+    ("character", "8. 인성 및 행동특성 종합 의견", ""),
+]
+
+
+def report_response_schema() -> dict:
+    keys = [key for key, _, _ in REPORT_SECTIONS]
+    return {
+        "type": "OBJECT",
+        "properties": {
+            key: {"type": "STRING", "description": heading}
+            for key, heading, _ in REPORT_SECTIONS
+        },
+        "required": keys,
+        "propertyOrdering": keys,
+    }
+
+
+def parse_report_sections(raw: str) -> Dict[str, str]:
+    """
+    JSON 응답 → {키: 본문}. 상한에 걸려 JSON이 잘렸으면
+    온전히 닫힌 필드만 건진다(나머지는 빠진 목차로 처리).
+    """
+    try:
+        data = json.loads(raw)
+    except ValueError:
+        data = {}
+        decoder = json.JSONDecoder()
+        for key, _, _ in REPORT_SECTIONS:
+            m = re.search(r'"%s"\s*:\s*' % re.escape(key), raw)
+            if not m:
+                continue
+            try:
+                data[key], _ = decoder.raw_decode(raw, m.end())
+            except ValueError:
+                pass
+    if not isinstance(data, dict):
+        data = {}
+    return {key: str(data.get(key) or "").strip() for key, _, _ in REPORT_SECTIONS}
+
+
+def missing_report_section_keys(sections: Dict[str, str]) -> list:
+    return [key for key, _, _ in REPORT_SECTIONS if not sections.get(key)]
+
+
+def render_report_sections(sections: Dict[str, str]) -> str:
+    """목차 제목 + 본문, 상위 헤딩(1. 단위)이 끝날 때마다 [[HR]]."""
+    blocks = []
+    for i, (key, heading, parent) in enumerate(REPORT_SECTIONS):
+        prev_parent = REPORT_SECTIONS[i - 1][2] if i else None
+        next_parent = (
+            REPORT_SECTIONS[i + 1][2] if i + 1 < len(REPORT_SECTIONS) else None
+        )
+        if parent and parent != prev_parent:
+            blocks.append(parent)
+        blocks.append(heading)
+        if sections.get(key):
+            blocks.append(sections[key])
+        if not parent or parent != next_parent:
+            blocks.append("[[HR]]")
+    return "\n\n".join(blocks)
+
+
+def generate_section(
+    heading: str,
+    sections: Dict[str, str],
+    stage1_prompt: str,
+    pdf_bytes: Optional[bytes],
+    profile: Optional[GenerationProfile] = None,
+) -> str:
+    written = render_report_sections({k: v for k, v in sections.items() if v}).replace(
+        "[[HR]]", ""
+    )
+    prompt = get_prompt_templates()["section"].render(
+        heading=heading, written=written.strip(), stage1_prompt=stage1_prompt
+    )
+    text = gemini_generate_text_with_retry(
+        MODEL_REPORT,
+        prompt,
+        pdf_bytes,
+        profile=profile or stage_profile("continuation"),
+    )
+    return _strip_heading_line(text, heading)
+
+
+def _strip_heading_line(text: str, heading: str) -> str:
+    # 모델이 지시와 달리 제목 줄을 다시 쓴 경우 제거
+    lines = text.strip().splitlines()
+    if lines and lines[0].strip().rstrip(":") == heading:
+        lines = lines[1:]
+    return "\n".join(lines).strip()
+
+
+def generate_structured_report(
+    student_name: str,
+    notes: str,
+    pdf_bytes: Optional[bytes],
+    profile: Optional[GenerationProfile] = None,
+) -> Tuple[Dict[str, str], dict]:
+    """
+    1단계를 JSON으로 생성 → 빠진 목차만 개별 생성.
+    반환: (목차별 본문, {"missing_after_first": [...], "regenerated": n})
+    """
+    stage1_prompt, prompt = build_structured_stage1_prompt(student_name, notes)
+    raw, _ = gemini_generate_with_meta(
+        MODEL_REPORT,
+        prompt,
+        pdf_bytes,
+        profile=profile or stage_profile("stage1"),
+        response_schema=report_response_schema(),
+    )
+    return finish_structured_report(raw, stage1_prompt, pdf_bytes)
+
+
+def build_structured_stage1_prompt(student_name: str, notes: str) -> Tuple[str, str]:
+    """반환: (1단계 작성 지침, JSON 출력 지시를 붙인 프롬프트)"""
+    stage1_prompt = build_stage1_prompt(student_name, notes)
+    section_list = "\n".join(
+        f"- {key}: {heading}" for key, heading, _ in REPORT_SECTIONS
+    )
+    prompt = (
+        stage1_prompt
+        + "\n\n\n"
+        + get_prompt_templates()["stage1_structured"].render(section_list=section_list)
+    )
+    return stage1_prompt, prompt
+
+
+def finish_structured_report(
+    raw: str, stage1_prompt: str, pdf_bytes: Optional[bytes]
+) -> Tuple[Dict[str, str], dict]:
+    """JSON 응답 → 목차별 본문. 빠진 목차만 개별 생성."""
+    sections = parse_report_sections(raw)
+    missing = missing_report_section_keys(sections)
+    headings = {key: heading for key, heading, _ in REPORT_SECTIONS}
+    for key in missing:
+        sections[key] = generate_section(
+            headings[key], sections, stage1_prompt, pdf_bytes
+        )
+    sections = {k: sanitize_numbered_lists(v) for k, v in sections.items()}
+    return sections, {"missing_after_first": missing, "regenerated": len(missing)}
+
+
+def build_stage2_prompt(report_md: str) -> str:
+    return get_prompt_templates()["stage2"].render(report_md=report_md)
+
+
+def build_stage3_homeroom_prompt(report_md: str, summary_md: str) -> str:
+    return get_prompt_templates()["stage3"].render(
+        report_md=report_md, summary_md=summary_md
+    )
+
+
+# =========================================================
+# 10) GAS 호출
+# =========================================================
+
+
+GAS_FORMAT_MAX_WORKERS = 2  # 동시에 GAS를 호출하는 최대 작업 수
+GAS_FORMAT_MAX_RETRIES = 3
+GAS_HTTP_TIMEOUT = (5, 60)  # (연결, 응답) 초 — 백그라운드라 응답 대기는 넉넉히
+
+
+def make_gas_http_session(pool_size: int = GAS_FORMAT_MAX_WORKERS) -> requests.Session:
+    """keep-alive 커넥션을 재사용하는 GAS 전용 세션(429/5xx 자동 재시도)."""
+    retry = Retry(
+        total=GAS_FORMAT_MAX_RETRIES,
+        backoff_factor=1.0,
+        status_forcelist=[429, 500, 502, 503, 504],
+        allowed_methods=frozenset(["GET"]),
+    )
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# GAS가 내려갔거나 응답하지 않을 때만 차단기 실패로 센다(잘못된 URL 등은 이쪽 설정 문제)
+_GAS_TRANSPORT_ERRORS = (
+    requests.ConnectionError,
+    requests.Timeout,
+    requests.exceptions.RetryError,
+    requests.exceptions.ChunkedEncodingError,
+)
+
+
+def request_gas_format(session: requests.Session, doc_id: str) -> None:
+    """GAS 서식 적용 1회 호출. 실패 시 예외."""
+    if not (doc_id or "").strip():
+        raise ValueError("서식을 적용할 문서 ID가 없습니다.")
+    params = {"docId": doc_id, "token": GAS_TOKEN}
+    check_deadline("GAS")
+    breaker = get_circuit_breaker("gas")
+    breaker.before_call()
+    try:
+        connect, read = GAS_HTTP_TIMEOUT
+        r = session.get(
+            GAS_WEBAPP_URL,
+            params=params,
+            timeout=(clamp_timeout(connect), clamp_timeout(read)),
+        )
+    except _GAS_TRANSPORT_ERRORS as e:
+        breaker.record_failure(e)
+        raise
+    except Exception:
+        breaker.release()
+        raise
+    if r.status_code >= 500 or r.status_code == 429:
+        error = RuntimeError(f"HTTP {r.status_code}")
+        breaker.record_failure(error)
+        raise error
+    breaker.record_success()
+
+    if r.status_code != 200:
+        raise RuntimeError(f"HTTP {r.status_code}")
+
+    ct = r.headers.get("Content-Type", "")
+    if "application/json" not in ct:
+        raise RuntimeError(f"Non-JSON response: {ct}")
+
+    data = r.json()
+    if not data.get("ok", False):
+        raise RuntimeError("GAS ok=false")
+
+
+def _cleanup_debug_tokens_in_worker(doc_id: str) -> None:
+    DocsMutationPlan(doc_id).remove_debug_tokens().flush(get_google_services()[1])
+
+
+GAS_JOB_TTL = 7 * 24 * 3600  # 서식 작업 상태 보관 기간(초)
+GAS_JOB_STALE = 15 * 60  # 이 시간 동안 갱신이 없는 대기/진행 작업은 중단된 것으로 표시
+GAS_RECENT_LIMIT = 50  # 최근 작업 목록 길이
+
+
+class GasFormatQueue:
+    """
+    GAS 서식 적용을 백그라운드에서 처리하는 큐.
+    - 동시 실행 수 제한(ThreadPoolExecutor)
+    - keep-alive 세션 공유 + 재시도
+    - 서식 적용 후 디버그 토큰 제거까지 처리
+    작업 상태(queued → running → done/failed)는 공유 상태(gas-job:{doc_id})와
+    실행 기록(체크포인트 gas_format:{doc_id})에 저장 → 재시작/다른 프로세스에서도 보인다.
+    """
+
+    def __init__(
+        self,
+        max_workers: int = GAS_FORMAT_MAX_WORKERS,
+        state: Optional[SharedStateBackend] = None,
+    ):
+        self.session = make_gas_http_session(max_workers)
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="gas-format"
+        )
+        self._lock = threading.Lock()
+        self._state = state
+        self.jobs: Dict[str, dict] = {}  # 이 프로세스가 받은 작업(wait_idle용)
+
+    @property
+    def state(self) -> SharedStateBackend:
+        return self._state or get_shared_state()
+
+    def _set(self, doc_id: str, **fields) -> None:
+        with self._lock:
+            job = self.jobs.setdefault(doc_id, {"doc_id": doc_id})
+            job.update(fields, updated_at=time.time())
+            job = dict(job)
+        self.state.cache_set(f"gas-job:{doc_id}", job, ttl=GAS_JOB_TTL)
+        if job.get("run_key"):
+            self.state.checkpoint_put(job["run_key"], f"gas_format:{doc_id}", job)
+
+    def _remember(self, doc_id: str) -> None:
+        with self.state.lock("gas-jobs", ttl=10, timeout=10):
+            recent = self.state.cache_get("gas-jobs:recent") or []
+            recent = [doc_id] + [d for d in recent if d != doc_id]
+            self.state.cache_set(
+                "gas-jobs:recent", recent[:GAS_RECENT_LIMIT], ttl=GAS_JOB_TTL
+            )
+
+    def submit(
+        self,
+        doc_id: str,
+        title: str = "",
+        cleanup_fn=None,
+        run_key: Optional[str] = None,
+    ) -> None:
+        self._set(
+            doc_id,
+            title=title,
+            run_key=run_key,
+            status="queued",
+            error="",
+            queued_at=time.time(),
+            finished_at=None,
+        )
+        try:
+            self._remember(doc_id)
+        except TimeoutError:
+            logger.warning("서식 작업 목록 갱신 실패(잠금 대기 초과): %s", doc_id)
+        self._executor.submit(self._run, doc_id, cleanup_fn)
+
+    def _run(self, doc_id: str, cleanup_fn) -> None:
+        self._set(doc_id, status="running")
+        error = ""
+        try:
+            request_gas_format(self.session, doc_id)
+        except Exception as e:
+            error = f"서식 적용 실패: {e}"
+        try:
+            # 서식 성공/실패와 무관하게 토큰 정리(기존 동기 흐름과 동일)
+            if cleanup_fn is not None:
+                cleanup_fn(doc_id)
+        except Exception as e:
+            error = (error + " / " if error else "") + f"토큰 정리 실패: {e}"
+        self._set(
+            doc_id,
+            status="failed" if error else "done",
+            error=error,
+            finished_at=time.time(),
+        )
+
+    def wait_idle(self, timeout: Optional[float] = None) -> bool:
+        """대기/진행 중인 작업이 모두 끝날 때까지 기다린다(일괄 실행 종료 전)."""
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            with self._lock:
+                busy = any(
+                    j.get("status") in ("queued", "running") for j in self.jobs.values()
+                )
+            if not busy:
+                return True
+            if end is not None and time.time() >= end:
+                return False
+            time.sleep(0.5)
+
+    def job(self, doc_id: str) -> Optional[dict]:
+        job = self.state.cache_get(f"gas-job:{doc_id}")
+        if job is None:
+            return None
+        stale = time.time() - job.get("updated_at", 0) > GAS_JOB_STALE
+        if job["status"] in ("queued", "running") and stale:
+            # 처리하던 프로세스가 재시작/종료됨 → 다시 요청해야 함
+            job.update(status="failed", error="중단됨(앱 재시작 등) — 수동 서식 필요")
+        return job
+
+    def recent(self, limit: int = 10) -> list:
+        doc_ids = (self.state.cache_get("gas-jobs:recent") or [])[:limit]
+        return [j for j in map(self.job, doc_ids) if j is not None]
+
+
+@process_singleton
+def get_gas_format_queue() -> GasFormatQueue:
+    # 화면 재실행(rerun)과 무관하게 큐/세션은 프로세스에 1개만 유지
+    return GasFormatQueue()
+
+
+def gas_format_pending(doc_url: str) -> bool:
+    """
+    문서의 자동 서식/디버그 토큰 정리가 아직 대기/진행 중인지.
+    _make_student_doc은 링크를 바로 돌려주므로 그동안은 토큰이 보일 수 있다.
+    """
+    job = get_gas_format_queue().job(doc_id_from_ref(doc_url))
+    return job is not None and job["status"] in ("queued", "running")
+
+
+# =========================================================
+# 11) Sheets 기록 (A열부터 정확히)
+# =========================================================
+
+
+def make_hyperlink_formula(url: str, label: str) -> str:
+    u = (url or "").strip()
+    if not u:
+        return ""
+    u = u.replace('"', '""')
+    label = (label or "").replace('"', '""')
+    return f'=HYPERLINK("{u}","{label}")'
+
+
+SHEETS_FIRST_ROW = 6
+SHEETS_LAST_ROW = 1005
+SHEETS_INDEX_TTL = 60  # 학번(D열) 인덱스 캐시 유지 시간(초)
+SHEETS_LOCK_TIMEOUT = 300  # 시트 잠금 대기(초) — 보유 중인 쪽은 잠금을 연장하며 재시도
+
+
+class SheetsRowWriter:
+    """
+    시트 기록 버퍼 + 학번(D열) 기준 upsert.
+
+    - add()로 행을 모았다가 flush()에서 values.batchUpdate 1회로 기록
+    - 이미 있는 학번은 그 행을 제자리 갱신
+    - 새 학번은 기존과 같이 A6부터 내려가며 'A열이 빈 가장 위의 행'부터 채움
+    - 시트 인덱스(학번 → 행, A열이 찬 행)는 공유 상태 저장소에 TTL 동안 캐시.
+      새 학번이 있으면 빈 행을 정확히 알아야 하므로 캐시 없이 A:D를 다시 읽음
+    - flush는 공유 잠금 안에서 실행 → 여러 프로세스가 같은 빈 행/학번을 겹쳐 쓰지 않음
+    """
+
+    def __init__(
+        self,
+        state: SharedStateBackend,
+        spreadsheet_id: str = SHEETS_ID,
+        tab: str = SHEETS_TAB,
+    ):
+        self.state = state
+        self.spreadsheet_id = spreadsheet_id
+        self.tab = tab
+        self._lock = threading.Lock()
+        self._buffer: list = []
+        self._index_key = f"sheets-rows:{spreadsheet_id}:{tab}"
+
+    def add(self, values_a_to_g: list) -> None:
+        """values_a_to_g: 학년, 반, 번호, 학번, 이름, 보고서 링크, 조언 링크 (A~G)"""
+        created_at = time.strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            self._buffer.append(list(values_a_to_g[:7]) + [created_at])  # A~H
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._buffer)
+
+    def pending_students(self) -> set:
+        with self._lock:
+            return {str(row[3]) for row in self._buffer}
+
+    def invalidate_index(self) -> None:
+        self.state.cache_delete(self._index_key)
+
+    def _load_index(self, sheets_service, fresh: bool = False) -> dict:
+        """{"students": {학번: 행}, "filled": [A열이 찬 행]}"""
+        cached = None if fresh else self.state.cache_get(self._index_key)
+        if cached is not None:
+            return cached
+
+        read_range = f"{self.tab}!A{SHEETS_FIRST_ROW}:D{SHEETS_LAST_ROW}"
+        resp = execute_with_retry(
+            lambda: sheets_service.spreadsheets()
+            .values()
+            .get(
+                spreadsheetId=self.spreadsheet_id,
+                range=read_range,
+                majorDimension="ROWS",
+            )
+            .execute(),
+            label="Sheets Read Index",
+        )
+        students, filled = {}, []
+        for i, r in enumerate(resp.get("values", [])):
+            row = SHEETS_FIRST_ROW + i
+            if (r[0] if r else "").strip():
+                filled.append(row)
+            num = (r[3] if len(r) > 3 else "").strip()
+            if num and num not in students:
+                students[num] = row
+        index = {"students": students, "filled": filled}
+        self.state.cache_set(self._index_key, index, ttl=SHEETS_INDEX_TTL)
+        return index
+
+    @staticmethod
+    def _empty_rows(filled: list, count: int) -> list:
+        """A6부터 A열이 빈 행 count개(위에서부터)."""
+        taken, rows, r = set(filled), [], SHEETS_FIRST_ROW
+        while len(rows) < count:
+            if r not in taken:
+                rows.append(r)
+            r += 1
+        return rows
+
+    def flush(self, sheets_service) -> Dict[str, int]:
+        """버퍼를 기록하고 {학번: 기록된 행 번호}를 반환."""
+        if not self.spreadsheet_id.strip():
+            return {}
+
+        with self._lock, self.state.lock(
+            self._index_key, ttl=60, timeout=SHEETS_LOCK_TIMEOUT, renew=True
+        ):
+            if not self._buffer:
+                return {}
+            # 같은 학번이 여러 번 들어오면 마지막 값만 기록
+            latest: Dict[str, list] = {}
+            for row in self._buffer:
+                latest[str(row[3])] = row
+
+            index = self._load_index(sheets_service)
+            if any(n not in index["students"] for n in latest):
+                index = self._load_index(sheets_service, fresh=True)
+            students = index["students"]
+            new_nums = [n for n in latest if n not in students]
+            for num, r in zip(
+                new_nums, self._empty_rows(index["filled"], len(new_nums))
+            ):
+                students[num] = r
+                index["filled"].append(r)
+
+            written = {num: students[num] for num in latest}
+            data = [
+                {"range": f"{self.tab}!A{r}:H{r}", "values": [latest[num]]}
+                for num, r in written.items()
+            ]
+            try:
+                execute_with_retry(
+                    lambda: sheets_service.spreadsheets()
+                    .values()
+                    .batchUpdate(
+                        spreadsheetId=self.spreadsheet_id,
+                        body={"valueInputOption": "USER_ENTERED", "data": data},
+                    )
+                    .execute(),
+                    label="Sheets Update",
+                )
+            except Exception:
+                # 일부만 기록됐을 수 있음 → 다음에 인덱스를 다시 읽기.
+                # 행은 이 writer의 버퍼에 남는다(호출한 쪽이 다시 flush하거나 버림)
+                self.invalidate_index()
+                raise
+            self.state.cache_set(self._index_key, index, ttl=SHEETS_INDEX_TTL)
+
+            self._buffer = []
+            return written
+
+
+SHEETS_FLUSH_EVERY = 20  # 일괄 실행: 모아 둔 행이 이만큼이면 중간 기록
+
+
+def write_row_to_sheet_from_A6(
+    sheets_service, values_a_to_g: list, writer: Optional[SheetsRowWriter] = None
+) -> None:
+    """
+    A~G에 values_a_to_g(7개)를 쓰고, H에는 생성 시간을 기록한다.
+    같은 학번(D열) 행이 있으면 그 행을 갱신하고, 없으면 A6부터 내려가며
+    '가장 위의 빈 행'(A열 기준)에 기록.
+    writer를 주면 그 버퍼에 모으기만 한다(일괄 실행 — 호출한 쪽이 flush).
+    없으면 이 행만 담은 writer로 바로 기록(화면) — 실패한 행이 남아
+    다른 학생의 기록에 섞이지 않는다.
+
+    values_a_to_g = [grade, klass, number, student_num5, name, report_link, guide_link]
+    """
+    if writer is not None:
+        writer.add(values_a_to_g)
+        return
+    writer = SheetsRowWriter(get_shared_state())
+    writer.add(values_a_to_g)
+    writer.flush(sheets_service)
+
+
+def mark_sheet_rows_written(state: SharedStateBackend, run_keys: list) -> None:
+    """모아 두었던 시트 행이 기록됨 → 결과 체크포인트의 sheet_pending 해제."""
+    for run_key in run_keys:
+        result = state.checkpoint_get(run_key).get("result")
+        if result and result.get("sheet_pending"):
+            state.checkpoint_put(run_key, "result", dict(result, sheet_pending=False))
+
+
+def parse_student_num5(num5: str):
+    if not re.fullmatch(r"\d{5}", num5 or ""):
+        return "", "", ""
+    grade = num5[0]
+    klass = str(int(num5[1:3]))
+    number = str(int(num5[3:5]))
+    return grade, klass, number
+
+
+# =========================================================
+# 12) 제목/학번
+# =========================================================
+
+
+def normalize_student_num(raw: str) -> str:
+    s = re.sub(r"\D", "", (raw or "").strip())
+    return s[:5] if len(s) >= 5 else ""
+
+
+def make_run_key(
+    student_num5: str, student_name: str, pdf_bytes: bytes, notes: str
+) -> str:
+    """같은 학생·같은 입력이면 같은 키(실행 체크포인트용)."""
+    h = hashlib.sha256()
+    for part in (
+        student_num5,
+        student_name,
+        hashlib.sha256(pdf_bytes or b"").hexdigest(),
+        hashlib.sha256((notes or "").strip().encode("utf-8")).hexdigest(),
+    ):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+def make_doc_titles(student_num5: str, student_name: str) -> Tuple[str, str]:
+    base = f"{student_num5}_{student_name}"
+    return base, f"{base}_담임교사지도방침"
+
+
+# =========================================================
+# 12-1) 학급 진행 현황(대시보드) — 시트 증분 동기화
+# =========================================================
+# 시트 전체는 처음 1회만 읽고 공유 캐시에 둔다. 이후에는
+#   1) TTL 안이면 API 호출 없음
+#   2) TTL이 지나면 Drive modifiedTime 1회 확인 → 안 바뀌었으면 Sheets 읽기 없음
+#   3) 바뀌었으면 D열(학번)/H열(생성시간)만 읽어 달라진 행만 batchGet
+#      (D/H가 그대로면 다른 열을 손으로 고친 것 → 전체 다시 읽기)
+# 여러 교사가 동시에 열어도 잠금으로 한 명만 갱신하고 나머지는 캐시를 쓴다.
+
+PROGRESS_TTL = 60  # 초
+RUN_FAILURES_KEY = "run-failures"  # {학번: {"error", "at"}}
+
+
+def record_run_failure(
+    state: SharedStateBackend, student_num5: str, error: str
+) -> None:
+    with state.lock(RUN_FAILURES_KEY):
+        failures = state.cache_get(RUN_FAILURES_KEY) or {}
+        failures[student_num5] = {"error": error, "at": time.time()}
+        state.cache_set(RUN_FAILURES_KEY, failures)
+
+
+def clear_run_failure(state: SharedStateBackend, student_num5: str) -> None:
+    with state.lock(RUN_FAILURES_KEY):
+        failures = state.cache_get(RUN_FAILURES_KEY) or {}
+        if failures.pop(student_num5, None) is not None:
+            state.cache_set(RUN_FAILURES_KEY, failures)
+
+
+def _sheet_cell(row: list, i: int) -> str:
+    return str(row[i]).strip() if len(row) > i else ""
+
+
+class SheetProgressCache:
+    """`컨설팅 보고서` 탭의 행을 공유 캐시에 두고 바뀐 행만 다시 읽는다."""
+
+    def __init__(
+        self,
+        state: SharedStateBackend,
+        spreadsheet_id: str = SHEETS_ID,
+        tab: str = SHEETS_TAB,
+    ):
+        self.state = state
+        self.spreadsheet_id = spreadsheet_id
+        self.tab = tab
+        self.key = f"sheet-progress:{spreadsheet_id}:{tab}"
+        self.last_sync_calls = {"drive": 0, "sheets": 0}
+
+    def _read(self, sheets_service, a1: str) -> list:
+        self.last_sync_calls["sheets"] += 1
+        resp = execute_with_retry(
+            lambda: sheets_service.spreadsheets()
+            .values()
+            .get(spreadsheetId=self.spreadsheet_id, range=f"{self.tab}!{a1}")
+            .execute(),
+            label="Sheets Read Progress",
+        )
+        return resp.get("values", [])
+
+    def _read_columns(self, sheets_service, columns: list) -> list:
+        """열 여러 개를 1회 호출로 — 열마다 [행별 값] (빈 칸은 "")."""
+        self.last_sync_calls["sheets"] += 1
+        ranges = [
+            f"{self.tab}!{c}{SHEETS_FIRST_ROW}:{c}{SHEETS_LAST_ROW}" for c in columns
+        ]
+        resp = execute_with_retry(
+            lambda: sheets_service.spreadsheets()
+            .values()
+            .batchGet(spreadsheetId=self.spreadsheet_id, ranges=ranges)
+            .execute(),
+            label="Sheets Read Progress Columns",
+        )
+        return [
+            [_sheet_cell(cell, 0) for cell in vr.get("values", [])]
+            for vr in resp.get("valueRanges", [])
+        ]
+
+    def _read_all(self, sheets_service, modified: str) -> dict:
+        values = self._read(sheets_service, f"A{SHEETS_FIRST_ROW}:H{SHEETS_LAST_ROW}")
+        return {
+            "rows": {
+                str(SHEETS_FIRST_ROW + i): row
+                for i, row in enumerate(values)
+                if _sheet_cell(row, 3) or _sheet_cell(row, 7)
+            },
+            "modified_time": modified,
+            "synced_at": time.time(),
+        }
+
+    def _read_rows(self, sheets_service, row_numbers: list) -> Dict[str, list]:
+        self.last_sync_calls["sheets"] += 1
+        ranges = [f"{self.tab}!A{r}:H{r}" for r in row_numbers]
+        resp = execute_with_retry(
+            lambda: sheets_service.spreadsheets()
+            .values()
+            .batchGet(spreadsheetId=self.spreadsheet_id, ranges=ranges)
+            .execute(),
+            label="Sheets Read Changed Rows",
+        )
+        out = {}
+        for r, vr in zip(row_numbers, resp.get("valueRanges", [])):
+            vals = vr.get("values", [[]])
+            out[str(r)] = vals[0] if vals else []
+        return out
+
+    def _modified_time(self, drive_service) -> str:
+        self.last_sync_calls["drive"] += 1
+        meta = execute_with_retry(
+            lambda: drive_service.files()
+            .get(
+                fileId=self.spreadsheet_id,
+                fields="modifiedTime",
+                supportsAllDrives=True,
+            )
+            .execute(),
+            label="Drive Sheet ModifiedTime",
+        )
+        return meta.get("modifiedTime", "")
+
+    def rows(self, drive_service, sheets_service, force: bool = False) -> dict:
+        """{"rows": {행번호(str): [A..H]}, "synced_at", "modified_time"}"""
+        self.last_sync_calls = {"drive": 0, "sheets": 0}
+        cached = self.state.cache_get(self.key)
+        if cached and not force and time.time() - cached["synced_at"] < PROGRESS_TTL:
+            return cached
+
+        with self.state.lock(self.key, ttl=60, timeout=SHEETS_LOCK_TIMEOUT, renew=True):
+            # 잠금을 기다리는 동안 다른 교사가 갱신했을 수 있음
+            fresh = self.state.cache_get(self.key)
+            if fresh and not force and time.time() - fresh["synced_at"] < PROGRESS_TTL:
+                return fresh
+            cached = fresh or cached
+
+            modified = self._modified_time(drive_service)
+            if cached and modified == cached["modified_time"]:
+                cached["synced_at"] = time.time()
+            elif not cached:
+                cached = self._read_all(sheets_service, modified)
+            else:
+                # 행 있음 = 학번(D) 또는 생성시간(H)이 있음 — 손으로 넣은 행은 H가 빔
+                nums, stamps = self._read_columns(sheets_service, ["D", "H"])
+                rows = cached["rows"]
+                changed = []
+                present = set()
+                for i in range(max(len(nums), len(stamps))):
+                    r = str(SHEETS_FIRST_ROW + i)
+                    num = nums[i] if i < len(nums) else ""
+                    stamp = stamps[i] if i < len(stamps) else ""
+                    if not num and not stamp:
+                        continue
+                    present.add(r)
+                    old = rows.get(r)
+                    if (
+                        old is None
+                        or _sheet_cell(old, 3) != num
+                        or _sheet_cell(old, 7) != stamp
+                    ):
+                        changed.append(int(r))
+                gone = [r for r in rows if r not in present]  # 지워진 행
+                if not changed and not gone:
+                    cached = self._read_all(sheets_service, modified)
+                else:
+                    for r in gone:
+                        rows.pop(r)
+                    if changed:
+                        rows.update(self._read_rows(sheets_service, changed))
+                    cached.update(modified_time=modified, synced_at=time.time())
+
+            self.state.cache_set(self.key, cached)
+            return cached
+
+
+def parse_roster_csv(data: bytes) -> list:
+    """명단 CSV(머리글에 '학번', '이름') → [{"학번", "이름"}]"""
+    for enc in ("utf-8-sig", "cp949"):
+        try:
+            text = data.decode(enc)
+            break
+        except UnicodeDecodeError:
+            continue
+    else:
+        raise ValueError("명단 파일 인코딩을 알 수 없습니다(UTF-8/CP949).")
+
+    roster = []
+    for row in csv.DictReader(io.StringIO(text)):
+        num = normalize_student_num(row.get("학번", ""))
+        if num:
+            roster.append({"학번": num, "이름": (row.get("이름") or "").strip()})
+    return roster
+
+
+def build_progress_table(roster: list, sheet_rows: dict, failures: dict) -> list:
+    """명단 × 시트 × 실패 기록 → 학생별 상태 목록."""
+    done = {}
+    for row in sheet_rows.values():
+        num = (row[3] if len(row) > 3 else "").strip()
+        if num and len(row) > 5 and str(row[5]).strip():
+            done[num] = row
+
+    students = roster or [
+        {
+            "학번": (r[3] if len(r) > 3 else "").strip(),
+            "이름": r[4] if len(r) > 4 else "",
+        }
+        for r in sheet_rows.values()
+    ]
+    table = []
+    for stu in students:
+        num = stu["학번"]
+        grade, klass, number = parse_student_num5(num)
+        if num in done:
+            status, when = "완료", done[num][7] if len(done[num]) > 7 else ""
+        elif num in failures:
+            status = "실패"
+            failed_at = time.localtime(failures[num]["at"])
+            when = time.strftime("%Y-%m-%d %H:%M:%S", failed_at)
+        else:
+            status, when = "미완료", ""
+        table.append(
+            {
+                "학년": grade,
+                "반": klass,
+                "번호": number,
+                "학번": num,
+                "이름": stu["이름"],
+                "상태": status,
+                "시각": when,
+            }
+        )
+    table.sort(key=lambda r: r["학번"])
+    return table
+
+
+# =========================================================
+# 12-2) PDF 일괄 내보내기 (학년/반 단위 ZIP)
+# =========================================================
+# 시트에 기록된 문서 id로 Drive에서 PDF를 내려받는다.
+#   - 동시에 EXPORT_MAX_WORKERS개까지(Google 서비스는 공유 — keep-alive 연결 재사용)
+#   - PDF는 메모리에 모으지 않고 작업 폴더에 바로 저장, ZIP도 디스크에서 만든다
+#   - manifest.json에 끝난 파일을 기록 → 중간에 끊겨도 남은 것만 이어서
+#   - 화면 내려받기(st.download_button)는 data를 콜러블로 넘겨도 결과를 통째로
+#     메모리에 올린 뒤 보낸다(파일 핸들/제너레이터도 마찬가지 — 스트리밍 없음).
+#     그래서 ZIP 크기를 EXPORT_ZIP_MAX_BYTES로 제한하고, 넘으면 반별로 나눠 받게 한다
+
+EXPORT_LOCK_WAIT = 2.0  # 같은 반을 다른 사용자가 내보내는 중이면 이만큼만 기다림(초)
+EXPORT_MAX_WORKERS = 4
+EXPORT_ZIP_MAX_BYTES = 300 * 1024 * 1024  # 학년 전체(약 300명 × 2개)도 대개 들어감
+EXPORT_DIR = os.path.join(tempfile.gettempdir(), "h_app_exports")
+EXPORT_KINDS = (("보고서", 5), ("지도방침", 6))  # (파일 이름, 시트 열 인덱스 F/G)
+_DOC_ID_RE = re.compile(r"/document/d/([A-Za-z0-9_-]+)")
+_UNSAFE_FILENAME_RE = re.compile(r'[\\/:*?"<>|\s]+')
+
+
+def read_export_targets(
+    sheets_service, grade: str, klass: str = "", spreadsheet_id: str = SHEETS_ID
+) -> list:
+    """
+    시트에서 학년(필수)/반(선택)에 해당하는 문서 목록을 만든다.
+    링크 열은 HYPERLINK 수식이라 FORMULA로 읽어 문서 id를 꺼낸다.
+    """
+    resp = execute_with_retry(
+        lambda: sheets_service.spreadsheets()
+        .values()
+        .get(
+            spreadsheetId=spreadsheet_id,
+            range=f"{SHEETS_TAB}!A{SHEETS_FIRST_ROW}:G{SHEETS_LAST_ROW}",
+            valueRenderOption="FORMULA",
+        )
+        .execute(),
+        label="Sheets Read Export Targets",
+    )
+    targets = {}
+    for row in resp.get("values", []):
+        row = [str(c) for c in row] + [""] * (7 - len(row))
+        if row[0].strip() != grade or (klass and row[1].strip() != klass):
+            continue
+        num, name = row[3].strip(), row[4].strip()
+        for kind, col in EXPORT_KINDS:
+            m = _DOC_ID_RE.search(row[col])
+            if not m:
+                continue
+            filename = _UNSAFE_FILENAME_RE.sub("_", f"{num}_{name}_{kind}") + ".pdf"
+            # 같은 학생이 여러 번 기록됐으면 아래(나중) 행이 이김
+            targets[filename] = {"filename": filename, "doc_id": m.group(1)}
+    return sorted(targets.values(), key=lambda t: t["filename"])
+
+
+class ExportBusy(RuntimeError):
+    """같은 학년/반 내보내기를 다른 세션/프로세스가 진행 중."""
+
+
+class ExportTooLarge(RuntimeError):
+    """ZIP이 화면 내려받기 한도(EXPORT_ZIP_MAX_BYTES)를 넘음."""
+
+
+class PdfExportJob:
+    """
+    작업 폴더 1개 = 내보내기 1건. 같은 학년/반을 다시 열면 같은 폴더를 이어 쓴다.
+    manifest: {파일 이름: 문서 id} — 문서 id가 바뀐(재생성된) 학생은 다시 받는다.
+    같은 폴더를 쓰는 작업(내려받기/ZIP/초기화)은 공유 잠금으로 한 번에 하나만 —
+    다른 교사가 같은 반을 내보내는 중이면 ExportBusy.
+    """
+
+    MANIFEST = "manifest.json"
+
+    def __init__(
+        self,
+        label: str,
+        max_workers: Optional[int] = None,
+        state: Optional[SharedStateBackend] = None,
+    ):
+        self.label = label
+        self.max_workers = max(1, max_workers or EXPORT_MAX_WORKERS)
+        self.state = state or get_shared_state()
+        digest = hashlib.sha256(f"{SHEETS_ID}:{label}".encode("utf-8")).hexdigest()
+        self._lock_name = f"pdf-export:{digest[:16]}"
+        self.dir = os.path.join(EXPORT_DIR, digest[:16])
+        self.pdf_dir = os.path.join(self.dir, "pdf")
+        self.zip_path = os.path.join(self.dir, f"{label}.zip")
+        self._lock = threading.Lock()
+        os.makedirs(self.pdf_dir, exist_ok=True)
+
+    @contextmanager
+    def exclusive(self, timeout: Optional[float] = None):
+        wait = EXPORT_LOCK_WAIT if timeout is None else timeout
+        try:
+            with self.state.lock(self._lock_name, ttl=60, timeout=wait, renew=True):
+                yield
+        except TimeoutError:
+            raise ExportBusy(
+                f"{self.label}: 다른 사용자가 내보내는 중입니다. 잠시 후 다시 시도하세요."
+            ) from None
+
+    def _manifest_path(self) -> str:
+        return os.path.join(self.dir, self.MANIFEST)
+
+    def manifest(self) -> Dict[str, str]:
+        try:
+            with open(self._manifest_path(), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _mark_done(self, filename: str, doc_id: str) -> None:
+        with self._lock:
+            done = self.manifest()
+            done[filename] = doc_id
+            tmp = self._manifest_path() + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(done, f, ensure_ascii=False)
+            os.replace(tmp, self._manifest_path())
+
+    def pending(self, targets: list) -> list:
+        done = self.manifest()
+        return [
+            t
+            for t in targets
+            if done.get(t["filename"]) != t["doc_id"]
+            or not os.path.exists(os.path.join(self.pdf_dir, t["filename"]))
+        ]
+
+    def _export_one(self, target: dict) -> None:
+        drive_service = get_google_services()[0]
+        path = os.path.join(self.pdf_dir, target["filename"])
+        part = path + ".part"
+        request = drive_service.files().export_media(
+            fileId=target["doc_id"], mimeType="application/pdf"
+        )
+        with open(part, "wb") as f:
+            downloader = MediaIoBaseDownload(f, request)
+            done = False
+            while not done:
+                _, done = execute_with_retry(
+                    downloader.next_chunk, label="Drive Export PDF"
+                )
+        os.replace(part, path)
+        self._mark_done(target["filename"], target["doc_id"])
+
+    def run(self, targets: list, on_progress=None) -> Dict[str, str]:
+        """남은 파일만 내려받는다. 반환: {파일 이름: 오류} (성공한 것은 없음)"""
+        with self.exclusive():
+            return self._run(targets, on_progress)
+
+    def _run(self, targets: list, on_progress=None) -> Dict[str, str]:
+        todo = self.pending(targets)
+        errors = {}
+        finished = len(targets) - len(todo)
+        if on_progress:
+            on_progress(finished, len(targets))
+        with ThreadPoolExecutor(
+            max_workers=self.max_workers, thread_name_prefix="pdf-export"
+        ) as pool:
+            futures = {pool.submit(self._export_one, t): t for t in todo}
+            for fut in futures:
+                try:
+                    fut.result()
+                except Exception as e:
+                    errors[futures[fut]["filename"]] = str(e)
+                finished += 1
+                if on_progress:
+                    on_progress(finished, len(targets))
+        return errors
+
+    def build_zip(self, targets: list) -> str:
+        """내려받은 PDF를 디스크에서 바로 ZIP으로(파일 하나씩 스트리밍)."""
+        with self.exclusive():
+            return self._build_zip(targets)
+
+    def _build_zip(self, targets: list) -> str:
+        tmp = self.zip_path + ".part"
+        with zipfile.ZipFile(tmp, "w", compression=zipfile.ZIP_STORED) as zf:
+            for t in targets:
+                path = os.path.join(self.pdf_dir, t["filename"])
+                if os.path.exists(path):
+                    zf.write(path, arcname=t["filename"])
+        os.replace(tmp, self.zip_path)
+        return self.zip_path
+
+    def zip_is_stale(self) -> bool:
+        if not os.path.exists(self.zip_path):
+            return True
+        manifest = self._manifest_path()
+        return os.path.exists(manifest) and os.path.getmtime(
+            manifest
+        ) > os.path.getmtime(self.zip_path)
+
+    def zip_size(self, targets: list) -> int:
+        """받아 둔 PDF 크기 합 — 압축 없이(ZIP_STORED) 묶으므로 ZIP 크기와 거의 같다."""
+        total = 0
+        for t in targets:
+            path = os.path.join(self.pdf_dir, t["filename"])
+            if os.path.exists(path):
+                total += os.path.getsize(path)
+        return total
+
+    def check_zip_size(self, targets: list) -> None:
+        size = self.zip_size(targets)
+        if size > EXPORT_ZIP_MAX_BYTES:
+            raise ExportTooLarge(
+                f"{self.label}: ZIP이 {size // 2**20}MB로 화면 내려받기 한도"
+                f"({EXPORT_ZIP_MAX_BYTES // 2**20}MB)를 넘습니다. 반별로 나눠 받으세요."
+            )
+
+    def read_zip(self, targets: list) -> bytes:
+        """
+        내려받기 버튼을 누른 순간에만 호출(화면 재실행마다 읽지 않음).
+        ZIP이 오래됐으면 다시 만든다. 다른 사용자가 작업 중이면 기존 ZIP을 그대로.
+        Streamlit이 결과를 어차피 메모리에 올리므로 크기 한도를 넘으면 ExportTooLarge.
+        """
+        self.check_zip_size(targets)
+        try:
+            if self.zip_is_stale():
+                self.build_zip(targets)
+        except ExportBusy:
+            if not os.path.exists(self.zip_path):
+                raise
+        with open(self.zip_path, "rb") as f:
+            return f.read()
+
+    def reset(self) -> None:
+        with self.exclusive(), self._lock:
+            for name in os.listdir(self.pdf_dir):
+                os.remove(os.path.join(self.pdf_dir, name))
+            for path in (self._manifest_path(), self.zip_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+
+# =========================================================
+# 13) 학생 1명 처리(파이프라인) — 화면/CLI 공용
+# =========================================================
+# 단계: 보고서 → 요약 → 지도방침 → 문서 2개 + 시트 기록.
+# 각 단계 결과는 공유 체크포인트에 저장 → 중간에 실패해도 다음 실행은 이어서.
+# 진행 알림은 on_progress(단계, 메시지)로, 실패는 PipelineError로 알린다.
+
+RUN_STAGE_LABELS = [
+    ("report", "1단계: 컨설팅 보고서"),
+    ("summary", "2단계: 보고서 요약"),
+    ("homeroom", "3단계: 담임교사용 지도방침"),
+    ("result", "문서 생성 + 시트 기록"),
+]
+
+STAGE_FAILURE_PREFIX = {
+    "services": "Google OAuth/서비스 연결 실패",
+    "preflight": "사전 점검 실패",
+    "prompts": "프롬프트 파일을 읽을 수 없습니다",
+    "report": "1단계 실패",
+    "summary": "2단계 실패",
+    "homeroom": "3단계 실패",
+    "result": "문서 생성 실패",
+    "section": "목차 다시 생성 실패",
+    "patch": "문서 수정 실패",
+}
+
+REPORT_PLACEHOLDERS = {
+    "{{REPORT_CONTENT}}": "컨설팅 보고서(원문)",
+    "{{REPORT_SUMMARY}}": "컨설팅 보고서 요약",
+    "{{STUDENT_NAME}}": "학생 이름",
+    "{{STUDENT_NUM}}": "학번",
+}
+
+GUIDE_PLACEHOLDERS = {
+    "{{HOMEROOM_GUIDANCE}}": "담임교사용 진학지도 조언",
+    "{{REPORT_SUMMARY}}": "학생 컨설팅 보고서 요약본",  # ✅ 추가
+    "{{STUDENT_NAME}}": "학생 이름",
+    "{{STUDENT_NUM}}": "학번",
+    "{{NOTES_BLOCK}}": "담임 추가 기재사항",
+}
+
+
+class PipelineError(RuntimeError):
+    """
+    단계 실패. stage는 RUN_STAGE_LABELS의 키 또는 services/preflight/prompts,
+    inflight(진행 중이던 같은 실행이 결과 없이 끝남)
+    """
+
+    def __init__(self, stage: str, message: str, deadline: RunDeadline):
+        super().__init__(message)
+        self.stage = stage
+        self.deadline = deadline
+
+
+class RunOptions:
+    """실행 1회 설정(화면/CLI가 명시적으로 넘김)."""
+
+    def __init__(
+        self,
+        force_regen: bool = False,
+        auto_gas_format: bool = AUTO_GAS_FORMAT_DEFAULT,
+        generation_preset: Optional[str] = None,
+        deadline_seconds: Optional[float] = None,
+        preflight: bool = True,
+        sheets_writer: Optional[SheetsRowWriter] = None,
+    ):
+        self.force_regen = force_regen
+        self.auto_gas_format = auto_gas_format
+        self.generation_preset = generation_preset
+        self.deadline_seconds = deadline_seconds
+        self.preflight = preflight  # Gemini 호출 전 외부 자원 점검(캐시됨)
+        # 시트 행을 모아 둘 writer(일괄 실행 — 호출한 쪽이 flush). 없으면 바로 기록
+        self.sheets_writer = sheets_writer
+
+
+def stage_checkpoint(checkpoint: dict, stage: str, versions: Dict[str, str]):
+    """저장된 단계 결과 — 만들 때의 프롬프트 버전이 지금과 같을 때만 재사용."""
+    if checkpoint.get(f"{stage}_prompt") != versions[stage]:
+        return None
+    return checkpoint.get(stage)
+
+
+def put_stage_checkpoint(
+    state: SharedStateBackend,
+    run_key: str,
+    stage: str,
+    value: str,
+    versions: Dict[str, str],
+) -> None:
+    state.checkpoint_put(run_key, stage, value)
+    state.checkpoint_put(run_key, f"{stage}_prompt", versions[stage])
+
+
+def _make_student_doc(
+    drive_service,
+    docs_service,
+    state: SharedStateBackend,
+    template_id: str,
+    title: str,
+    root_id: str,
+    student_num5: str,
+    placeholders: Dict[str, str],
+    values: Dict[str, str],
+    auto_gas_format: bool,
+    run_key: Optional[str] = None,
+    checkpoint_name: Optional[str] = None,
+) -> Tuple[str, dict]:
+    """
+    템플릿 사본 1개를 만들어 치환. 반환: (문서 URL, batchUpdate 통계)
+    checkpoint_name을 주면 만들자마자 체크포인트에 두고, 다시 실행할 때 같은 내용이면
+    그 문서를 그대로 쓴다(뒤 단계 실패로 앞서 만든 문서가 버려지지 않게).
+    내용이 바뀌었으면 이전 문서는 휴지통으로 보내고 새로 만든다.
+    """
+    if run_key and checkpoint_name:
+        digest = hashlib.sha256(
+            json.dumps(values, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        ).hexdigest()
+        saved = state.checkpoint_get(run_key).get(checkpoint_name)
+        if saved and saved["digest"] == digest:
+            return saved["url"], saved["stats"]
+        if saved:
+            try:
+                trash_file(
+                    drive_service,
+                    doc_id_from_ref(saved["url"]),
+                    label="Drive Trash Stale Doc",
+                )
+            except Exception as e:
+                logger.warning("이전 문서를 휴지통으로 옮기지 못함: %s", e)
+        url, stats = _make_student_doc(
+            drive_service,
+            docs_service,
+            state,
+            template_id,
+            title,
+            root_id,
+            student_num5,
+            placeholders,
+            values,
+            auto_gas_format,
+            run_key,
+        )
+        state.checkpoint_put(
+            run_key, checkpoint_name, {"url": url, "stats": stats, "digest": digest}
+        )
+        return url, stats
+
+    doc_id = copy_template_to_class_folder(
+        drive_service, state, template_id, title, root_id, student_num5
+    )
+    plan = DocsMutationPlan(doc_id).ensure_placeholders(placeholders)
+    plan.replace_all(values)
+    if auto_gas_format:
+        # 서식 적용 + 토큰 제거는 백그라운드에서(링크는 바로 돌려줌 — 끝나기 전에는
+        # gas_format_pending으로 "서식 적용 중"을 표시). 토큰은 GAS 서식의 표시라
+        # 서식보다 먼저 지울 수 없다
+        stats = plan.commit(docs_service)
+        get_gas_format_queue().submit(
+            doc_id, title, _cleanup_debug_tokens_in_worker, run_key=run_key
+        )
+    else:
+        plan.remove_debug_tokens()
+        stats = plan.commit(docs_service)
+    return f"https://docs.google.com/document/d/{doc_id}/edit", stats
+
+
+RUN_INFLIGHT_TTL = 30 * 60  # 진행 중 표시 유지 시간(초) — 프로세스가 죽어도 자동 해제
+RUN_ATTACH_WAIT = 15 * 60  # 진행 중인 같은 실행을 기다리는 최대 시간(초)
+RUN_ATTACH_POLL = 2.0  # 기다리는 동안 체크포인트 확인 간격(초)
+
+
+def _run_inflight_key(run_key: str) -> str:
+    return f"run-inflight:{run_key}"
+
+
+def wait_for_run_result(state: SharedStateBackend, run_key: str) -> dict:
+    """같은 키로 진행 중인 실행이 끝날 때까지 기다렸다가 체크포인트를 반환."""
+    deadline = time.time() + RUN_ATTACH_WAIT
+    while time.time() < deadline:
+        checkpoint = state.checkpoint_get(run_key)
+        if "result" in checkpoint:
+            return checkpoint
+        if state.cache_get(_run_inflight_key(run_key)) is None:
+            return checkpoint  # 결과 없이 끝남(실패)
+        time.sleep(RUN_ATTACH_POLL)
+    return state.checkpoint_get(run_key)
+
+
+def run_student_pipeline(
+    student_num5: str,
+    student_name: str,
+    pdf_bytes: bytes,
+    notes: str,
+    options: Optional[RunOptions] = None,
+    on_progress: Optional[Callable[[str, str], None]] = None,
+    state: Optional[SharedStateBackend] = None,
+) -> dict:
+    """
+    학생 1명을 처음부터(또는 저장된 단계부터) 끝까지 처리한다.
+    반환: {"run_key", "checkpoint", "reused", "attached"}
+      - reused: 같은 입력의 이전 결과
+      - attached: 화면/CLI 어디서든 같은 입력이 이미 진행 중이어서 그 결과를 기다림
+    실패: PipelineError(어느 단계에서, 왜, 경과 시간)
+    """
+    options = options or RunOptions()
+    state = state or get_shared_state()
+    student_name = student_name.strip()
+    grade, klass, number = parse_student_num5(student_num5)
+    run_key = make_run_key(student_num5, student_name, pdf_bytes, notes)
+
+    def progress(stage: str, message: str) -> None:
+        if on_progress:
+            on_progress(stage, message)
+
+    checkpoint = state.checkpoint_get(run_key)
+    if "result" in checkpoint and not options.force_regen:
+        return {
+            "run_key": run_key,
+            "checkpoint": checkpoint,
+            "reused": True,
+            "attached": False,
+        }
+
+    succeeded = False
+    failure = "생성 중단"
+    with run_deadline(options.deadline_seconds) as deadline, use_generation_preset(
+        options.generation_preset
+    ):
+        # 같은 입력은 한 곳에서만 생성(Gemini 비용/문서·시트 행 중복 방지)
+        inflight_key = _run_inflight_key(run_key)
+        inflight = {"started_at": time.time(), "owner": uuid.uuid4().hex}
+        if not state.cache_add(inflight_key, inflight, ttl=RUN_INFLIGHT_TTL):
+            progress(
+                "inflight",
+                "같은 학생의 생성이 이미 진행 중입니다. 끝나면 결과를 보여드립니다...",
+            )
+            checkpoint = wait_for_run_result(state, run_key)
+            if "result" not in checkpoint:
+                raise PipelineError(
+                    "inflight",
+                    "진행 중이던 같은 실행이 완료되지 않았습니다. "
+                    "잠시 후 다시 시도하세요.",
+                    deadline,
+                )
+            return {
+                "run_key": run_key,
+                "checkpoint": checkpoint,
+                "reused": True,
+                "attached": True,
+            }
+
+        stage = "services"
+        try:
+            progress(stage, "Google 서비스 연결 중...")
+            drive_service, docs_service, sheets_service = get_google_services()
+
+            # 설정 오류는 Gemini 비용을 쓰기 전에(캐시된 결과면 ms 단위로) 실패
+            stage = "preflight"
+            if options.preflight:
+                progress(stage, "사전 점검(템플릿/폴더/시트/secrets) 중...")
+                health = run_preflight(
+                    state, (drive_service, docs_service, sheets_service)
+                )
+                blockers = preflight_blockers(health, options.auto_gas_format)
+                if blockers:
+                    raise RuntimeError(
+                        "; ".join(f"{r['name']}: {r['detail']}" for r in blockers)
+                    )
+
+            # Gemini 생성 동안 템플릿 사본 풀을 백그라운드로 채움(풀 사용 시)
+            get_template_pool().ensure_warm(
+                TEMPLATE_REPORT_DOC_ID, DRIVE_FOLDER_ID_REPORT
+            )
+            get_template_pool().ensure_warm(
+                TEMPLATE_GUIDE_DOC_ID, DRIVE_FOLDER_ID_GUIDE
+            )
+
+            # 같은 입력의 이전 실행이 중간에 끊겼다면 완료된 단계는 건너뜀
+            if options.force_regen:
+                state.checkpoint_clear(run_key)
+                checkpoint = {}
+            stage = "prompts"
+            versions = prompt_versions()
+            if any(stage_checkpoint(checkpoint, s, versions) for s in versions):
+                progress(stage, "이전 실행에서 완료된 단계는 저장된 결과를 이어서 사용")
+
+            stage = "report"
+            progress(stage, "1단계: 컨설팅 보고서 생성 중...")
+            report_md = stage_checkpoint(checkpoint, "report", versions)
+            if report_md is None and STRUCTURED_REPORT:
+                sections, _ = generate_structured_report(student_name, notes, pdf_bytes)
+                report_md = render_report_sections(sections)
+                state.checkpoint_put(run_key, "report_sections", sections)
+                put_stage_checkpoint(state, run_key, "report", report_md, versions)
+            elif report_md is None:
+                p1 = build_stage1_prompt(student_name, notes)
+                report_md = gemini_generate_text_with_retry(
+                    MODEL_REPORT, p1, pdf_bytes, profile=stage_profile("stage1")
+                )
+                report_md = ensure_report_complete(report_md, student_name)
+                report_md = sanitize_numbered_lists(report_md)
+                put_stage_checkpoint(state, run_key, "report", report_md, versions)
+
+            stage = "summary"
+            progress(stage, "2단계: 보고서 요약 생성 중...")
+            summary_md = stage_checkpoint(checkpoint, "summary", versions)
+            if summary_md is None:
+                p2 = build_stage2_prompt(report_md)
+                summary_md = gemini_generate_text_with_retry(
+                    MODEL_SUMMARY, p2, None, profile=stage_profile("stage2")
+                )
+                summary_md = sanitize_numbered_lists(summary_md)
+                put_stage_checkpoint(state, run_key, "summary", summary_md, versions)
+
+            stage = "homeroom"
+            progress(stage, "3단계: 담임교사용 지도방침 생성 중...")
+            homeroom_md = stage_checkpoint(checkpoint, "homeroom", versions)
+            if homeroom_md is None:
+                p3 = build_stage3_homeroom_prompt(report_md, summary_md)
+                homeroom_md, length_stats = generate_with_length_control(
+                    MODEL_GUIDE, p3, STAGE3_TARGET_BYTES, state
+                )
+                put_stage_checkpoint(state, run_key, "homeroom", homeroom_md, versions)
+                state.checkpoint_put(run_key, "length_control", length_stats)
+
+            stage = "result"
+            progress(stage, "Google Docs 생성/치환 + 시트 기록 중...")
+            report_title, guide_title = make_doc_titles(student_num5, student_name)
+            report_doc_url, report_stats = _make_student_doc(
+                drive_service,
+                docs_service,
+                state,
+                TEMPLATE_REPORT_DOC_ID,
+                report_title,
+                DRIVE_FOLDER_ID_REPORT,
+                student_num5,
+                REPORT_PLACEHOLDERS,
+                {
+                    "{{STUDENT_NAME}}": student_name,
+                    "{{STUDENT_NUM}}": student_num5,
+                    "{{REPORT_CONTENT}}": report_md.strip(),
+                    "{{REPORT_SUMMARY}}": summary_md.strip(),
+                },
+                options.auto_gas_format,
+                run_key,
+                checkpoint_name="report_doc",
+            )
+            guide_doc_url, guide_stats = _make_student_doc(
+                drive_service,
+                docs_service,
+                state,
+                TEMPLATE_GUIDE_DOC_ID,
+                guide_title,
+                DRIVE_FOLDER_ID_GUIDE,
+                student_num5,
+                GUIDE_PLACEHOLDERS,
+                {
+                    "{{STUDENT_NAME}}": student_name,
+                    "{{STUDENT_NUM}}": student_num5,
+                    "{{NOTES_BLOCK}}": notes.strip(),
+                    "{{REPORT_SUMMARY}}": summary_md.strip(),
+                    "{{HOMEROOM_GUIDANCE}}": homeroom_md.strip(),
+                },
+                options.auto_gas_format,
+                run_key,
+                checkpoint_name="guide_doc",
+            )
+
+            # Sheets 기록: A:H 정확 매핑 + 하이퍼링크 문구 통일
+            sheet_row = [
+                grade,  # A 학년
+                klass,  # B 반
+                number,  # C 번호
+                student_num5,  # D 학번
+                student_name,  # E 이름
+                make_hyperlink_formula(report_doc_url, "컨설팅 보고서"),  # F
+                make_hyperlink_formula(guide_doc_url, "조언"),  # G
+                # H 생성시간은 함수에서 자동
+            ]
+            write_row_to_sheet_from_A6(sheets_service, sheet_row, options.sheets_writer)
+
+            state.checkpoint_put(
+                run_key,
+                "result",
+                {
+                    "report_doc_url": report_doc_url,
+                    "guide_doc_url": guide_doc_url,
+                    "docs_stats": [report_stats, guide_stats],
+                    "prompt_versions": versions,
+                    "finished_at": time.time(),
+                    # 모아 둔 행은 flush 뒤에 mark_sheet_rows_written이 해제.
+                    # 기록 전에 끝나면 다시 실행할 때(reused) 이 행을 다시 모은다
+                    "sheet_row": sheet_row,
+                    "sheet_pending": options.sheets_writer is not None,
+                },
+            )
+            # 보고서 문서 → 생성 당시 입력(목차 다시 생성에서 사용)
+            state.cache_set(
+                _doc_run_key(doc_id_from_ref(report_doc_url)),
+                {
+                    "run_key": run_key,
+                    "student_num": student_num5,
+                    "student_name": student_name,
+                    "notes": notes,
+                },
+                ttl=CHECKPOINT_TTL,
+            )
+            succeeded = True
+        except Exception as e:
+            if isinstance(e, HttpError) and stage == "result":
+                failure = f"Google API 오류: {e}"
+            else:
+                failure = f"{STAGE_FAILURE_PREFIX[stage]}: {e}"
+            raise PipelineError(stage, failure, deadline) from e
+        finally:
+            # 오래 걸려 TTL이 지난 사이 다른 실행이 차지했으면 그쪽 표시는 그대로
+            state.cache_delete_if(inflight_key, inflight)
+            if succeeded:
+                clear_run_failure(state, student_num5)
+            else:
+                record_run_failure(state, student_num5, failure)
+
+    return {
+        "run_key": run_key,
+        "checkpoint": state.checkpoint_get(run_key),
+        "reused": False,
+        "attached": False,
+    }
+
+
+# =========================================================
+# 13-1) 목차 1개 다시 생성 — 기존 보고서 문서를 제자리에서 수정
+# =========================================================
+# 전체 재실행(Gemini 3회 + 문서 2개 + 시트 행) 대신 목차 1개만 Gemini 1회로 다시 쓰고
+# 문서에서는 그 범위만 deleteContentRange + insertText로 바꾼다.
+#   - 범위: 목차 제목 문단 다음 ~ 다음 경계 문단(다른 목차 제목/가로줄/[제목] 줄/
+#     제목 스타일 문단) 직전. 앞뒤 빈 문단은 그대로 둔다(간격 유지).
+#   - 마지막 목차 뒤에 경계가 없으면(자동 서식 꺼짐 → [[HR]]가 빈 줄로 지워짐) 뒤의
+#     요약까지 범위에 들어가므로, 체크포인트의 생성 본문과 같은 문단까지만 잡는다.
+#     생성 기록이 없으면 끝을 확정할 수 없어 다시 생성하지 않는다.
+#   - 읽은 뒤 문서가 바뀌었으면(revisionId) 다시 찾아 같은 내용일 때만 1회 재시도.
+#   - 요약/지도방침은 요청했을 때만 다시(지도방침은 새 문서 + 시트 행 갱신).
+
+_BRACKET_TITLE_RE = re.compile(r"^\[[^\]]+\]$")
+_HEADING_STYLES = ("TITLE", "SUBTITLE", "HEADING_")
+_LINE_MARKER_RE = re.compile(r"^(?:#+|[-*•·]|\d+[.)])\s+")
+
+
+def _doc_run_key(doc_id: str) -> str:
+    return f"doc-run:{doc_id}"
+
+
+def doc_id_from_ref(ref: str) -> str:
+    """문서 URL 또는 ID → ID."""
+    m = _DOC_ID_RE.search(ref or "")
+    return m.group(1) if m else (ref or "").strip()
+
+
+def _known_headings() -> Dict[str, str]:
+    """문서에 나올 수 있는 목차 제목 → 목차 키(상위 헤딩은 "")."""
+    known = {parent: "" for _, _, parent in REPORT_SECTIONS if parent}
+    by_number = {}
+    for key, heading, _ in REPORT_SECTIONS:
+        known[heading] = key
+        by_number[heading.split()[0]] = key
+    for heading in REPORT_REQUIRED_SECTIONS:  # 자유 형식 1단계의 제목 표기
+        known.setdefault(heading, by_number.get(heading.split()[0], ""))
+    return known
+
+
+def _match_text(line: str) -> str:
+    """문서 문단 ↔ 생성 텍스트 비교용. 서식 기호/목록 머리/디버그 토큰 차이는 무시."""
+    for token in DEBUG_TOKENS:
+        line = line.replace(token, "")
+    line = _LINE_MARKER_RE.sub("", line.strip()).replace("*", "").replace("`", "")
+    return " ".join(line.split())
+
+
+def _report_section_spans(lines: list) -> Dict[str, Tuple[int, int]]:
+    """
+    보고서 원문 줄 목록에서 목차 키 → (제목 줄, 끝 줄) — 본문은 그 사이.
+    다음 목차/상위 제목 줄이나 [[HR]] 줄에서 끝난다. 같은 제목은 처음 것만.
+    """
+    known = _known_headings()
+    spans: Dict[str, Tuple[int, int]] = {}
+    open_key, open_at = None, 0
+    for i, line in enumerate(lines):
+        text = line.strip()
+        heading = text.rstrip(":")
+        if heading not in known and text != "[[HR]]":
+            continue
+        if open_key:
+            spans[open_key] = (open_at, i)
+        open_key = known.get(heading)
+        if open_key in spans:
+            open_key = None
+        open_at = i
+    if open_key:
+        spans[open_key] = (open_at, len(lines))
+    return spans
+
+
+def generated_report_sections(checkpoint: dict) -> Dict[str, str]:
+    """체크포인트에 남은 목차별 생성 본문(구조화 결과, 없으면 보고서 원문을 나눔)."""
+    if checkpoint.get("report_sections"):
+        return dict(checkpoint["report_sections"])
+    lines = (checkpoint.get("report") or "").split("\n")
+    return {
+        key: "\n".join(lines[start + 1 : end]).strip()
+        for key, (start, end) in _report_section_spans(lines).items()
+    }
+
+
+def splice_report_section(report_md: str, key: str, new_text: str) -> Optional[str]:
+    """
+    보고서 원문에서 목차 1개의 본문만 바꾼다(상위 제목/[[HR]]/마크다운/앞뒤 빈 줄은
+    그대로). 목차 제목을 못 찾으면 None.
+    """
+    lines = report_md.split("\n")
+    span = _report_section_spans(lines).get(key)
+    if span is None:
+        return None
+    start, end = span
+    body = lines[start + 1 : end]
+    filled = [n for n, line in enumerate(body) if line.strip()]
+    if filled:
+        lead, trail = body[: filled[0]], body[filled[-1] + 1 :]
+    else:
+        lead, trail = [""], [""] if end < len(lines) else []
+    new_lines = new_text.strip().split("\n")
+    return "\n".join(lines[: start + 1] + lead + new_lines + trail + lines[end:])
+
+
+def _doc_blocks(content: list) -> list:
+    """본문과 표 셀마다 문단 목록 — 범위는 한 블록 안에서만 찾는다."""
+    blocks, paragraphs = [], []
+    for el in content:
+        if "paragraph" in el:
+            para = el["paragraph"]
+            elements = para.get("elements", [])
+            paragraphs.append(
+                {
+                    "start": el.get("startIndex", 0),
+                    "end": el["endIndex"],
+                    "text": "".join(
+                        e.get("textRun", {}).get("content", "") for e in elements
+                    ).strip(),
+                    "rule": any("horizontalRule" in e for e in elements),
+                    "style": para.get("paragraphStyle", {}).get("namedStyleType", ""),
+                }
+            )
+        elif "table" in el:
+            for row in el["table"].get("tableRows", []):
+                for cell in row.get("tableCells", []):
+                    blocks.extend(_doc_blocks(cell.get("content", [])))
+    return [paragraphs] + blocks
+
+
+class ReportSectionRange:
+    """
+    문서 안 목차 1개의 본문 범위(Docs 인덱스).
+    [start, end)를 지우고 start에 새 본문을 넣으면 된다(end = 마지막 본문 줄바꿈).
+    heading_only면 제목 뒤에 본문 문단이 하나도 없음(start = 제목 줄바꿈 위치).
+    open_ended면 뒤에 경계가 없어 블록 끝까지 잡힘(본문이 어디서 끝나는지 모름).
+    """
+
+    def __init__(
+        self,
+        key: str,
+        heading: str,
+        start: int,
+        end: int,
+        text: str,
+        heading_only: bool,
+        open_ended: bool = False,
+    ):
+        self.key = key
+        self.heading = heading
+        self.start = start
+        self.end = end
+        self.text = text
+        self.heading_only = heading_only
+        self.open_ended = open_ended
+
+
+def _is_section_boundary(p: dict, known: Dict[str, str]) -> bool:
+    return (
+        p["rule"]
+        or p["text"].rstrip(":") in known
+        or bool(_BRACKET_TITLE_RE.match(p["text"]))
+        or p["style"].startswith(_HEADING_STYLES)
+    )
+
+
+def locate_report_sections(
+    doc: dict, generated: Optional[Dict[str, str]] = None
+) -> Dict[str, ReportSectionRange]:
+    """
+    목차 키 → 범위(문서 순서). 같은 제목이 또 나오면 처음 것만.
+    generated(목차 키 → 생성 본문)가 있으면 경계 없이 블록 끝까지 가는 목차는
+    생성 본문에 없는 첫 문단 직전까지만.
+    """
+    known = _known_headings()
+    generated = generated or {}
+    found: Dict[str, ReportSectionRange] = {}
+    for paragraphs in _doc_blocks(doc.get("body", {}).get("content", [])):
+        for i, p in enumerate(paragraphs):
+            heading = p["text"].rstrip(":")
+            key = known.get(heading)
+            if not key or key in found:
+                continue
+            j = i + 1
+            while j < len(paragraphs) and not _is_section_boundary(
+                paragraphs[j], known
+            ):
+                j += 1
+            open_ended = j == len(paragraphs)
+            if open_ended and key in generated:
+                lines = {_match_text(line) for line in generated[key].splitlines()}
+                j = next(
+                    (
+                        n
+                        for n in range(i + 1, j)
+                        if paragraphs[n]["text"]
+                        and _match_text(paragraphs[n]["text"]) not in lines
+                    ),
+                    j,
+                )
+                open_ended = False
+            body = paragraphs[i + 1 : j]
+            filled = [n for n, b in enumerate(body) if b["text"]]
+            if filled:
+                body = body[filled[0] : filled[-1] + 1]
+                start, end = body[0]["start"], body[-1]["end"] - 1
+                text = "\n".join(b["text"] for b in body)
+            elif body:  # 빈 문단만 있음 → 첫 빈 문단에 넣기만
+                start = end = body[0]["start"]
+                text = ""
+            else:
+                start = end = p["end"] - 1
+                text = ""
+            found[key] = ReportSectionRange(
+                key,
+                heading,
+                start,
+                end,
+                text,
+                heading_only=not body,
+                open_ended=open_ended and bool(body),
+            )
+    return found
+
+
+def _utf16_len(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _section_patch_requests(rng: ReportSectionRange, new_text: str) -> list:
+    text = new_text.strip()
+    if rng.heading_only:
+        # 제목 줄바꿈 앞에 "\n본문" → 새 문단이 제목 스타일을 물려받으므로 본문으로 되돌림
+        inserted = "\n" + text
+        para = {
+            "startIndex": rng.start + 1,
+            "endIndex": rng.start + _utf16_len(inserted),
+        }
+        return [
+            {"insertText": {"location": {"index": rng.start}, "text": inserted}},
+            {
+                "updateParagraphStyle": {
+                    "range": para,
+                    "paragraphStyle": {"namedStyleType": "NORMAL_TEXT"},
+                    "fields": "namedStyleType",
+                }
+            },
+            {
+                "updateTextStyle": {
+                    "range": para,
+                    "textStyle": {},
+                    "fields": "bold,italic,underline,fontSize,foregroundColor",
+                }
+            },
+        ]
+    reqs = []
+    if rng.end > rng.start:
+        reqs.append(
+            {
+                "deleteContentRange": {
+                    "range": {"startIndex": rng.start, "endIndex": rng.end}
+                }
+            }
+        )
+    reqs.append({"insertText": {"location": {"index": rng.start}, "text": text}})
+    return reqs
+
+
+def _get_doc(docs_service, doc_id: str) -> dict:
+    return execute_with_retry(
+        lambda: docs_service.documents().get(documentId=doc_id).execute(),
+        label="Docs Get",
+    )
+
+
+def _patch_doc(docs_service, doc_id: str, reqs: list, revision_id: str) -> None:
+    execute_with_retry(
+        lambda: docs_service.documents()
+        .batchUpdate(
+            documentId=doc_id,
+            body={
+                "requests": reqs,
+                "writeControl": {"requiredRevisionId": revision_id},
+            },
+        )
+        .execute(),
+        label="Docs Patch",
+    )
+
+
+def patch_report_section(
+    docs_service,
+    doc_id: str,
+    doc: dict,
+    rng: ReportSectionRange,
+    new_text: str,
+    generated: Optional[Dict[str, str]] = None,
+) -> None:
+    """읽은 뒤 문서가 바뀌었으면 다시 찾아서, 그 목차가 그대로일 때만 재시도."""
+    try:
+        _patch_doc(
+            docs_service,
+            doc_id,
+            _section_patch_requests(rng, new_text),
+            doc["revisionId"],
+        )
+        return
+    except HttpError as e:
+        if getattr(e.resp, "status", None) != 400:
+            raise
+    doc = _get_doc(docs_service, doc_id)
+    fresh = locate_report_sections(doc, generated).get(rng.key)
+    if fresh is None or fresh.text != rng.text:
+        raise RuntimeError(
+            "다시 생성하는 동안 문서의 이 목차가 수정되었습니다. 다시 시도하세요."
+        )
+    _patch_doc(
+        docs_service,
+        doc_id,
+        _section_patch_requests(fresh, new_text),
+        doc["revisionId"],
+    )
+
+
+def replace_doc_paragraphs(docs_service, doc_id: str, old: str, new: str) -> bool:
+    """
+    문서에서 old와 같은 문단 묶음(빈 줄 무시)을 찾아 new로 교체. 못 찾으면 False.
+    GAS 서식 적용 뒤에도 찾도록 _match_text로 서식 기호/목록 머리를 빼고 비교.
+    """
+    lines = [t for t in map(_match_text, old.splitlines()) if t]
+    if not lines:
+        return False
+    doc = _get_doc(docs_service, doc_id)
+    for paragraphs in _doc_blocks(doc.get("body", {}).get("content", [])):
+        filled = [p for p in paragraphs if _match_text(p["text"])]
+        for i in range(len(filled) - len(lines) + 1):
+            window = filled[i : i + len(lines)]
+            if [_match_text(p["text"]) for p in window] != lines:
+                continue
+            rng = ReportSectionRange(
+                "",
+                "",
+                filled[i]["start"],
+                filled[i + len(lines) - 1]["end"] - 1,
+                old,
+                heading_only=False,
+            )
+            _patch_doc(
+                docs_service,
+                doc_id,
+                _section_patch_requests(rng, new),
+                doc["revisionId"],
+            )
+            return True
+    return False
+
+
+def _name_from_title(title: str) -> str:
+    """make_doc_titles 형식("학번_이름")의 문서 제목 → 이름."""
+    parts = title.split("_", 1)
+    return parts[1].strip() if len(parts) == 2 else title.strip()
+
+
+def regenerate_report_section(
+    report_doc: str,
+    section_key: str,
+    request: str = "",
+    pdf_bytes: Optional[bytes] = None,
+    refresh_guide: bool = False,
+    options: Optional[RunOptions] = None,
+    on_progress: Optional[Callable[[str, str], None]] = None,
+    state: Optional[SharedStateBackend] = None,
+) -> dict:
+    """
+    기존 보고서 문서(URL/ID)의 목차 1개를 다시 생성해 그 범위만 바꾼다.
+    refresh_guide면 요약/지도방침도 다시 만든다(생성 기록이 남아 있을 때만).
+    반환: {"report_doc_url", "heading", "old_text", "new_text", "guide_doc_url",
+           "gemini_calls"}
+    실패: PipelineError
+    """
+    options = options or RunOptions()
+    state = state or get_shared_state()
+    doc_id = doc_id_from_ref(report_doc)
+    report_doc_url = f"https://docs.google.com/document/d/{doc_id}/edit"
+
+    def progress(stage: str, message: str) -> None:
+        if on_progress:
+            on_progress(stage, message)
+
+    with run_deadline(options.deadline_seconds) as deadline, use_generation_preset(
+        options.generation_preset
+    ):
+        stage = "services"
+        patched = False
+        try:
+            progress(stage, "Google 서비스 연결 중...")
+            drive_service, docs_service, sheets_service = get_google_services()
+
+            stage = "section"
+            progress(stage, "문서에서 목차 찾는 중...")
+            doc = _get_doc(docs_service, doc_id)
+            # 생성 당시 입력(학번/이름/메모) — 없으면 제목에서 이름만
+            origin = state.cache_get(_doc_run_key(doc_id)) or {}
+            run_key = origin.get("run_key")
+            checkpoint = state.checkpoint_get(run_key) if run_key else {}
+            generated = generated_report_sections(checkpoint)
+            sections = locate_report_sections(doc, generated)
+            target = sections.get(section_key)
+            if target is None:
+                raise ValueError("문서에서 해당 목차 제목을 찾을 수 없습니다.")
+            if target.open_ended:
+                raise ValueError(
+                    "이 목차 뒤에 경계가 없고 생성 기록도 없어(보관 기간 경과 등) "
+                    "본문이 어디서 끝나는지 알 수 없습니다."
+                )
+            if refresh_guide and not origin:
+                raise ValueError(
+                    "이 문서의 생성 기록이 없어(보관 기간 경과 등) "
+                    "요약/지도방침은 다시 만들 수 없습니다."
+                )
+            student_name = origin.get("student_name") or _name_from_title(
+                doc.get("title", "")
+            )
+            notes = origin.get("notes", "")
+
+            progress(stage, f"'{target.heading}' 다시 생성 중...")
+            written = "\n\n".join(
+                f"{r.heading}\n{r.text}"
+                for k, r in sections.items()
+                if k != section_key and r.text
+            )
+            prompt = get_prompt_templates()["section_rewrite"].render(
+                heading=target.heading,
+                current=target.text or "(비어 있음)",
+                request=request.strip() or "(없음)",
+                written=written,
+                stage1_prompt=build_stage1_prompt(student_name, notes),
+            )
+            new_text = gemini_generate_text_with_retry(
+                MODEL_REPORT, prompt, pdf_bytes, profile=stage_profile("continuation")
+            )
+            new_text = clean_generated_text(
+                _strip_heading_line(new_text, target.heading)
+            ).strip()
+            if not new_text:
+                raise RuntimeError("생성된 본문이 비어 있습니다.")
+            gemini_calls = 1
+
+            stage = "patch"
+            progress(stage, "문서의 해당 범위만 바꾸는 중...")
+            patch_report_section(docs_service, doc_id, doc, target, new_text, generated)
+            patched = True
+            old_text = target.text
+            target.text = new_text
+
+            # 같은 입력으로 다시 실행하면 고친 보고서를 이어 쓰도록 체크포인트도 갱신.
+            # 저장된 원문에 그 목차만 끼워 넣는다(상위 제목/[[HR]]/마크다운 유지).
+            # 원문에서 목차를 못 찾으면 덮어쓰지 않고, 프롬프트에는 문서 텍스트를 쓴다
+            report_md = splice_report_section(
+                checkpoint.get("report", ""), section_key, new_text
+            )
+            if report_md is not None:
+                state.checkpoint_put(run_key, "report", report_md)
+            else:
+                report_md = "\n\n".join(
+                    f"{r.heading}\n\n{r.text}" for r in sections.values()
+                )
+            if "report_sections" in checkpoint:
+                state.checkpoint_put(
+                    run_key,
+                    "report_sections",
+                    dict(checkpoint["report_sections"], **{section_key: new_text}),
+                )
+
+            guide_doc_url = None
+            if refresh_guide:
+                versions = prompt_versions()
+                stage = "summary"
+                progress(stage, "2단계: 보고서 요약 다시 생성 중...")
+                summary_md = gemini_generate_text_with_retry(
+                    MODEL_SUMMARY,
+                    build_stage2_prompt(report_md),
+                    None,
+                    profile=stage_profile("stage2"),
+                )
+                summary_md = sanitize_numbered_lists(summary_md)
+
+                stage = "homeroom"
+                progress(stage, "3단계: 담임교사용 지도방침 다시 생성 중...")
+                homeroom_md, length_stats = generate_with_length_control(
+                    MODEL_GUIDE,
+                    build_stage3_homeroom_prompt(report_md, summary_md),
+                    STAGE3_TARGET_BYTES,
+                    state,
+                )
+                gemini_calls += 2
+
+                stage = "result"
+                progress(stage, "요약 교체 + 지도방침 문서 생성 + 시트 갱신 중...")
+                if not replace_doc_paragraphs(
+                    docs_service, doc_id, checkpoint.get("summary", ""), summary_md
+                ):
+                    # 요약만 어긋난 문서가 되지 않도록 지도방침 문서/시트도 그대로 둔다
+                    raise RuntimeError(
+                        "목차는 바꿨지만 보고서 문서에서 이전 요약을 찾지 못했습니다"
+                        "(직접 고친 경우 등). 요약/지도방침은 바꾸지 않았습니다."
+                    )
+                old_guide_url = (checkpoint.get("result") or {}).get("guide_doc_url")
+                student_num5 = origin["student_num"]
+                _, guide_title = make_doc_titles(student_num5, student_name)
+                guide_doc_url, _ = _make_student_doc(
+                    drive_service,
+                    docs_service,
+                    state,
+                    TEMPLATE_GUIDE_DOC_ID,
+                    guide_title,
+                    DRIVE_FOLDER_ID_GUIDE,
+                    student_num5,
+                    GUIDE_PLACEHOLDERS,
+                    {
+                        "{{STUDENT_NAME}}": student_name,
+                        "{{STUDENT_NUM}}": student_num5,
+                        "{{NOTES_BLOCK}}": notes.strip(),
+                        "{{REPORT_SUMMARY}}": summary_md.strip(),
+                        "{{HOMEROOM_GUIDANCE}}": homeroom_md.strip(),
+                    },
+                    options.auto_gas_format,
+                )
+                grade, klass, number = parse_student_num5(student_num5)
+                write_row_to_sheet_from_A6(
+                    sheets_service,
+                    [
+                        grade,
+                        klass,
+                        number,
+                        student_num5,
+                        student_name,
+                        make_hyperlink_formula(report_doc_url, "컨설팅 보고서"),
+                        make_hyperlink_formula(guide_doc_url, "조언"),
+                    ],
+                )
+                if run_key:
+                    put_stage_checkpoint(
+                        state, run_key, "summary", summary_md, versions
+                    )
+                    put_stage_checkpoint(
+                        state, run_key, "homeroom", homeroom_md, versions
+                    )
+                    state.checkpoint_put(run_key, "length_control", length_stats)
+                    if "result" in checkpoint:
+                        state.checkpoint_put(
+                            run_key,
+                            "result",
+                            dict(checkpoint["result"], guide_doc_url=guide_doc_url),
+                        )
+                # 시트가 새 문서를 가리킨 뒤에만 이전 지도방침 문서를 휴지통으로
+                if old_guide_url and old_guide_url != guide_doc_url:
+                    try:
+                        trash_file(
+                            drive_service,
+                            doc_id_from_ref(old_guide_url),
+                            label="Drive Trash Old Guide",
+                        )
+                    except Exception as e:
+                        notify(
+                            "warning",
+                            f"이전 지도방침 문서를 휴지통으로 옮기지 못했습니다: {e}",
+                        )
+        except Exception as e:
+            raise PipelineError(
+                stage, f"{STAGE_FAILURE_PREFIX[stage]}: {e}", deadline
+            ) from e
+        finally:
+            # 목차/요약 교체가 모두 끝난 뒤 1번만 서식 적용(실패해도 바뀐 목차는 서식)
+            if patched and options.auto_gas_format:
+                get_gas_format_queue().submit(
+                    doc_id,
+                    doc.get("title", ""),
+                    _cleanup_debug_tokens_in_worker,
+                    run_key=run_key,
+                )
+
+    return {
+        "report_doc_url": report_doc_url,
+        "heading": target.heading,
+        "old_text": old_text,
+        "new_text": new_text,
+        "guide_doc_url": guide_doc_url,
+        "gemini_calls": gemini_calls,
+    }
+
+
+# =========================================================
+# 13-2) Gemini Batch API — 학년 단위 야간 일괄 생성
+# =========================================================
+# 수백 명을 대화형으로 부르면 분당 한도에 걸리고 요금도 정가다. Batch API는 요청을
+# 작업 1개로 묶어 보내고(할인 요금, 별도 한도) 최대 24시간 안에 결과를 돌려준다.
+#   1단계(학생 전원) 작업 → 완료 대기 → 2단계 작업 → 대기 → 3단계 작업 → 대기
+#   → 문서/시트는 run_student_pipeline()(저장된 단계는 건너뛰므로 Gemini 호출 없음)
+# 단계 결과는 보통 실행과 같은 체크포인트/프롬프트 버전으로 저장한다.
+# 제출한 작업 이름은 공유 상태에 두므로, 기다리는 중에 프로세스가 죽어도
+# 같은 명단으로 다시 실행하면 새로 제출하지 않고 그 작업을 이어서 기다린다.
+
+BATCH_POLL_INTERVAL = 30.0  # 상태 조회 간격(초)
+BATCH_MAX_WAIT = 24 * 3600  # Batch API 처리 목표 시간(초)
+BATCH_JOB_TTL = 48 * 3600  # 제출한 작업 이름 보관(초)
+BATCH_FILE_TTL = 47 * 3600  # 올린 PDF URI 재사용(Files API 보관 48시간보다 짧게)
+BATCH_INLINE_MAX_BYTES = 18 * 1024 * 1024  # 넘으면 JSONL 파일 입력(인라인 한도 20MB)
+BATCH_DONE_STATES = (
+    "JOB_STATE_SUCCEEDED",
+    "JOB_STATE_FAILED",
+    "JOB_STATE_CANCELLED",
+    "JOB_STATE_EXPIRED",
+)
+BATCH_STAGES = (
+    ("report", MODEL_REPORT, "stage1"),
+    ("summary", MODEL_SUMMARY, "stage2"),
+    ("homeroom", MODEL_GUIDE, "stage3"),
+)
+
+
+class GeminiBatchEndpoint:
+    """
+    Gemini Batch API. 결과는 요청 순서대로 돌려준다.
+    PDF는 Files API로 올리고 URI만 넣는다. 그래도 요청 전체가
+    BATCH_INLINE_MAX_BYTES를 넘으면(학년 전체의 긴 2·3단계 프롬프트 등)
+    인라인 대신 JSONL 파일을 올려 입력으로 쓴다.
+    """
+
+    def __init__(self, state: SharedStateBackend):
+        self.state = state
+
+    def _pdf_part(self, pdf_bytes: bytes):
+        key = f"gemini-file:{hashlib.sha256(pdf_bytes).hexdigest()}"
+        uri = self.state.cache_get(key)
+        if uri is None:
+            uploaded = get_gemini_client().files.upload(
+                file=io.BytesIO(pdf_bytes),
+                config=types.UploadFileConfig(mime_type="application/pdf"),
+            )
+            uri = uploaded.uri
+            self.state.cache_set(key, uri, ttl=BATCH_FILE_TTL)
+        return types.Part.from_uri(file_uri=uri, mime_type="application/pdf")
+
+    def _content(self, r: dict) -> "types.Content":
+        parts = [types.Part.from_text(text=r["prompt"])]
+        if r.get("pdf"):
+            parts.append(self._pdf_part(r["pdf"]))
+        return types.Content(role="user", parts=parts)
+
+    @staticmethod
+    def _jsonl_line(key: int, content: "types.Content", config) -> str:
+        """파일 입력 1줄(REST 형식). http_options(타임아웃)는 요청 본문이 아님."""
+        dump = dict(mode="json", exclude_none=True, by_alias=True)
+        request = {
+            "contents": [content.model_dump(**dump)],
+            "generationConfig": config.model_dump(exclude={"http_options"}, **dump),
+        }
+        return json.dumps({"key": str(key), "request": request}, ensure_ascii=False)
+
+    def submit(self, model: str, requests: list, display_name: str) -> str:
+        client = get_gemini_client()
+        contents = [self._content(r) for r in requests]
+        lines = [
+            self._jsonl_line(i, content, r["config"])
+            for i, (content, r) in enumerate(zip(contents, requests))
+        ]
+        payload = "\n".join(lines).encode("utf-8")
+        if len(payload) > BATCH_INLINE_MAX_BYTES:
+            uploaded = client.files.upload(
+                file=io.BytesIO(payload),
+                config=types.UploadFileConfig(
+                    mime_type="jsonl", display_name=display_name
+                ),
+            )
+            src = uploaded.name
+        else:
+            src = [
+                types.InlinedRequest(contents=[content], config=r["config"])
+                for content, r in zip(contents, requests)
+            ]
+        job = client.batches.create(
+            model=model,
+            src=src,
+            config=types.CreateBatchJobConfig(display_name=display_name),
+        )
+        return job.name
+
+    @staticmethod
+    def _result(response, error) -> dict:
+        if error or response is None:
+            return {"error": str(error or "응답 없음")}
+        text = (response.text or "").strip()
+        return dict(_usage_meta(response), text=text)
+
+    @classmethod
+    def _file_results(cls, data: bytes) -> list:
+        """
+        JSONL 결과 파일 → 요청 순서(key)대로. 줄 순서는 보장되지 않는다.
+        빠진 key는 오류로 채운다(맨 뒤에서 빠진 것은 호출 쪽에서 "결과 없음").
+        """
+        by_key = {}
+        for line in data.decode("utf-8").splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get("response")
+            if response:
+                response = types.GenerateContentResponse.model_validate(response)
+            by_key[int(item["key"])] = cls._result(response, item.get("error"))
+        count = max(by_key) + 1 if by_key else 0
+        return [by_key.get(i, {"error": "응답 없음"}) for i in range(count)]
+
+    def poll(self, name: str) -> Tuple[str, Optional[list]]:
+        """반환: (상태, 결과 목록 — 성공 전엔 None). 결과: {"text", 사용량} 또는 {"error"}"""
+        client = get_gemini_client()
+        job = client.batches.get(name=name)
+        status = getattr(job.state, "name", str(job.state))
+        if status != "JOB_STATE_SUCCEEDED":
+            return status, None
+        if job.dest.file_name:
+            data = client.files.download(file=job.dest.file_name)
+            return status, self._file_results(data)
+        return status, [
+            self._result(item.response, item.error)
+            for item in job.dest.inlined_responses or []
+        ]
+
+
+def _local_batch_responder(model: str, request: dict) -> str:
+    """목차를 모두 갖춘 짧은 더미 글(완결성 검사를 통과 → 추가 Gemini 호출 없음)."""
+    tag = hashlib.sha256(request["prompt"].encode("utf-8")).hexdigest()[:8]
+    if request.get("json"):
+        return json.dumps(
+            {key: f"로컬 배치 응답 {tag}." for key, _, _ in REPORT_SECTIONS},
+            ensure_ascii=False,
+        )
+    return "\n\n".join(f"{h}\n로컬 배치 응답 {tag}." for h in REPORT_REQUIRED_SECTIONS)
+
+
+class LocalBatchEndpoint:
+    """
+    Batch API 오프라인 대용(개발/점검용) — Gemini를 부르지 않는다.
+    responder(model, request) → 텍스트. 예외를 던지면 그 요청만 실패로 돌려준다.
+    작업은 complete_after초 뒤에 끝난 것으로 보인다(대기 흐름 점검용).
+    """
+
+    def __init__(
+        self,
+        responder: Optional[Callable[[str, dict], str]] = None,
+        complete_after: float = 0.0,
+    ):
+        self.responder = responder or _local_batch_responder
+        self.complete_after = complete_after
+        self.jobs: Dict[str, dict] = {}
+
+    def submit(self, model: str, requests: list, display_name: str) -> str:
+        name = f"local-batches/{uuid.uuid4().hex[:12]}"
+        self.jobs[name] = {
+            "model": model,
+            "requests": list(requests),
+            "display_name": display_name,
+            "ready_at": time.time() + self.complete_after,
+        }
+        return name
+
+    def poll(self, name: str) -> Tuple[str, Optional[list]]:
+        job = self.jobs.get(name)
+        if job is None:  # 다른 프로세스에서 만든 작업 → 다시 제출하게
+            return "JOB_STATE_EXPIRED", None
+        if time.time() < job["ready_at"]:
+            return "JOB_STATE_RUNNING", None
+        results = []
+        for r in job["requests"]:
+            try:
+                text = self.responder(job["model"], r)
+            except Exception as e:
+                results.append({"error": str(e)})
+                continue
+            results.append(
+                {
+                    "text": text,
+                    "output_tokens": max(1, len(text.encode("utf-8")) // 3),
+                    "thinking_tokens": 0,
+                    "finish_reason": "STOP",
+                }
+            )
+        return "JOB_STATE_SUCCEEDED", results
+
+
+class BatchRun:
+    """
+    학생 여러 명의 1→2→3단계를 단계마다 Batch 작업 1개로 생성한다.
+    students: [{"student_num", "student_name", "pdf_bytes", "notes"}]
+    run() 반환: {학번: {"run_key", "status": "ready"/"done"/"failed", "stage", "error"}}
+      ready = 생성 끝(문서/시트 남음), done = 이전에 문서까지 끝남
+    """
+
+    def __init__(
+        self,
+        students: list,
+        endpoint=None,
+        options: Optional[RunOptions] = None,
+        state: Optional[SharedStateBackend] = None,
+        on_progress: Optional[Callable[[str, str], None]] = None,
+        poll_interval: float = BATCH_POLL_INTERVAL,
+        max_wait: float = BATCH_MAX_WAIT,
+    ):
+        self.state = state or get_shared_state()
+        self.endpoint = endpoint or GeminiBatchEndpoint(self.state)
+        self.options = options or RunOptions()
+        self.on_progress = on_progress
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.items = []
+        for s in students:
+            name = s["student_name"].strip()
+            run_key = make_run_key(s["student_num"], name, s["pdf_bytes"], s["notes"])
+            self.items.append(dict(s, student_name=name, run_key=run_key))
+        keys = "\0".join(sorted(item["run_key"] for item in self.items))
+        self.batch_id = hashlib.sha256(keys.encode("utf-8")).hexdigest()[:16]
+        self.failed: Dict[str, Tuple[str, str]] = {}  # run_key → (단계, 오류)
+
+    def _progress(self, stage: str, message: str) -> None:
+        if self.on_progress:
+            self.on_progress(stage, message)
+
+    def _request(
+        self,
+        stage: str,
+        item: dict,
+        checkpoint: dict,
+        cap,
+        profile: Optional[GenerationProfile] = None,
+    ) -> dict:
+        _, model, profile_stage = next(s for s in BATCH_STAGES if s[0] == stage)
+        profile = profile or stage_profile(profile_stage)
+        name, notes = item["student_name"], item["notes"]
+        if stage == "report" and STRUCTURED_REPORT:
+            _, prompt = build_structured_stage1_prompt(name, notes)
+            return {
+                "prompt": prompt,
+                "pdf": item["pdf_bytes"],
+                "json": True,
+                "config": profile.config(model, None, report_response_schema()),
+            }
+        if stage == "report":
+            prompt, pdf = build_stage1_prompt(name, notes), item["pdf_bytes"]
+        elif stage == "summary":
+            prompt, pdf = build_stage2_prompt(checkpoint["report"]), None
+        else:
+            prompt = build_stage3_homeroom_prompt(
+                checkpoint["report"], checkpoint["summary"]
+            )
+            pdf = None
+        return {"prompt": prompt, "pdf": pdf, "config": profile.config(model, cap)}
+
+    def _finish(self, stage: str, item: dict, job: dict, result: dict, versions):
+        """결과 1개 후처리 → 보통 실행과 같은 체크포인트로 저장."""
+        run_key, name, text = item["run_key"], item["student_name"], result["text"]
+        if stage == "report" and job.get("json"):
+            # 빠진 목차가 있으면 그 목차만 대화형으로 보충(드묾)
+            sections, _ = finish_structured_report(
+                text, build_stage1_prompt(name, item["notes"]), item["pdf_bytes"]
+            )
+            self.state.checkpoint_put(run_key, "report_sections", sections)
+            value = render_report_sections(sections)
+        elif stage == "report":
+            value = sanitize_numbered_lists(ensure_report_complete(text, name))
+        elif stage == "summary":
+            value = sanitize_numbered_lists(text)
+        else:
+            profile = stage_profile("stage3")
+            controller = length_controller(self.state, profile)
+            meta = dict(result, max_output_tokens=job["max_output_tokens"])
+            if not text and result.get("finish_reason") == "MAX_TOKENS":
+                checkpoint = self.state.checkpoint_get(run_key)
+                text, meta = _generate_without_length_cap(
+                    MODEL_GUIDE,
+                    build_stage3_homeroom_prompt(
+                        checkpoint["report"], checkpoint["summary"]
+                    ),
+                    profile,
+                )
+            value, stats = finish_length_controlled(
+                text, meta, STAGE3_TARGET_BYTES, controller
+            )
+            self.state.checkpoint_put(run_key, "length_control", stats)
+        put_stage_checkpoint(self.state, run_key, stage, value, versions)
+
+    def _fail(self, item: dict, stage: str, error: str) -> None:
+        self.failed[item["run_key"]] = (stage, error)
+        record_run_failure(
+            self.state, item["student_num"], f"{STAGE_FAILURE_PREFIX[stage]}: {error}"
+        )
+
+    def _wait(self, stage: str, name: str) -> Tuple[str, Optional[list]]:
+        started = time.time()
+        while True:
+            try:
+                status, results = self.endpoint.poll(name)
+            except Exception as e:  # 조회 오류는 다음 조회에서 다시
+                logger.warning("배치 상태 조회 실패(%s): %s", name, e)
+                status, results = "", None
+            if status in BATCH_DONE_STATES:
+                return status, results
+            if time.time() - started > self.max_wait:
+                return "TIMEOUT", None
+            waited = int(time.time() - started)
+            self._progress(stage, f"배치 작업 대기 중 ({status or '?'}, {waited}초)")
+            time.sleep(self.poll_interval)
+
+    def run_stage(self, stage: str, versions: Dict[str, str]) -> None:
+        todo = []
+        for item in self.items:
+            if item["run_key"] in self.failed:
+                continue
+            checkpoint = self.state.checkpoint_get(item["run_key"])
+            if "result" in checkpoint:
+                continue
+            if stage_checkpoint(checkpoint, stage, versions) is None:
+                todo.append((item, checkpoint))
+        if not todo:
+            return
+
+        model = next(s[1] for s in BATCH_STAGES if s[0] == stage)
+        job_key = f"batch-job:{self.batch_id}:{stage}:{versions[stage]}"
+        job = self.state.cache_get(job_key)
+        keys = [item["run_key"] for item, _ in todo]
+        if job is not None and set(keys) <= set(job["run_keys"]):
+            self._progress(stage, f"제출된 배치 작업을 이어서 기다림: {job['name']}")
+        else:
+            cap = profile = None
+            if stage == "homeroom":
+                profile = stage_profile("stage3")
+                cap, profile = length_controller(self.state, profile).budget(
+                    STAGE3_TARGET_BYTES, model, profile
+                )
+            requests = [
+                self._request(stage, item, cp, cap, profile) for item, cp in todo
+            ]
+            self._progress(stage, f"배치 작업 제출: {len(requests)}건 ({model})")
+            try:
+                name = self.endpoint.submit(
+                    model, requests, f"h-app-{stage}-{self.batch_id}"
+                )
+            except Exception as e:
+                for item, _ in todo:
+                    self._fail(item, stage, f"배치 제출 실패: {e}")
+                return
+            job = {
+                "name": name,
+                "run_keys": keys,
+                "json": bool(requests[0].get("json")),
+                "max_output_tokens": cap,
+            }
+            self.state.cache_set(job_key, job, ttl=BATCH_JOB_TTL)
+
+        status, results = self._wait(stage, job["name"])
+        self.state.cache_delete(job_key)  # 끝난 작업 — 다시 실행하면 남은 것만 새로
+        if results is None:
+            for item, _ in todo:
+                self._fail(item, stage, f"배치 작업 {status}")
+            return
+        by_key = dict(zip(job["run_keys"], results))
+        for item, _ in todo:
+            result = by_key.get(item["run_key"]) or {"error": "결과 없음"}
+            try:
+                if "error" in result:
+                    raise RuntimeError(result["error"])
+                self._finish(stage, item, job, result, versions)
+            except Exception as e:
+                self._fail(item, stage, str(e))
+        done = len(todo) - sum(1 for item, _ in todo if item["run_key"] in self.failed)
+        label = dict(RUN_STAGE_LABELS)[stage]
+        self._progress(stage, f"{label} 배치 완료: {done}/{len(todo)}건")
+
+    def run(self) -> Dict[str, dict]:
+        with use_generation_preset(self.options.generation_preset):
+            if self.options.force_regen:
+                for item in self.items:
+                    self.state.checkpoint_clear(item["run_key"])
+            versions = prompt_versions()
+            for stage, _, _ in BATCH_STAGES:
+                self.run_stage(stage, versions)
+
+        outcome = {}
+        for item in self.items:
+            row = {"run_key": item["run_key"], "status": "ready"}
+            if item["run_key"] in self.failed:
+                stage, error = self.failed[item["run_key"]]
+                row.update(status="failed", stage=stage, error=error)
+            elif "result" in self.state.checkpoint_get(item["run_key"]):
+                row["status"] = "done"
+            outcome[item["student_num"]] = row
+        return outcome
@@ -0,0 +1,67 @@
+# 후처리 마이크로벤치마크: 이전 구현(여러 번 순회) vs TextPostProcessor(1회 순회)
+#
+#   python tests/bench_postprocess.py [문단 수]
+#
+# 짧은 문단 말뭉치와 수천 줄짜리 보고서 전문 각각에 대해, 같은 입력으로 규칙별
+# 이전 함수 체인과 새 처리기를 번갈아 돌려 최솟값을 비교한다.
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import legacy_postprocess as legacy  # noqa: E402
+from h_pipeline import DEBUG_TOKENS, TextPostProcessor  # noqa: E402
+from postprocess_corpus import corpus, full_reports  # noqa: E402
+
+CASES = {
+    "sanitize": (
+        legacy.sanitize_numbered_lists,
+        lambda t: TextPostProcessor().process(t),
+    ),
+    "sanitize+tokens": (
+        lambda t: legacy.remove_debug_tokens(legacy.sanitize_numbered_lists(t)),
+        lambda t: TextPostProcessor(strip_tokens=DEBUG_TOKENS).process(t),
+    ),
+    "trim+sanitize": (
+        lambda t: legacy.sanitize_numbered_lists(
+            legacy.trim_korean_text_safely(t, 9000)
+        ),
+        lambda t: TextPostProcessor(max_utf8_bytes=9000).process(t),
+    ),
+}
+
+
+def bench(texts: list, repeat: int = 5) -> list:
+    rows = []
+    for name, (old, new) in CASES.items():
+        t_old = min(
+            timeit.repeat(lambda: [old(t) for t in texts], number=1, repeat=repeat)
+        )
+        t_new = min(
+            timeit.repeat(lambda: [new(t) for t in texts], number=1, repeat=repeat)
+        )
+        rows.append((name, t_old, t_new))
+    return rows
+
+
+def report(title: str, texts: list) -> None:
+    print(
+        f"{title}: {len(texts)}개, {sum(len(t.encode('utf-8')) for t in texts)}바이트"
+    )
+    for name, t_old, t_new in bench(texts):
+        print(
+            f"{name:16s} 이전 {t_old * 1000:8.1f}ms  새 {t_new * 1000:8.1f}ms"
+            f"  ({t_old / t_new:.2f}x)"
+        )
+
+
+def main() -> None:
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    report("짧은 문단", corpus(n, seed=1))
+    report("보고서 전문(수천 줄)", full_reports())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# 단일 패스 후처리(TextPostProcessor) 이전 구현 — 골든 테스트/벤치마크 기준값.
+# 원래 H_App.py에 있던 코드를 그대로 옮겼다(수정하지 말 것).
+import re
+
+# remove_debug_tokens_after_format()가 replaceAllText로 지우던 토큰(순서 그대로)
+DEBUG_TOKENS = {
+    # 공용
+    "[[HR]]": "",
+    "=== 본문 시작 ===": "",
+    # 보고서 템플릿
+    "{{REPORT_ANCHOR}}": "",
+    # 담임 템플릿
+    "{{GUIDE_ANCHOR}}": "",
+    "[[NOTES_START]]": "",
+    "[[NOTES_END]]": "",
+}
+
+
+def is_heading_line(line: str) -> bool:
+    s = line.strip()
+    if not re.match(r"^\d+(-\d+){0,2}\.\s+\S+", s):
+        return False
+    if len(s) > 40:
+        return False
+    if s.endswith(("다.", "요.", ".")):
+        return False
+    return True
+
+
+def sanitize_numbered_lists(text: str) -> str:
+    lines = text.splitlines()
+    processed = []
+    for line in lines:
+        stripped = line.strip()
+
+        # ✅ 헤더는 무조건 보호
+        if is_heading_line(stripped):
+            processed.append(stripped)
+            continue
+
+        # ❌ 일반 숫자 목록만 변환
+        if re.match(r"^\d+\.\s+", stripped):
+            body = stripped.split(".", 1)[1].strip()
+            processed.append(f"- {body}")
+        else:
+            processed.append(line)
+    return "\n".join(processed)
+
+
+def trim_korean_text_safely(text: str, max_utf8_bytes: int = 9000) -> str:
+    t = (text or "").strip()
+    if not t:
+        return t
+    if len(t.encode("utf-8")) <= max_utf8_bytes:
+        return t
+
+    b = t.encode("utf-8")[:max_utf8_bytes]
+    return b.decode("utf-8", errors="ignore").strip()
+
+
+def remove_debug_tokens(text: str) -> str:
+    """Docs replaceAllText를 토큰 순서대로 적용한 것과 같은 결과."""
+    for token, repl in DEBUG_TOKENS.items():
+        text = text.replace(token, repl)
+    return text
@@ -0,0 +1,107 @@
+import random
+
+from legacy_postprocess import DEBUG_TOKENS
+
+_WORDS = ["학생은", "탐구", "활동에서", "문제를", "해결했다.", "성장", "3.", "A", "다."]
+_LINES = [
+    "1. 학업 역량",
+    "2-1. 세부 능력",
+    "1. 수학 시간에 적극적으로 참여했다.",
+    "  3.  발표를 맡았다  ",
+    "10. 항목",
+    "1.내용(공백 없음)",
+    "- 이미 목록",
+    "### 강점 5개",
+    "",
+    "   ",
+    "12. 아주 길어서 제목으로 보기 어려운 줄은 숫자 목록으로 바뀌어야 하는 문장입니다",
+]
+
+# 실제 1단계 보고서 모양: 목차 제목, 하위 제목, 숫자 목록, 긴 문단, [[HR]]
+_HEADINGS = [
+    "1. 학생을 위한 한마디",
+    "2. 컨설팅 종합 분석",
+    "3. 대학 전공 추천",
+    "4. 1학년 활동 문제점 및 보완 전략",
+    "5. 추천 도서",
+    "6. 창체 영역별 상세 컨설팅",
+    "6-1. 창의적 체험활동#1 자율활동",
+    "6-2. 창의적 체험활동#2 진로활동",
+    "6-3. 창의적 체험활동#3 동아리활동",
+    "6-4. 창의적 체험활동#4 봉사활동",
+    "7. 2학년 교과별 전략 / 수업 태도 개선 전략",
+    "8. 인성 및 행동특성 종합 의견",
+]
+_SUBHEADINGS = ["### 강점", "### 보완점", "**핵심 요약**", "[요약]", "2-1-3. 세부"]
+_SENTENCES = [
+    "학생은 수학 시간에 모둠 토의를 이끌며 풀이 과정을 논리적으로 설명했다.",
+    "과학 탐구 보고서에서 변인 통제의 한계를 스스로 찾아 보완 실험을 설계함.",
+    "진로 활동에서 생명공학 연구원을 희망하며 관련 독서를 꾸준히 이어 갔습니다.",
+    "동아리 활동 기록이 단편적이므로 2학년에는 주제 탐구로 연결하는 것이 좋다.",
+    "봉사 시간은 충분하나 활동의 의미를 성찰한 기록이 부족합니다.",
+    "3. 학기 말 발표에서 보여 준 태도는 인상적이었다.",
+    "(예: 1. 실험 설계 2. 결과 분석) 순서로 정리하면 좋다.",
+]
+
+
+def random_text(rng: random.Random) -> str:
+    """헤딩/숫자목록/토큰/공백/한글이 섞인 텍스트."""
+    lines = []
+    for _ in range(rng.randint(0, 30)):
+        kind = rng.random()
+        if kind < 0.4:
+            line = rng.choice(_LINES)
+        else:
+            line = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(1, 12)))
+        if rng.random() < 0.2:
+            line = f"{line} {rng.choice(list(DEBUG_TOKENS))}"
+        if rng.random() < 0.1:
+            line = " " * rng.randint(1, 3) + line
+        lines.append(line)
+    sep = rng.choice(["\n", "\n", "\r\n"])
+    return (
+        rng.choice(["", "  \n", "\n\n"])
+        + sep.join(lines)
+        + rng.choice(["", "\n", " \n\n"])
+    )
+
+
+def corpus(n: int, seed: int = 31) -> list:
+    rng = random.Random(seed)
+    return [random_text(rng) for _ in range(n)]
+
+
+def full_report(rng: random.Random, n_lines: int) -> str:
+    """n_lines줄 안팎의 보고서 전문(목차를 돌아가며 반복)."""
+    lines = ["=== 본문 시작 ===", "{{REPORT_ANCHOR}}", ""]
+    section = 0
+    while len(lines) < n_lines:
+        lines += [_HEADINGS[section % len(_HEADINGS)], ""]
+        section += 1
+        for _ in range(rng.randint(4, 20)):
+            kind = rng.random()
+            if kind < 0.15:
+                lines.append(rng.choice(_SUBHEADINGS))
+            elif kind < 0.5:
+                number = rng.randint(1, 12)
+                lines.append(f"{number}. {rng.choice(_SENTENCES)}")
+            elif kind < 0.6:
+                lines.append(f"- {rng.choice(_SENTENCES)}")
+            else:
+                lines.append(
+                    " ".join(rng.choice(_SENTENCES) for _ in range(rng.randint(1, 6)))
+                )
+            if rng.random() < 0.05:
+                lines[-1] += f" {rng.choice(list(DEBUG_TOKENS))}"
+            if rng.random() < 0.3:
+                lines.append("")
+        lines += ["", "[[HR]]", ""]
+    return rng.choice(["\n", "\r\n"]).join(lines) + "\n"
+
+
+def full_reports() -> list:
+    """수천 줄짜리 보고서 몇 개(고정 시드)."""
+    return [
+        full_report(random.Random(seed), n_lines)
+        for seed, n_lines in ((1, 2000), (2, 4000), (3, 8000))
+    ]
@@ -0,0 +1,128 @@
+import json
+
+from google.genai import types
+
+import h_pipeline
+from h_pipeline import (
+    BatchRun,
+    GeminiBatchEndpoint,
+    LocalBatchEndpoint,
+    SqliteStateBackend,
+    prompt_versions,
+    stage_checkpoint,
+)
+
+
+def _students():
+    return [
+        {
+            "student_num": num,
+            "student_name": name,
+            "pdf_bytes": f"%PDF {num}".encode(),
+            "notes": "",
+        }
+        for num, name in (("10201", "홍길동"), ("10202", "김철수"))
+    ]
+
+
+def test_local_batch_run_fills_every_stage(tmp_path):
+    state = SqliteStateBackend(str(tmp_path / "state.sqlite3"))
+    run = BatchRun(_students(), LocalBatchEndpoint(), state=state, poll_interval=0)
+    outcome = run.run()
+    assert {o["status"] for o in outcome.values()} == {"ready"}
+    versions = prompt_versions()
+    for item in run.items:
+        checkpoint = state.checkpoint_get(item["run_key"])
+        for stage in versions:
+            assert stage_checkpoint(checkpoint, stage, versions)
+
+
+def test_local_batch_failure_stops_only_that_student(tmp_path):
+    def responder(model, request):
+        if "김철수" in request["prompt"]:
+            raise RuntimeError("quota")
+        return h_pipeline._local_batch_responder(model, request)
+
+    state = SqliteStateBackend(str(tmp_path / "state.sqlite3"))
+    outcome = BatchRun(
+        _students(), LocalBatchEndpoint(responder), state=state, poll_interval=0
+    ).run()
+    assert outcome["10201"]["status"] == "ready"
+    assert outcome["10202"]["status"] == "failed"
+    assert outcome["10202"]["stage"] == "report"
+
+
+class FakeFiles:
+    def __init__(self):
+        self.uploads = []
+
+    def upload(self, file, config):
+        self.uploads.append((file.read(), config.mime_type))
+        return types.File(name="files/batch-input", uri="https://files/x")
+
+
+class FakeBatches:
+    def create(self, model, src, config):
+        self.src = src
+        return types.BatchJob(name="batches/1")
+
+
+class FakeClient:
+    def __init__(self):
+        self.files = FakeFiles()
+        self.batches = FakeBatches()
+
+
+def _requests(n=3):
+    config = h_pipeline.GENERATION_PRESETS["균형"]["stage2"].config(
+        "gemini-2.5-flash", timeout_s=30
+    )
+    return [{"prompt": f"요약 {i}", "config": config} for i in range(n)]
+
+
+def test_small_batch_is_submitted_inline(tmp_path, monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(h_pipeline, "get_gemini_client", lambda: client)
+    endpoint = GeminiBatchEndpoint(SqliteStateBackend(str(tmp_path / "s.sqlite3")))
+    assert endpoint.submit("gemini-2.5-flash", _requests(), "job") == "batches/1"
+    assert len(client.batches.src) == 3
+    assert not client.files.uploads
+
+
+def test_large_batch_is_submitted_as_jsonl_file(tmp_path, monkeypatch):
+    client = FakeClient()
+    monkeypatch.setattr(h_pipeline, "get_gemini_client", lambda: client)
+    monkeypatch.setattr(h_pipeline, "BATCH_INLINE_MAX_BYTES", 100)
+    endpoint = GeminiBatchEndpoint(SqliteStateBackend(str(tmp_path / "s.sqlite3")))
+    endpoint.submit("gemini-2.5-flash", _requests(), "job")
+    assert client.batches.src == "files/batch-input"
+    ((data, mime_type),) = client.files.uploads
+    assert mime_type == "jsonl"
+    lines = [json.loads(line) for line in data.decode("utf-8").splitlines()]
+    assert [line["key"] for line in lines] == ["0", "1", "2"]
+    request = lines[1]["request"]
+    assert request["contents"][0]["parts"] == [{"text": "요약 1"}]
+    assert request["generationConfig"]["thinkingConfig"] == {"thinkingBudget": 512}
+    assert "httpOptions" not in request["generationConfig"]
+
+
+def test_file_results_follow_request_keys():
+    def response(text):
+        return {
+            "candidates": [
+                {"content": {"parts": [{"text": text}]}, "finishReason": "STOP"}
+            ],
+            "usageMetadata": {"candidatesTokenCount": 7},
+        }
+
+    lines = [
+        {"key": "2", "response": response("셋째")},
+        {"key": "0", "response": response("첫째")},
+        {"key": "3", "error": {"code": 429, "message": "quota"}},
+    ]
+    data = "\n".join(json.dumps(line, ensure_ascii=False) for line in lines)
+    results = GeminiBatchEndpoint._file_results(data.encode("utf-8"))
+    assert [r.get("text") for r in results] == ["첫째", None, "셋째", None]
+    assert results[0]["output_tokens"] == 7
+    assert "quota" in results[3]["error"]
+    assert results[1] == {"error": "응답 없음"}
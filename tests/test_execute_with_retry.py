@@ -0,0 +1,51 @@
+import socket
+
+import pytest
+
+import h_pipeline
+from h_pipeline import CircuitBreaker, execute_with_retry
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    monkeypatch.setattr(h_pipeline, "_sleep_backoff", lambda attempt: None)
+    breaker = CircuitBreaker("drive", 10, 60)
+    monkeypatch.setattr(h_pipeline, "_breaker_for_label", lambda label: breaker)
+    return breaker
+
+
+def _flaky(errors):
+    calls = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) <= len(errors):
+            raise errors[len(calls) - 1]
+        return "ok"
+
+    return fn, calls
+
+
+@pytest.mark.parametrize(
+    "error", [ConnectionResetError(), socket.timeout("read"), TimeoutError()]
+)
+def test_transport_errors_are_retried(breaker, error):
+    fn, calls = _flaky([error, error])
+    assert execute_with_retry(fn, label="Drive Copy") == "ok"
+    assert len(calls) == 3
+    assert breaker.stats["failures"] == 2
+
+
+def test_transport_errors_count_toward_the_breaker(breaker):
+    fn, calls = _flaky([ConnectionResetError()] * 3)
+    with pytest.raises(ConnectionResetError):
+        execute_with_retry(fn, max_retries=3, label="Drive Copy")
+    assert breaker.stats["failures"] == 3
+
+
+def test_other_errors_are_not_retried(breaker):
+    fn, calls = _flaky([ValueError("bad")])
+    with pytest.raises(ValueError):
+        execute_with_retry(fn, label="Drive Copy")
+    assert len(calls) == 1
+    assert breaker.stats["failures"] == 0
@@ -0,0 +1,88 @@
+import pytest
+import requests
+
+import h_pipeline
+from h_pipeline import (
+    CircuitBreaker,
+    GasFormatQueue,
+    SqliteStateBackend,
+    gas_format_pending,
+    request_gas_format,
+)
+
+
+def test_job_status_is_persisted_to_state_and_run_record(tmp_path, monkeypatch):
+    state = SqliteStateBackend(str(tmp_path / "state.sqlite3"))
+    calls = []
+    monkeypatch.setattr(
+        h_pipeline, "request_gas_format", lambda session, doc_id: calls.append(doc_id)
+    )
+    queue = GasFormatQueue(max_workers=1, state=state)
+    queue.submit("doc-1", "보고서", run_key="run-1")
+    assert queue.wait_idle(timeout=5)
+
+    assert calls == ["doc-1"]
+    assert state.cache_get("gas-job:doc-1")["status"] == "done"
+    assert state.checkpoint_get("run-1")["gas_format:doc-1"]["status"] == "done"
+
+    # 프로세스가 바뀌어도(새 큐) 공유 상태에서 목록을 읽는다
+    other = GasFormatQueue(max_workers=1, state=state)
+    assert [j["doc_id"] for j in other.recent()] == ["doc-1"]
+
+
+def test_stale_running_job_is_reported_as_interrupted(tmp_path, monkeypatch):
+    state = SqliteStateBackend(str(tmp_path / "state.sqlite3"))
+    state.cache_set(
+        "gas-job:doc-2", {"doc_id": "doc-2", "status": "running", "updated_at": 0}
+    )
+    job = GasFormatQueue(max_workers=1, state=state).job("doc-2")
+    assert job["status"] == "failed"
+    assert job["error"]
+
+
+class _Session:
+    def __init__(self, error):
+        self.error = error
+        self.calls = 0
+
+    def get(self, *args, **kwargs):
+        self.calls += 1
+        raise self.error
+
+
+@pytest.mark.parametrize(
+    "error, counted",
+    [
+        (requests.ConnectionError("down"), True),
+        (requests.Timeout("slow"), True),
+        (requests.exceptions.MissingSchema("bad url"), False),
+    ],
+)
+def test_only_transport_errors_count_toward_the_gas_breaker(
+    monkeypatch, error, counted
+):
+    breaker = CircuitBreaker("gas")
+    monkeypatch.setattr(h_pipeline, "get_circuit_breaker", lambda name: breaker)
+    with pytest.raises(type(error)):
+        request_gas_format(_Session(error), "doc-1")
+    assert breaker.consecutive_failures == (1 if counted else 0)
+
+
+def test_missing_doc_id_fails_before_calling_gas(monkeypatch):
+    breaker = CircuitBreaker("gas")
+    monkeypatch.setattr(h_pipeline, "get_circuit_breaker", lambda name: breaker)
+    session = _Session(AssertionError("called"))
+    with pytest.raises(ValueError):
+        request_gas_format(session, " ")
+    assert session.calls == 0 and breaker.stats["calls"] == 0
+
+
+def test_link_is_pending_until_format_and_cleanup_finish(tmp_path, monkeypatch):
+    state = SqliteStateBackend(str(tmp_path / "state.sqlite3"))
+    queue = GasFormatQueue(max_workers=1, state=state)
+    monkeypatch.setattr(h_pipeline, "get_gas_format_queue", lambda: queue)
+    url = "https://docs.google.com/document/d/doc-3/edit"
+    queue._set("doc-3", status="running")
+    assert gas_format_pending(url)
+    queue._set("doc-3", status="done")
+    assert not gas_format_pending(url)
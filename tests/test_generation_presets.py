@@ -0,0 +1,28 @@
+from h_pipeline import (
+    GENERATION_PRESETS,
+    SqliteStateBackend,
+    length_controller,
+    prompt_versions,
+    use_generation_preset,
+)
+
+
+def test_stage_versions_differ_per_preset():
+    base = prompt_versions("기본")
+    fast = prompt_versions("빠름")
+    for stage in base:
+        assert base[stage] != fast[stage]
+    assert prompt_versions("기본") == base
+
+
+def test_versions_follow_the_active_preset():
+    with use_generation_preset("균형"):
+        assert prompt_versions() == prompt_versions("균형")
+
+
+def test_default_preset_keeps_the_pre_preset_length_key(tmp_path):
+    state = SqliteStateBackend(str(tmp_path / "state.sqlite3"))
+    base = length_controller(state, GENERATION_PRESETS["기본"]["stage3"])
+    fast = length_controller(state, GENERATION_PRESETS["빠름"]["stage3"])
+    assert base.key == "length-control:stage3"
+    assert fast.key == "length-control:빠름:stage3"
@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+import requests
+
+import h_pipeline
+from h_pipeline import CircuitBreaker, PooledGoogleHttp, execute_with_retry
+
+
+class FakeCredentials:
+    def __init__(self):
+        self.token = None
+        self.refreshes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def valid(self):
+        return self.token is not None
+
+    def refresh(self, request):
+        with self._lock:
+            self.refreshes += 1
+            self.token = f"t{self.refreshes}"
+
+    def apply(self, headers, token=None):
+        headers["authorization"] = f"Bearer {token or self.token}"
+
+
+class FakeServer:
+    def __init__(self):
+        self.revoked = set()
+        self.timeouts = 0
+        self.lock = threading.Lock()
+        self.sessions = set()
+
+    def request(self, session, method, uri, headers=None, **kwargs):
+        with self.lock:
+            self.sessions.add(session)  # 참조 유지 → 스레드가 끝나도 id 재사용 없음
+            if self.timeouts:
+                self.timeouts -= 1
+                raise requests.ReadTimeout("read timed out")
+        r = requests.Response()
+        token = headers["authorization"].split()[1]
+        r.status_code = 401 if token in self.revoked else 200
+        r.headers["Content-Type"] = "application/json"
+        r._content = b"{}"
+        return r
+
+
+@pytest.fixture
+def server(monkeypatch):
+    server = FakeServer()
+    monkeypatch.setattr(
+        requests.Session,
+        "request",
+        lambda session, *args, **kwargs: server.request(session, *args, **kwargs),
+    )
+    monkeypatch.setattr(h_pipeline, "AuthRequest", lambda session: None)
+    return server
+
+
+def _hammer(http, threads=8, calls=20):
+    statuses = []
+
+    def work():
+        for _ in range(calls):
+            resp, body = http.request("https://x", "POST", body='{"a": "한"}')
+            statuses.append(resp.status)
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return statuses
+
+
+def test_concurrent_requests_share_one_token_refresh(server):
+    creds = FakeCredentials()
+    http = PooledGoogleHttp(creds)
+    statuses = _hammer(http)
+    assert statuses == [200] * 160
+    assert creds.refreshes == 1
+    stats = http.stats()
+    assert stats["requests"] == 160 and stats["threads"] == 8
+    assert len(server.sessions) == 8
+
+
+def test_concurrent_401s_refresh_the_token_once(server):
+    creds = FakeCredentials()
+    http = PooledGoogleHttp(creds)
+    _hammer(http, threads=1, calls=1)
+    server.revoked.add(creds.token)
+    assert _hammer(http) == [200] * 160
+    assert creds.refreshes == 2
+
+
+def test_read_timeout_is_retried_and_counted(server, monkeypatch):
+    monkeypatch.setattr(h_pipeline, "_sleep_backoff", lambda attempt: None)
+    breaker = CircuitBreaker("drive", 10, 60)
+    monkeypatch.setattr(h_pipeline, "_breaker_for_label", lambda label: breaker)
+    http = PooledGoogleHttp(FakeCredentials())
+    server.timeouts = 2
+    resp, _ = execute_with_retry(lambda: http.request("https://x"), label="Drive")
+    assert resp.status == 200
+    assert breaker.stats["failures"] == 2
+    assert http.stats()["errors"] == 2
@@ -0,0 +1,133 @@
+import math
+
+import pytest
+from google.genai import types
+
+import h_pipeline
+from h_pipeline import (
+    DEFAULT_THINKING_ALLOWANCE,
+    GENERATION_PRESETS,
+    LENGTH_HEADROOM,
+    BatchRun,
+    GeminiEmptyResponse,
+    LocalBatchEndpoint,
+    SqliteStateBackend,
+    gemini_generate_with_meta,
+    generate_with_length_control,
+    length_controller,
+)
+
+TARGET = 9000
+
+
+@pytest.fixture
+def state(tmp_path):
+    return SqliteStateBackend(str(tmp_path / "state.sqlite3"))
+
+
+def test_default_preset_pins_the_thinking_budget(state):
+    profile = GENERATION_PRESETS["기본"]["stage3"]
+    cap, pinned = length_controller(state, profile).budget(
+        TARGET, "gemini-2.5-pro", profile
+    )
+    assert profile.thinking_budget is None
+    assert pinned.thinking_budget == DEFAULT_THINKING_ALLOWANCE
+    answer = math.ceil(TARGET * LENGTH_HEADROOM / 3.0)
+    assert cap == answer + DEFAULT_THINKING_ALLOWANCE
+
+
+def test_explicit_thinking_budget_is_kept(state):
+    profile = GENERATION_PRESETS["균형"]["stage3"]
+    cap, pinned = length_controller(state, profile).budget(
+        TARGET, "gemini-2.5-pro", profile
+    )
+    assert pinned is profile
+    assert cap == math.ceil(TARGET * LENGTH_HEADROOM / 3.0) + 2048
+
+
+def _response(text, finish):
+    parts = [{"text": text}] if text else []
+    return types.GenerateContentResponse.model_validate(
+        {
+            "candidates": [{"content": {"parts": parts}, "finishReason": finish}],
+            "usageMetadata": {"candidatesTokenCount": 5, "thoughtsTokenCount": 900},
+        }
+    )
+
+
+class FakeModels:
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.configs = []
+
+    def generate_content(self, model, contents, config):
+        self.configs.append(config)
+        return self.responses.pop(0)
+
+
+@pytest.fixture
+def gemini(monkeypatch):
+    def install(*responses):
+        models = FakeModels(responses)
+        client = type("Client", (), {"models": models})()
+        monkeypatch.setattr(h_pipeline, "get_gemini_client", lambda: client)
+        monkeypatch.setattr(h_pipeline, "notify", lambda *a, **k: None)
+        return models
+
+    return install
+
+
+def test_empty_max_tokens_response_is_not_retried_blindly(gemini):
+    models = gemini(_response("", "MAX_TOKENS"))
+    with pytest.raises(GeminiEmptyResponse) as e:
+        gemini_generate_with_meta("gemini-2.5-pro", "p", None, max_output_tokens=10)
+    assert e.value.finish_reason == "MAX_TOKENS"
+    assert len(models.configs) == 1
+
+
+def test_empty_capped_stage3_retries_once_with_the_preset_cap(gemini, state):
+    models = gemini(_response("", "MAX_TOKENS"), _response("지도 방침.", "STOP"))
+    text, stats = generate_with_length_control("gemini-2.5-pro", "p", TARGET, state)
+    assert text == "지도 방침."
+    capped, plain = models.configs
+    assert capped.thinking_config.thinking_budget == DEFAULT_THINKING_ALLOWANCE
+    assert plain.thinking_config is None
+    assert plain.max_output_tokens == 8192
+    assert stats["max_output_tokens"] == 8192
+
+
+def test_empty_stop_response_still_fails(gemini, state):
+    gemini(_response("", "STOP"))
+    with pytest.raises(GeminiEmptyResponse):
+        generate_with_length_control("gemini-2.5-pro", "p", TARGET, state)
+
+
+class CappedHomeroomEndpoint(LocalBatchEndpoint):
+    """3단계 결과가 thinking으로 상한을 다 써서 비어 온 것처럼."""
+
+    def poll(self, name):
+        status, results = super().poll(name)
+        if self.jobs[name]["display_name"].startswith("h-app-homeroom"):
+            results = [dict(r, text="", finish_reason="MAX_TOKENS") for r in results]
+        return status, results
+
+
+def test_batch_empty_homeroom_falls_back_to_the_preset_cap(gemini, state):
+    models = gemini(_response("배치 대체 지도 방침.", "STOP"))
+    students = [
+        {
+            "student_num": "10201",
+            "student_name": "홍길동",
+            "pdf_bytes": b"%PDF",
+            "notes": "",
+        }
+    ]
+    endpoint = CappedHomeroomEndpoint()
+    run = BatchRun(students, endpoint, state=state, poll_interval=0)
+    assert run.run()["10201"]["status"] == "ready"
+    (job,) = [j for j in endpoint.jobs.values() if "homeroom" in j["display_name"]]
+    config = job["requests"][0]["config"]
+    assert config.thinking_config.thinking_budget == DEFAULT_THINKING_ALLOWANCE
+    checkpoint = state.checkpoint_get(run.items[0]["run_key"])
+    assert checkpoint["homeroom"] == "배치 대체 지도 방침."
+    assert models.configs[0].max_output_tokens == 8192
@@ -0,0 +1,63 @@
+import threading
+import zipfile
+
+import pytest
+
+import h_pipeline
+from h_pipeline import ExportBusy, ExportTooLarge, PdfExportJob, SqliteStateBackend
+
+TARGETS = [{"filename": "10201_홍길동_보고서.pdf", "doc_id": "doc-1"}]
+
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    monkeypatch.setattr(h_pipeline, "EXPORT_DIR", str(tmp_path / "exports"))
+    return SqliteStateBackend(str(tmp_path / "state.sqlite3"))
+
+
+def _fake_export(release: threading.Event, started: threading.Event):
+    def export_one(self, target):
+        started.set()
+        release.wait(5)
+        path = f"{self.pdf_dir}/{target['filename']}"
+        with open(path, "wb") as f:
+            f.write(b"%PDF")
+        self._mark_done(target["filename"], target["doc_id"])
+
+    return export_one
+
+
+def test_second_export_of_same_class_is_rejected_while_first_runs(state, monkeypatch):
+    release, started = threading.Event(), threading.Event()
+    monkeypatch.setattr(PdfExportJob, "_export_one", _fake_export(release, started))
+    first = PdfExportJob("1학년 2반", state=state)
+    worker = threading.Thread(target=first.run, args=(TARGETS,))
+    worker.start()
+    assert started.wait(5)
+
+    second = PdfExportJob("1학년 2반", state=state)
+    monkeypatch.setattr(h_pipeline, "EXPORT_LOCK_WAIT", 0.1)
+    with pytest.raises(ExportBusy):
+        second.run(TARGETS)
+    with pytest.raises(ExportBusy):
+        second.read_zip(TARGETS)  # 아직 ZIP이 없음
+
+    release.set()
+    worker.join(5)
+    assert second.pending(TARGETS) == []
+    data = second.read_zip(TARGETS)
+    assert data[:2] == b"PK"
+    with zipfile.ZipFile(second.zip_path) as zf:
+        assert zf.namelist() == [TARGETS[0]["filename"]]
+
+
+def test_zip_over_the_download_limit_is_refused(state, monkeypatch):
+    job = PdfExportJob("1학년", state=state)
+    with open(f"{job.pdf_dir}/{TARGETS[0]['filename']}", "wb") as f:
+        f.write(b"%PDF" * 100)
+    assert job.zip_size(TARGETS) == 400
+    monkeypatch.setattr(h_pipeline, "EXPORT_ZIP_MAX_BYTES", 399)
+    with pytest.raises(ExportTooLarge):
+        job.read_zip(TARGETS)
+    monkeypatch.setattr(h_pipeline, "EXPORT_ZIP_MAX_BYTES", 400)
+    assert job.read_zip(TARGETS)[:2] == b"PK"
@@ -0,0 +1,184 @@
+import pytest
+
+import h_pipeline
+from h_pipeline import (
+    DEBUG_TOKENS,
+    REPORT_SECTIONS,
+    PipelineError,
+    RunOptions,
+    SqliteStateBackend,
+    _doc_run_key,
+    _section_patch_requests,
+    generated_report_sections,
+    locate_report_sections,
+    regenerate_report_section,
+    render_report_sections,
+    splice_report_section,
+)
+
+SECTIONS = {
+    key: f"{heading} 본문 첫 줄\n- 둘째 줄" for key, heading, _ in REPORT_SECTIONS
+}
+SUMMARY = "- 강점: 꾸준한 탐구\n- 보완: 진로 활동 기록"
+
+
+def _doc(text: str) -> dict:
+    """한 줄 = 문단 1개인 Docs 응답(본문 블록 1개)."""
+    content, index = [], 1
+    for line in text.split("\n"):
+        end = index + len(line.encode("utf-16-le")) // 2 + 1
+        content.append(
+            {
+                "startIndex": index,
+                "endIndex": end,
+                "paragraph": {"elements": [{"textRun": {"content": line + "\n"}}]},
+            }
+        )
+        index = end
+    return {"body": {"content": content}}
+
+
+def _plain_doc(report_md: str) -> dict:
+    # 자동 서식 꺼짐: 디버그 토큰([[HR]] 포함)은 빈 문자열로 지워지고 요약이 바로 뒤에
+    for token, value in DEBUG_TOKENS.items():
+        report_md = report_md.replace(token, value)
+    return _doc(report_md + "\n\n" + SUMMARY)
+
+
+def _summary_start(doc: dict) -> int:
+    for el in doc["body"]["content"]:
+        text = el["paragraph"]["elements"][0]["textRun"]["content"]
+        if text.startswith("- 강점"):
+            return el["startIndex"]
+    raise AssertionError("summary not found")
+
+
+def test_last_section_without_boundary_is_open_ended():
+    doc = _plain_doc(render_report_sections(SECTIONS))
+    rng = locate_report_sections(doc)["character"]
+    assert rng.open_ended
+    assert not locate_report_sections(doc)["subjects"].open_ended
+
+
+def test_last_section_stops_at_its_generated_text():
+    doc = _plain_doc(render_report_sections(SECTIONS))
+    rng = locate_report_sections(doc, SECTIONS)["character"]
+    assert not rng.open_ended
+    assert rng.text == SECTIONS["character"]
+    delete = _section_patch_requests(rng, "새 본문")[0]["deleteContentRange"]
+    assert delete["range"]["endIndex"] < _summary_start(doc)
+
+
+def test_generated_text_from_free_form_report_checkpoint():
+    report_md = render_report_sections(SECTIONS).replace("[[HR]]", "")
+    generated = generated_report_sections({"report": report_md})
+    assert generated["character"] == SECTIONS["character"]
+    assert generated["autonomy"] == SECTIONS["autonomy"]
+    doc = _plain_doc(report_md)
+    assert locate_report_sections(doc, generated)["character"].text == (
+        SECTIONS["character"]
+    )
+
+
+def test_formatted_paragraphs_still_match_generated_text():
+    # 자동 서식이 목록 머리/굵게 표시를 문단 서식으로 바꾼 뒤에도 같은 문단으로 봄
+    sections = dict(SECTIONS, character="**종합** 의견\n- 성실함")
+    doc = _doc("8. 인성 및 행동특성 종합 의견\n종합 의견\n성실함\n\n" + SUMMARY)
+    rng = locate_report_sections(doc, sections)["character"]
+    assert rng.text == "종합 의견\n성실함"
+
+
+def test_splice_keeps_parent_headings_and_rules():
+    report_md = render_report_sections(SECTIONS)
+    spliced = splice_report_section(report_md, "autonomy", "새 본문\n- 새 줄")
+    assert spliced.replace("새 본문\n- 새 줄", SECTIONS["autonomy"]) == report_md
+    assert generated_report_sections({"report": spliced})["autonomy"] == (
+        "새 본문\n- 새 줄"
+    )
+    assert splice_report_section("자유 형식 보고서", "autonomy", "새 본문") is None
+
+
+class FakeDocs:
+    def __init__(self, doc: dict):
+        self.doc = doc
+        self.patches = []
+
+    def documents(self):
+        return self
+
+    def get(self, documentId):
+        return _Call(lambda: self.doc)
+
+    def batchUpdate(self, documentId, body):
+        return _Call(lambda: self.patches.append(body["requests"]))
+
+
+class _Call:
+    def __init__(self, fn):
+        self.execute = fn
+
+
+@pytest.fixture
+def regen(tmp_path, monkeypatch):
+    """저장된 생성 기록이 있는 보고서 문서 + Google/Gemini 호출 대역."""
+    state = SqliteStateBackend(str(tmp_path / "state.sqlite3"))
+    report_md = render_report_sections(SECTIONS)
+    # 자동 서식 뒤: 목록 머리("- ")가 문단 서식으로 바뀐 요약
+    doc = _doc(report_md.replace("[[HR]]", "") + "\n\n" + SUMMARY.replace("- ", ""))
+    doc.update(title="10101_홍길동", revisionId="r1")
+    docs = FakeDocs(doc)
+    trashed, made = [], []
+    state.cache_set(
+        _doc_run_key("doc1"),
+        {"run_key": "rk", "student_num": "10101", "student_name": "홍길동"},
+    )
+    state.checkpoint_put("rk", "report", report_md)
+    state.checkpoint_put("rk", "summary", SUMMARY)
+    state.checkpoint_put("rk", "result", {"guide_doc_url": "old-guide"})
+    monkeypatch.setattr(h_pipeline, "get_google_services", lambda: (None, docs, None))
+    monkeypatch.setattr(
+        h_pipeline, "gemini_generate_text_with_retry", lambda *a, **k: "새 본문"
+    )
+    monkeypatch.setattr(
+        h_pipeline, "generate_with_length_control", lambda *a: ("지도방침", {})
+    )
+    monkeypatch.setattr(
+        h_pipeline, "_make_student_doc", lambda *a: (made.append(a) or "new-guide", "")
+    )
+    monkeypatch.setattr(h_pipeline, "write_row_to_sheet_from_A6", lambda *a: None)
+    monkeypatch.setattr(
+        h_pipeline, "trash_file", lambda drive, file_id, label: trashed.append(file_id)
+    )
+    return state, docs, trashed, made, report_md
+
+
+def _regenerate(state):
+    return regenerate_report_section(
+        "doc1",
+        "autonomy",
+        refresh_guide=True,
+        options=RunOptions(auto_gas_format=False),
+        state=state,
+    )
+
+
+def test_regenerate_splices_checkpoint_and_replaces_guide(regen):
+    state, docs, trashed, made, report_md = regen
+    result = _regenerate(state)
+    checkpoint = state.checkpoint_get("rk")
+    assert checkpoint["report"] == report_md.replace(SECTIONS["autonomy"], "새 본문")
+    assert len(docs.patches) == 2  # 목차 + 서식 적용된 요약
+    assert result["guide_doc_url"] == "new-guide"
+    assert checkpoint["result"]["guide_doc_url"] == "new-guide"
+    assert trashed == ["old-guide"]
+
+
+def test_regenerate_fails_when_old_summary_is_missing(regen):
+    state, docs, trashed, made, report_md = regen
+    state.checkpoint_put("rk", "summary", "- 직접 고쳐서 문서에 없는 요약")
+    with pytest.raises(PipelineError) as e:
+        _regenerate(state)
+    assert e.value.stage == "result"
+    assert len(docs.patches) == 1  # 목차만 바뀜
+    assert not made and not trashed
+    assert state.checkpoint_get("rk")["result"]["guide_doc_url"] == "old-guide"
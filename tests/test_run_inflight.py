@@ -0,0 +1,114 @@
+import threading
+
+import pytest
+
+import h_pipeline
+from h_pipeline import (
+    TEMPLATE_GUIDE_DOC_ID,
+    DocsMutationPlan,
+    PipelineError,
+    RunOptions,
+    SqliteStateBackend,
+    make_run_key,
+    prompt_versions,
+    put_stage_checkpoint,
+    run_student_pipeline,
+)
+
+ARGS = ("10201", "홍길동", b"%PDF-1.4", "메모")
+
+
+@pytest.fixture
+def state(tmp_path, monkeypatch):
+    monkeypatch.setattr(h_pipeline, "RUN_ATTACH_POLL", 0.01)
+    return SqliteStateBackend(str(tmp_path / "state.sqlite3"))
+
+
+def _claim(state):
+    run_key = make_run_key(*ARGS)
+    assert state.cache_add(f"run-inflight:{run_key}", {}, ttl=60)
+    return run_key
+
+
+def test_second_run_attaches_to_the_one_in_flight(state, monkeypatch):
+    # 기다리기만 해야 함 — 직접 생성하면 실패
+    monkeypatch.setattr(h_pipeline, "get_google_services", pytest.fail)
+    run_key = _claim(state)
+    threading.Timer(
+        0.1, state.checkpoint_put, (run_key, "result", {"report_doc_url": "u"})
+    ).start()
+    progress = []
+    out = run_student_pipeline(
+        *ARGS, on_progress=lambda stage, _: progress.append(stage), state=state
+    )
+    assert out["attached"] and out["reused"]
+    assert out["checkpoint"]["result"] == {"report_doc_url": "u"}
+    assert progress == ["inflight"]
+
+
+def test_attached_run_fails_when_the_other_ends_without_result(state):
+    run_key = _claim(state)
+    threading.Timer(0.1, state.cache_delete, (f"run-inflight:{run_key}",)).start()
+    with pytest.raises(PipelineError) as e:
+        run_student_pipeline(*ARGS, state=state)
+    assert e.value.stage == "inflight"
+
+
+def test_claim_is_released_after_a_failed_run(state, monkeypatch):
+    def broken():
+        raise RuntimeError("no credentials")
+
+    monkeypatch.setattr(h_pipeline, "get_google_services", broken)
+    with pytest.raises(PipelineError) as e:
+        run_student_pipeline(*ARGS, RunOptions(preflight=False), state=state)
+    assert e.value.stage == "services"
+    assert state.cache_get(f"run-inflight:{make_run_key(*ARGS)}") is None
+
+
+def test_claim_taken_over_by_another_run_is_left_alone(state, monkeypatch):
+    key = f"run-inflight:{make_run_key(*ARGS)}"
+
+    def slow_then_broken():
+        # TTL이 지나 다른 실행이 같은 키를 차지한 상황
+        state.cache_set(key, {"owner": "other"})
+        raise RuntimeError("no credentials")
+
+    monkeypatch.setattr(h_pipeline, "get_google_services", slow_then_broken)
+    with pytest.raises(PipelineError):
+        run_student_pipeline(*ARGS, RunOptions(preflight=False), state=state)
+    assert state.cache_get(key) == {"owner": "other"}
+
+
+class _Pool:
+    def ensure_warm(self, *args):
+        pass
+
+
+def test_resume_reuses_the_report_doc_after_a_guide_doc_failure(state, monkeypatch):
+    run_key = make_run_key(*ARGS)
+    versions = prompt_versions()
+    for stage in ("report", "summary", "homeroom"):
+        put_stage_checkpoint(state, run_key, stage, f"{stage} 본문", versions)
+    copies = []
+
+    def copy(drive, st, template_id, title, root_id, num):
+        copies.append(template_id)
+        if template_id == TEMPLATE_GUIDE_DOC_ID and copies.count(template_id) == 1:
+            raise RuntimeError("Drive 오류")
+        return f"doc-{len(copies)}"
+
+    monkeypatch.setattr(h_pipeline, "get_google_services", lambda: (None, None, None))
+    monkeypatch.setattr(h_pipeline, "get_template_pool", _Pool)
+    monkeypatch.setattr(h_pipeline, "copy_template_to_class_folder", copy)
+    monkeypatch.setattr(DocsMutationPlan, "commit", lambda self, docs: {})
+    monkeypatch.setattr(h_pipeline, "write_row_to_sheet_from_A6", lambda *a: None)
+    options = RunOptions(preflight=False, auto_gas_format=False)
+    with pytest.raises(PipelineError) as e:
+        run_student_pipeline(*ARGS, options, state=state)
+    assert e.value.stage == "result"
+
+    out = run_student_pipeline(*ARGS, options, state=state)
+    result = out["checkpoint"]["result"]
+    assert result["report_doc_url"].endswith("/doc-1/edit")
+    assert result["guide_doc_url"].endswith("/doc-3/edit")
+    assert len(copies) == 3  # 보고서 1 + 지도방침(실패) 1 + 지도방침 1
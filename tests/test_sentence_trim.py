@@ -0,0 +1,55 @@
+import random
+
+from h_pipeline import (
+    TextPostProcessor,
+    cut_at_sentence_boundary,
+    trim_korean_text_safely,
+)
+
+TWO = "첫 문장입니다. 둘째 문장입니다."
+
+
+def test_complete_last_sentence_is_kept():
+    assert cut_at_sentence_boundary(TWO) == TWO
+    assert cut_at_sentence_boundary("줄 하나.\n마지막 줄도 끝났다!") == (
+        "줄 하나.\n마지막 줄도 끝났다!"
+    )
+
+
+def test_text_within_target_is_not_cut():
+    size = len(TWO.encode("utf-8"))
+    assert trim_korean_text_safely(TWO, size) == TWO
+    assert trim_korean_text_safely(TWO + "\n\n", size) == TWO
+
+
+def test_text_over_target_is_cut_at_last_complete_sentence():
+    size = len(TWO.encode("utf-8"))
+    assert trim_korean_text_safely(TWO, size - 1) == "첫 문장입니다."
+    # 한도가 문장 끝 바로 뒤(공백)에 걸리면 그 문장까지 유지
+    assert trim_korean_text_safely(TWO + " 셋째", size) == TWO
+
+
+def test_period_inside_number_is_not_a_sentence_end():
+    text = "첫 문장입니다.\n값은 3.14입니다."
+    limit = len("첫 문장입니다.\n값은 3.".encode("utf-8"))
+    assert trim_korean_text_safely(text, limit) == "첫 문장입니다."
+
+
+def test_streaming_sentence_trim_matches_whole_string():
+    rng = random.Random(32)
+    text = "\n".join(
+        " ".join(
+            rng.choice(["문장입니다.", "값 3.14", "계속", "끝!"]) for _ in range(6)
+        )
+        for _ in range(20)
+    )
+    for limit in range(10, len(text.encode("utf-8")), 37):
+        whole = TextPostProcessor(max_utf8_bytes=limit, sentence_aware=True)
+        stream = TextPostProcessor(max_utf8_bytes=limit, sentence_aware=True)
+        out, i = [], 0
+        while i < len(text):
+            n = rng.randint(1, 30)
+            out.append(stream.feed(text[i : i + n]))
+            i += n
+        out.append(stream.finish())
+        assert "".join(out) == whole.process(text), limit
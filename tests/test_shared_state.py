@@ -0,0 +1,34 @@
+import time
+
+import h_pipeline
+from h_pipeline import SqliteStateBackend
+
+
+def _state(tmp_path):
+    return SqliteStateBackend(str(tmp_path / "state.sqlite3"))
+
+
+def test_release_does_not_delete_lock_taken_over_by_another_holder(tmp_path):
+    state = _state(tmp_path)
+    with state.lock("job", ttl=0.2):
+        time.sleep(0.3)  # 만료 → 다른 보유자가 가져감
+        assert state.cache_add("lock:job", "other", ttl=30)
+    assert state.cache_get("lock:job") == "other"
+
+
+def test_renewed_lock_outlives_its_ttl(tmp_path):
+    state = _state(tmp_path)
+    with state.lock("job", ttl=0.3, renew=True):
+        time.sleep(0.8)
+        assert not state.cache_add("lock:job", "other", ttl=30)
+    assert state.cache_get("lock:job") is None
+
+
+def test_expired_rows_are_purged(tmp_path, monkeypatch):
+    monkeypatch.setattr(h_pipeline, "KV_PURGE_INTERVAL", 0)
+    state = _state(tmp_path)
+    state.cache_set("old", 1, ttl=0.01)
+    time.sleep(0.05)
+    state.cache_set("new", 2)
+    keys = [k for (k,) in state._conn().execute("SELECT key FROM kv")]
+    assert keys == ["new"]
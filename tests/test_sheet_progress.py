@@ -0,0 +1,90 @@
+import re
+
+from h_pipeline import SheetProgressCache, SqliteStateBackend
+
+COLUMNS = "ABCDEFGH"
+
+
+class FakeSheets:
+    """values().get / batchGet만 흉내 — rows: {행 번호: [A..H]}"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.ranges = []
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def _values(self, a1: str) -> list:
+        self.ranges.append(a1)
+        c1, r1, c2, r2 = re.match(r".*!([A-H])(\d+):([A-H])(\d+)", a1).groups()
+        first, last = COLUMNS.index(c1), COLUMNS.index(c2) + 1
+        rows = range(int(r1), min(int(r2), max(self.rows, default=0)) + 1)
+        values = [self.rows.get(r, [])[first:last] for r in rows]
+        while values and not values[-1]:
+            values.pop()
+        return values
+
+    def get(self, spreadsheetId, range):
+        return _Call(lambda: {"values": self._values(range)})
+
+    def batchGet(self, spreadsheetId, ranges):
+        return _Call(
+            lambda: {"valueRanges": [{"values": self._values(a1)} for a1 in ranges]}
+        )
+
+
+class FakeDrive:
+    def __init__(self):
+        self.modified = "t1"
+
+    def files(self):
+        return self
+
+    def get(self, **kwargs):
+        return _Call(lambda: {"modifiedTime": self.modified})
+
+
+class _Call:
+    def __init__(self, fn):
+        self.execute = fn
+
+
+def _row(num, stamp=""):
+    row = ["1", "2", "3", num, "이름", "보고서", "조언", stamp]
+    return row if stamp else row[:7]
+
+
+def _sync(tmp_path, rows):
+    drive, sheets = FakeDrive(), FakeSheets(rows)
+    cache = SheetProgressCache(SqliteStateBackend(str(tmp_path / "s.sqlite3")))
+    cache.rows(drive, sheets)
+    drive.modified = "t2"
+    sheets.ranges.clear()
+    return cache, drive, sheets
+
+
+def test_rows_without_a_timestamp_survive_incremental_sync(tmp_path):
+    # 손으로 넣은 행(H 빔) — 다음 동기화에서 사라지면 안 됨
+    cache, drive, sheets = _sync(tmp_path, {6: _row("10201", "t"), 7: _row("10202")})
+    sheets.rows[8] = _row("10203")
+    rows = cache.rows(drive, sheets, force=True)["rows"]
+    assert sorted(rows) == ["6", "7", "8"]
+    assert rows["8"][3] == "10203"
+    assert sheets.ranges[-1].endswith("A8:H8")  # 새 행만 읽음
+
+    del sheets.rows[7]
+    drive.modified = "t3"
+    assert sorted(cache.rows(drive, sheets, force=True)["rows"]) == ["6", "8"]
+
+
+def test_edit_outside_key_and_stamp_columns_rereads_all(tmp_path):
+    cache, drive, sheets = _sync(tmp_path, {6: _row("10201", "t"), 7: _row("10202")})
+    sheets.rows[7] = ["1", "2", "3", "10202", "고친 이름", "보고서", "조언"]
+    rows = cache.rows(drive, sheets, force=True)["rows"]
+    assert rows["7"][4] == "고친 이름"
+    assert sheets.ranges[-1].endswith("A6:H1005")
+    assert cache.last_sync_calls == {"drive": 1, "sheets": 2}
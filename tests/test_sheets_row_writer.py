@@ -0,0 +1,96 @@
+import pytest
+
+import h_pipeline
+from h_pipeline import SheetsRowWriter, SqliteStateBackend, write_row_to_sheet_from_A6
+
+
+class FakeSheets:
+    """values().get / batchUpdate만 흉내 — rows: {행 번호: [A..H]}"""
+
+    def __init__(self, rows, fail_updates=0):
+        self.rows = rows
+        self.reads = 0
+        self.fail_updates = fail_updates
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def get(self, **kwargs):
+        self.reads += 1
+        last = max(self.rows, default=5)
+        values = [self.rows.get(r, [])[:4] for r in range(6, last + 1)]
+        return _Call({"values": values})
+
+    def batchUpdate(self, spreadsheetId, body):
+        if self.fail_updates:
+            self.fail_updates -= 1
+            raise ValueError("시트 쓰기 실패")
+        for d in body["data"]:
+            row = int(d["range"].split("!A")[1].split(":")[0])
+            self.rows[row] = d["values"][0]
+        return _Call({})
+
+
+class _Call:
+    def __init__(self, resp):
+        self.resp = resp
+
+    def execute(self):
+        return self.resp
+
+
+def _row(num):
+    return ["1", "2", "3", num, "이름", "보고서", "조언"]
+
+
+def test_new_student_fills_first_empty_row_from_a6(tmp_path):
+    sheets = FakeSheets({6: _row("10201"), 8: _row("10203")})  # 7행이 비어 있음
+    writer = SheetsRowWriter(
+        SqliteStateBackend(str(tmp_path / "s.sqlite3")), "sheet", "탭"
+    )
+    writer.add(_row("10202"))
+    writer.add(_row("10204"))
+    assert writer.flush(sheets) == {"10202": 7, "10204": 9}
+    assert sheets.rows[7][3] == "10202"
+
+
+def test_rerun_updates_existing_row_from_cached_index(tmp_path):
+    sheets = FakeSheets({6: _row("10201")})
+    writer = SheetsRowWriter(
+        SqliteStateBackend(str(tmp_path / "s.sqlite3")), "sheet", "탭"
+    )
+    writer.add(_row("10202"))
+    writer.flush(sheets)
+    reads = sheets.reads
+    writer.add(_row("10201"))
+    assert writer.flush(sheets) == {"10201": 6}
+    assert sheets.reads == reads  # 있는 학번 갱신은 캐시된 인덱스로
+    assert len(sheets.rows) == 2
+
+
+def test_failed_row_does_not_leak_into_the_next_students_write(tmp_path, monkeypatch):
+    state = SqliteStateBackend(str(tmp_path / "s.sqlite3"))
+    monkeypatch.setattr(h_pipeline, "get_shared_state", lambda: state)
+    sheets = FakeSheets({}, fail_updates=1)
+    with pytest.raises(ValueError):
+        write_row_to_sheet_from_A6(sheets, _row("10201"))
+    write_row_to_sheet_from_A6(sheets, _row("10202"))
+    assert [r[3] for r in sheets.rows.values()] == ["10202"]
+
+
+def test_buffered_rows_stay_queued_until_a_flush_succeeds(tmp_path):
+    writer = SheetsRowWriter(
+        SqliteStateBackend(str(tmp_path / "s.sqlite3")), "sheet", "탭"
+    )
+    sheets = FakeSheets({}, fail_updates=1)
+    write_row_to_sheet_from_A6(sheets, _row("10201"), writer)
+    write_row_to_sheet_from_A6(sheets, _row("10202"), writer)
+    assert sheets.reads == 0  # 모으기만 함
+    with pytest.raises(ValueError):
+        writer.flush(sheets)
+    assert writer.pending_students() == {"10201", "10202"}
+    assert writer.flush(sheets) == {"10201": 6, "10202": 7}
+    assert writer.pending() == 0
@@ -0,0 +1,103 @@
+import pytest
+
+import h_pipeline
+from h_pipeline import SqliteStateBackend, TemplateCopyPool, copy_template_pooled
+
+
+class FakeDrive:
+    def __init__(self, fail_update=False):
+        self.calls = []
+        self.fail_update = fail_update
+        self.fail_get = False
+        self.version = "7"
+        self.copies = 0
+
+    def files(self):
+        return self
+
+    def get(self, **kw):
+        self.calls.append("get")
+        if self.fail_get:
+            raise RuntimeError("get failed")
+        return _Call({"version": self.version})
+
+    def list(self, **kw):
+        self.calls.append("list")
+        return _Call({"files": []})
+
+    def copy(self, **kw):
+        self.calls.append("copy")
+        self.copies += 1
+        return _Call({"id": f"copy-{self.copies}"})
+
+    def update(self, **kw):
+        self.calls.append("update")
+        if self.fail_update:
+            raise RuntimeError("update failed")
+        return _Call({})
+
+
+class _Call:
+    def __init__(self, resp):
+        self.resp = resp
+
+    def execute(self):
+        return self.resp
+
+
+def _warm_pool(tmp_path, drive, size=2):
+    pool = TemplateCopyPool(SqliteStateBackend(str(tmp_path / "s.sqlite3")), size)
+    pool.refill(drive, "tpl", "root")
+    drive.calls.clear()
+    return pool
+
+
+def test_claim_uses_version_checked_at_warm_time(tmp_path):
+    drive = FakeDrive()
+    pool = _warm_pool(tmp_path, drive)
+    assert pool.claim(drive, "tpl", "제목", "root") == "copy-1"
+    assert drive.calls == ["update"]  # 템플릿 version 조회 없음
+
+
+def test_failed_claim_returns_copy_to_pool(tmp_path):
+    drive = FakeDrive(fail_update=True)
+    pool = _warm_pool(tmp_path, drive)
+    with pytest.raises(RuntimeError):
+        pool.claim(drive, "tpl", "제목", "root")
+    assert pool.state.cache_get("pool-claim:copy-1") is None
+    drive.fail_update = False
+    assert pool.claim(drive, "tpl", "제목", "root") == "copy-1"
+
+
+def _expire_version_check(pool):
+    version, checked_at = pool._versions["tpl"]
+    pool._versions["tpl"] = (version, checked_at - h_pipeline.POOL_VERSION_TTL - 1)
+
+
+def test_claim_rechecks_an_old_version_and_skips_stale_copies(tmp_path):
+    drive = FakeDrive()
+    pool = _warm_pool(tmp_path, drive)
+    _expire_version_check(pool)
+    drive.version = "8"  # 마지막 채우기 뒤 템플릿이 편집됨
+    assert pool.claim(drive, "tpl", "제목", "root") is None
+    assert drive.calls == ["get", "update", "update"]  # 옛 사본 2개는 휴지통으로
+    assert pool._versions["tpl"][0] == "8"
+
+
+def test_claim_rechecks_an_old_version_and_uses_current_copies(tmp_path):
+    drive = FakeDrive()
+    pool = _warm_pool(tmp_path, drive)
+    _expire_version_check(pool)
+    assert pool.claim(drive, "tpl", "제목", "root") == "copy-1"
+    assert drive.calls == ["get", "update"]
+
+
+def test_failed_version_recheck_falls_back_to_a_direct_copy(tmp_path, monkeypatch):
+    drive = FakeDrive()
+    pool = _warm_pool(tmp_path, drive)
+    _expire_version_check(pool)
+    drive.fail_get = True
+    monkeypatch.setattr(h_pipeline, "get_template_pool", lambda: pool)
+    assert copy_template_pooled(drive, "tpl", "제목", "root") == "copy-3"
+    assert drive.calls == ["get", "copy"]
+    assert len(pool._ready[("tpl", "root")]) == 2  # 풀 사본은 그대로
@@ -0,0 +1,65 @@
+import random
+
+import legacy_postprocess as legacy
+from h_pipeline import (
+    DEBUG_TOKENS,
+    TextPostProcessor,
+    clean_generated_text,
+    sanitize_numbered_lists,
+)
+from postprocess_corpus import corpus, full_reports
+
+CORPUS = corpus(600)
+REPORTS = full_reports()
+LIMITS = (0, 17, 120, 400)
+REPORT_LIMITS = (9000, 30000, 10**9)
+
+
+def _streamed(pp: TextPostProcessor, text: str, rng: random.Random) -> str:
+    out, i = [], 0
+    while i < len(text):
+        n = rng.randint(1, 40)
+        out.append(pp.feed(text[i : i + n]))
+        i += n
+    out.append(pp.finish())
+    return "".join(out)
+
+
+def _trim_then_sanitize(text: str, limit: int) -> str:
+    trimmed = legacy.trim_korean_text_safely(text, limit)
+    return legacy.sanitize_numbered_lists(trimmed) if trimmed else trimmed
+
+
+def test_full_reports_are_realistic():
+    for text in REPORTS:
+        assert len(text.splitlines()) >= 2000
+        assert "[[HR]]" in text and "=== 본문 시작 ===" in text
+        assert "6-1. 창의적 체험활동#1 자율활동" in text
+
+
+def test_sanitize_matches_legacy():
+    for i, text in enumerate(CORPUS + REPORTS):
+        assert sanitize_numbered_lists(text) == legacy.sanitize_numbered_lists(text), i
+
+
+def test_token_stripping_matches_legacy():
+    for i, text in enumerate(CORPUS + REPORTS):
+        expected = legacy.remove_debug_tokens(legacy.sanitize_numbered_lists(text))
+        assert clean_generated_text(text) == expected, i
+
+
+def test_trim_then_sanitize_matches_legacy():
+    cases = [(t, limit) for t in CORPUS[:200] for limit in LIMITS]
+    cases += [(t, limit) for t in REPORTS for limit in REPORT_LIMITS]
+    for text, limit in cases:
+        expected = _trim_then_sanitize(text, limit)
+        assert TextPostProcessor(max_utf8_bytes=limit).process(text) == expected, limit
+
+
+def test_streaming_matches_whole_string():
+    rng = random.Random(31)
+    options = ({}, {"strip_tokens": DEBUG_TOKENS}, {"max_utf8_bytes": 150})
+    for text in CORPUS[:200] + REPORTS:
+        for kwargs in options + ({"max_utf8_bytes": 9000},):
+            whole = TextPostProcessor(**kwargs).process(text)
+            assert _streamed(TextPostProcessor(**kwargs), text, rng) == whole